@@ -1,12 +1,21 @@
 # routers/chat.py
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Response, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
-from backend.core.chat_engine import Chatbot
-from backend.db import crud, models, database
-from backend.db.mysql_v1 import MYSQL
-from backend.core.vectorstore import Vectorstore
+from backend.api import fastjson
+from backend.core import admission, profiling
+from backend.core.history import HistoryManager
+from backend.core.llm import get_client
+from backend.core.warmup import retrieval
+from backend.core.config import COALESCE_REQUESTS, WRITE_BEHIND
+from backend.core.tracing import span
+from backend.db import archive, async_crud, async_database, crud, models, database, pagination, write_behind
+
+import logging
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/sessions", # Base path for routes in this file
@@ -16,8 +25,8 @@ router = APIRouter(
 # --- Chat Session Endpoints ---
 
 @router.post("/", response_model=models.ChatSessionResponse, status_code=status.HTTP_201_CREATED)
-def create_new_chat_session(
-    session_create: models.ChatSessionCreate, db: Session = Depends(database.get_db)
+async def create_new_chat_session(
+    session_create: models.ChatSessionCreate, db: AsyncSession = Depends(async_database.get_async_db)
 ):
     """
     Creates a new chat session.
@@ -25,63 +34,132 @@ def create_new_chat_session(
     - If no title is provided, a default title with timestamp is generated.
     - Returns the created chat session details including its unique ID.
     """
-    return crud.create_chat_session(db=db, session_create=session_create)
+    return await async_crud.create_chat_session(db=db, session_create=session_create)
 
 @router.get("/", response_model=List[models.ChatSessionResponse])
-def read_chat_sessions(
-    skip: int = 0, limit: int = 100, db: Session = Depends(database.get_db)
+async def read_chat_sessions(
+    response: Response, cursor: Optional[str] = None, limit: int = Query(100, ge=1, le=1000),
+    sort: str = Query("created", pattern="^(created|activity)$", description="Order by creation or by last message"),
+    db: AsyncSession = Depends(async_database.get_async_db)
 ):
     """
     Retrieves a list of all existing chat sessions, ordered by creation date (newest first).
-    Supports pagination using `skip` and `limit` query parameters.
+    - With `sort=activity`, the most recently active sessions come first instead.
+    - Each session comes with its activity summary (`last_message_at`, `message_count`, `last_message_preview`),
+      maintained when messages are stored: the list is a single indexed read of the sessions table.
+      Turns still in the write-behind queue are counted once written.
+    - Supports cursor pagination: pass the `X-Next-Cursor` response header of a page as `cursor` to get the next one
+      (with the same `sort`).
     """
-    sessions = crud.get_chat_sessions(db, skip=skip, limit=limit)
+    try:
+        sessions = await async_crud.get_chat_sessions(db, cursor=cursor, limit=limit, sort=sort)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    cursor = pagination.next_cursor(sessions, limit, timestamp_attr=crud.SESSION_SORT_COLUMNS[sort])
+    if cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = cursor
     return sessions
 
 @router.get("/{session_id}", response_model=models.ChatSessionResponse)
-def read_chat_session(session_id: str, db: Session = Depends(database.get_db)):
+async def read_chat_session(session_id: str, db: AsyncSession = Depends(async_database.get_async_db)):
     """
     Retrieves details for a specific chat session by its ID.
     Returns 404 Not Found if the session ID does not exist.
     """
-    db_session = crud.get_chat_session(db, session_id=session_id)
+    db_session = await async_crud.get_chat_session(db, session_id=session_id)
     if db_session is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat session not found")
+    if db_session.archived_at is not None: # Idle session that was archived: restore its messages first
+        await db.run_sync(archive.rehydrate, session_id)
+        await db.refresh(db_session)
     return db_session
 
+@router.post("/delete", response_model=models.SessionsDeletedResponse)
+async def delete_chat_sessions(request: models.SessionIdsRequest, db: AsyncSession = Depends(async_database.get_async_db)):
+    """
+    Deletes chat sessions in bulk, with their messages, citations, summaries and archives.
+    - Unknown IDs are ignored; returns the number of sessions deleted.
+    - Their turns still in the write-behind queue are dropped.
+    """
+    if not request.session_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No session IDs provided")
+    write_behind.queue.discard_sessions(request.session_ids)
+    return {"deleted": await async_crud.delete_chat_sessions(db, session_ids=request.session_ids)}
+
+@router.delete("/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_chat_session(session_id: str, db: AsyncSession = Depends(async_database.get_async_db)):
+    """
+    Deletes a chat session with its messages, citations, summary and archive.
+    Returns 404 Not Found if the session ID does not exist.
+    """
+    write_behind.queue.discard_sessions([session_id])
+    if not await async_crud.delete_chat_sessions(db, session_ids=[session_id]):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat session not found")
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
 # --- Message Endpoints ---
 
-#######################################
-# Initialize the vector store and LLM
-db_faq = "ecommerce_faq"
-MYSQL.create_and_init_db(db_faq)  # Run once to create the database and tables
-engine = MYSQL.get_db_connection(db_faq)
-faq_data = MYSQL.load_faq_data()
-# logger.info(f"\n{'##'*20}\nFAQ data:\n{'##'*20} \n{faq_data}\n")
+# Bounded per-session chat history (recent turns + running summary of older turns)
+history_manager = HistoryManager(llm=get_client())
 
-# Create the vector store
-vectorstore = Vectorstore(docs=faq_data)
+def get_chatbot():
+    """Dependency of the endpoints that need the retrieval engine: 503 until its warm-up is done."""
+    if not retrieval.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The chatbot is warming up, retry shortly",
+            headers={"Retry-After": "5"},
+        )
+    return retrieval.chatbot
 
-# Initialize the chatbot
-chatbot = Chatbot(vectorstore=vectorstore)
-    
-############################################
 
-@router.post("/{session_id}/messages/", response_model=models.MessageResponse, status_code=status.HTTP_201_CREATED)
-def create_new_message(
-    session_id: str, message: models.MessageCreate, db: Session = Depends(database.get_db)
+@router.post("/{session_id}/messages/", response_model=models.TurnResponse, status_code=status.HTTP_201_CREATED)
+async def create_new_message(
+    session_id: str, message: models.MessageCreate, background_tasks: BackgroundTasks,
+    db: Session = Depends(database.get_db), chatbot=Depends(get_chatbot)
 ):
     """
     Adds a new message (user or assistant) to the specified chat session.
     - Requires `role` and `content` in the request body.
     - `ai_model` and `link` are optional.
     - Returns 404 Not Found if the `session_id` does not exist.
-    - Returns the details of the created message.
+    - Returns 503 Service Unavailable while the retrieval engine is warming up.
+    - Returns 503 Service Unavailable with a Retry-After header when too many turns are already running
+      or waiting (admission control), and 429 Too Many Requests when the session sends messages faster
+      than its rate limit.
+    - Returns 503 Service Unavailable when no answer could be generated (provider error, timeout or open
+      circuit). The user message is stored anyway; its ID is in the `X-User-Message-Id` header.
+    - Returns the created assistant message, with the stored user message in `user_message`:
+      the client can append both to its copy of the history without fetching it again, unless
+      `message_epoch` changed (see `GET /sessions/{session_id}/messages/`).
     """
+    try:
+        # Waits on the event loop (not in a thread) for one of the LLM turn slots of this worker
+        async with admission.controller.admit(session_id):
+            turn = await run_in_threadpool(_create_turn, session_id, message, db, chatbot)
+    except admission.AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    # Fold turns that left the verbatim window into the session summary, after the response is sent
+    background_tasks.add_task(history_manager.compact, session_id)
+    return turn
+
+# Response header of a failed turn: ID of the user message, which was stored nonetheless
+USER_MESSAGE_ID_HEADER = "X-User-Message-Id"
+# Message epoch of the session (see `database.ChatSession.message_epoch`), sent with every message list
+MESSAGE_EPOCH_HEADER = "X-Message-Epoch"
+
+def _create_turn(session_id: str, message: models.MessageCreate, db: Session, chatbot) -> models.TurnResponse:
+    """Answers a user message and stores the turn (runs in a threadpool thread)."""
+    with profiling.profiled(): # Only when the request asked for it with a signed X-Profile header
+        return _answer_and_store(session_id, message, db, chatbot)
+
+def _answer_and_store(session_id: str, message: models.MessageCreate, db: Session, chatbot) -> models.TurnResponse:
     # First, check if the session exists
     db_session = crud.get_chat_session(db, session_id=session_id)
     if db_session is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat session not found")
+    archive.ensure_hot(db, db_session) # Restore the messages of an idle session that was archived
+    message_epoch = db_session.message_epoch
 
     # Validate role
     if message.role not in ["user", "assistant"]:
@@ -90,75 +168,129 @@ def create_new_message(
              detail="Message role must be 'user' or 'assistant'"
          )
 
-    # store user data and generate and store assistant data concurrently/simultaneously
-    _ = crud.create_message(db=db, session_id=session_id, message=message)
-    
+    # History of the previous turns (built before storing the new user message)
+    chat_history = history_manager.build_history(db, session_id=session_id)
+    # Give the connection back to the pool while the answer is generated; storing the turn takes a new one
+    db.close()
+
     # assistant_response = database.get_mock_llm_response(message.content) 
     # citations = []
     # if not assistant_response:
-    assistant_response, citations, _ = chatbot.chat(message.content)
-    print(f"\ncreate_new_message -> Citations: {citations}\n")
-    
-    # print(f"\nCitations: {citations}\n")
+    try:
+        with span("chat"):
+            if COALESCE_REQUESTS:
+                assistant_response, citations, _ = chatbot.chat_coalesced(message.content, chat_history=chat_history)
+            else:
+                assistant_response, citations, _ = chatbot.chat(message.content, chat_history=chat_history)
+    except Exception as e:
+        # Keep the user's message: the turn can be retried (or the answer regenerated) without retyping it
+        logger.error(f"No answer for session {session_id} ({type(e).__name__}: {e}), storing the user message alone.")
+        user_msg = _store_user_message(session_id, message, db)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The assistant could not answer, retry shortly (your message was saved)",
+            headers={"Retry-After": "5", USER_MESSAGE_ID_HEADER: str(user_msg.id)},
+        )
+    logger.debug(f"create_new_message -> Citations: {citations}")
     
     assistant_message = models.MessageCreate(
         role="assistant",
         content=assistant_response,
         ai_model="Gemma 3",
     )
-    assistant_data = crud.create_message(db=db, session_id=session_id, message=assistant_message)
-    if citations:
-        citations = crud.create_citations(db=db, message_id=assistant_data.id, citations=citations)
-        # print(f"Type Citation -> ID {type(citations[-1].id)}, doc IDs: {citations[-1].doc_ids}")
-        
-    response_msg = models.MessageResponse(
-        id=assistant_data.id,
-        session_id=session_id,
-        role=assistant_data.role,
-        content=assistant_data.content,
-        ai_model=assistant_data.ai_model,
-        link=assistant_data.link,
-        timestamp=assistant_data.timestamp,
-        citations=citations,
-    )
-    return response_msg
+    if WRITE_BEHIND:
+        # Acknowledged once logged; a background worker writes the turn to the DB in batches
+        user_msg, assistant_msg = write_behind.queue.submit(
+            session_id, user_message=message, assistant_message=assistant_message, citations=citations,
+        )
+    else:
+        # Store the user message, the assistant message and its citations in one transaction
+        user_data, assistant_data = crud.create_turn(
+            db=db, session_id=session_id, user_message=message,
+            assistant_message=assistant_message, citations=citations,
+        )
+        user_msg = models.MessageResponse.model_validate(user_data)
+        assistant_msg = models.MessageResponse.model_validate(assistant_data)
+    return models.TurnResponse(**assistant_msg.model_dump(), user_message=user_msg, message_epoch=message_epoch)
+
+def _store_user_message(session_id: str, message: models.MessageCreate, db: Session) -> models.MessageResponse:
+    """Stores the user message of a turn that got no answer."""
+    if WRITE_BEHIND:
+        user_msg, _ = write_behind.queue.submit(session_id, user_message=message)
+        return user_msg
+    return models.MessageResponse.model_validate(crud.create_message(db=db, session_id=session_id, message=message))
 
 @router.get("/{session_id}/messages/", response_model=List[models.MessageResponse])
-def read_messages_for_session(
-    session_id: str, skip: int = 0, limit: int = 1000, db: Session = Depends(database.get_db)
+async def read_messages_for_session(
+    session_id: str, cursor: Optional[str] = None, limit: int = Query(100, ge=1, le=1000),
+    after: Optional[int] = Query(None, ge=0, description="Only the messages with an ID greater than this one"),
+    epoch: Optional[int] = Query(None, ge=0, description="With `after`: the message epoch the client's messages come from"),
+    db: AsyncSession = Depends(async_database.get_async_db)
 ):
     """
     Retrieves all messages associated with a specific chat session, ordered by timestamp (oldest first).
     - Returns 404 Not Found if the `session_id` does not exist.
-    - Supports pagination (`skip`, `limit`), defaulting to retrieve up to 1000 messages.
+    - The messages of an archived session are restored first (see backend/db/archive.py).
+    - Supports cursor pagination (`cursor`, `limit`), with pages of 100 messages by default.
+      The cursor of the next page is returned in the `X-Next-Cursor` header.
+    - With `after=<message_id>`, returns only the messages newer than the last one the client has
+      (in ID order, at most `limit`; a full page means there may be more). Cannot be combined with `cursor`.
+    - Every response has the message epoch of the session in the `X-Message-Epoch` header. It changes
+      when the messages get new IDs (session restored from the archive under new IDs): a delta read
+      with an older `epoch` returns 409 Conflict, and the client reloads the session without `after`.
     """
+    with profiling.profiled(): # Only when the request asked for it with a signed X-Profile header
+        return await _read_messages(db, session_id, cursor=cursor, limit=limit, after=after, epoch=epoch)
+
+async def _read_messages(db: AsyncSession, session_id: str, cursor: Optional[str], limit: int, after: Optional[int], epoch: Optional[int] = None):
+    if after is not None and cursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Use either `cursor` or `after`, not both")
     # Check if session exists (optional, but good practice)
-    db_session = crud.get_chat_session(db, session_id=session_id)
+    db_session = await async_crud.get_chat_session(db, session_id=session_id)
     if db_session is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat session not found")
-
-    messages = crud.get_messages_for_session(db, session_id=session_id, skip=skip, limit=limit)
-    
-    response_msgs = []
-    for message in messages:
-        # Get citations for each message
-        db_citations = crud.get_citations_by_msg_id(db, msg_id=message.id)
-        response_msg = models.MessageResponse(
-            id=message.id,
-            session_id=session_id,
-            role=message.role,
-            content=message.content,
-            ai_model=message.ai_model,
-            link=message.link,
-            timestamp=message.timestamp,
-            citations=db_citations,  # Include citations in the response
+    if db_session.archived_at is not None: # Idle session that was archived: restore its messages first
+        await db.run_sync(archive.rehydrate, session_id)
+        await db.refresh(db_session)
+    if after is not None and epoch is not None and epoch != db_session.message_epoch:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The message IDs of this session changed, reload it without `after`",
+            headers={MESSAGE_EPOCH_HEADER: str(db_session.message_epoch)},
         )
-        response_msgs.append(response_msg)
-    return response_msgs
+
+    # Messages and all their citations in a constant number of queries
+    try:
+        if after is not None: # Delta since the client's last message
+            messages = await async_crud.get_messages_after(db, session_id=session_id, after_id=after, limit=limit)
+        else:
+            messages = await async_crud.get_messages_with_citations(db, session_id=session_id, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    page = list(messages)
+    if len(page) < limit: # Past the last stored message: add the turns still in the write-behind queue
+        try:
+            if page:
+                after_id = page[-1].id
+            elif after is not None:
+                after_id = after
+            else:
+                after_id = pagination.decode_cursor(cursor)[1] if cursor else 0
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        pending = [message for message in write_behind.queue.pending_messages(session_id) if message.id > after_id]
+        page.extend(pending[:limit - len(page)])
+    headers = {MESSAGE_EPOCH_HEADER: str(db_session.message_epoch)}
+    if after is None: # Delta reads continue with `after` = ID of their last message
+        cursor = pagination.next_cursor(page, limit, timestamp_attr="timestamp")
+        if cursor:
+            headers[pagination.NEXT_CURSOR_HEADER] = cursor
+    # Rows go straight to JSON bytes, without a second validation against the response model
+    return fastjson.FastJSONResponse([fastjson.message_row(message) for message in page], headers=headers)
 
 # Get list of documents by their ids
 @router.post("/documents/", response_model=List[Dict[str, Any]], status_code=status.HTTP_200_OK)
-def get_docs(request: models.DocIdsRequest) -> List[Dict[str, Any]]:
+def get_docs(request: models.DocIdsRequest, _=Depends(get_chatbot)) -> List[Dict[str, Any]]:
     """
     Retrieves a list of documents by their IDs.
     - Accepts a list of document IDs as query parameters.
@@ -169,8 +301,7 @@ def get_docs(request: models.DocIdsRequest) -> List[Dict[str, Any]]:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No document IDs provided")
     # print(f"get_docs -> doc_ids: {doc_ids}")
     
-    # docs = [faq_data[idx] for idx in doc_ids] # same as vectorstore.docs[idx]
-    docs = [doc for doc in faq_data if str(doc['id']) in doc_ids]
+    docs = retrieval.documents.get_many(doc_ids) # ID lookup, no scan (see also GET /documents)
     # print(f"get_docs -> docs: {docs}")
     return docs
 
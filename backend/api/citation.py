@@ -1,34 +1,86 @@
 # routers/citation.py
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Any, List, Optional, Sequence, Union
 
-from backend.db import crud, models, database
+from backend.api.documents import get_document_store
+from backend.db import async_crud, async_database, models, pagination, write_behind
 
 router = APIRouter(
     prefix="/citations",
     tags=["Citations"],
 )
 
+EXPAND_QUERY = Query(None, description="`documents` to embed the cited documents in the response")
+
+def expand_documents(citations: Sequence[Any], expand: Optional[str]) -> List[Union[models.CitationExpanded, models.CitationResponse]]:
+    """
+    Citations as API models, with their documents embedded when `expand` is "documents".
+    Documents come from the in-memory document store, so expanding costs no extra query.
+    """
+    if expand is None:
+        return [models.CitationResponse.model_validate(citation) for citation in citations]
+    if expand != "documents":
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown expand value: {expand}")
+    documents = get_document_store() # 503 while the documents are loading
+    return [
+        models.CitationExpanded(
+            **models.CitationResponse.model_validate(citation).model_dump(),
+            documents=documents.get_many(citation.doc_ids),
+        )
+        for citation in citations
+    ]
+
 @router.get("/", response_model=List[models.CitationResponse])
-def read_all_citations(
-    skip: int = 0, limit: int = 100, db: Session = Depends(database.get_db)
+async def read_all_citations(
+    response: Response, cursor: Optional[str] = None, limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(async_database.get_async_db)
 ):
     """
     Retrieves a list of all available citations (documents).
-    Supports pagination using `skip` and `limit`.
+    Supports cursor pagination: the cursor of the next page is returned in the `X-Next-Cursor` header.
     """
-    citations = crud.get_citations(db, skip=skip, limit=limit)
+    try:
+        citations = await async_crud.get_citations(db, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    cursor = pagination.next_cursor(citations, limit)
+    if cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = cursor
     return citations
 
-@router.get("/{citation_id}", response_model=models.CitationResponse)
-def read_citation_details(citation_id: str, db: Session = Depends(database.get_db)):
+@router.get("/by-document/{doc_id}", response_model=List[models.CitationResponse])
+async def read_citations_of_document(
+    doc_id: str, response: Response, cursor: Optional[str] = None, limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(async_database.get_async_db)
+):
+    """
+    Retrieves the citations that reference a document, i.e. which answers cited it (e.g. FAQ 42).
+    Supports cursor pagination: the cursor of the next page is returned in the `X-Next-Cursor` header.
+    The citations of archived sessions are not listed until the sessions are read again (see backend/db/archive.py).
+    """
+    try:
+        citations = await async_crud.get_citations_by_doc_id(db, doc_id=doc_id, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    cursor = pagination.next_cursor(citations, limit)
+    if cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = cursor
+    return citations
+
+@router.get("/{citation_id}", response_model=Union[models.CitationExpanded, models.CitationResponse])
+async def read_citation_details(
+    citation_id: str, expand: Optional[str] = EXPAND_QUERY,
+    db: AsyncSession = Depends(async_database.get_async_db)
+):
     """
     Retrieves the details (title, text) for a specific citation ID.
-    Returns 404 Not Found if the citation ID does not exist in the database.
+    - With `expand=documents`, the cited documents are embedded, so one request is enough to show a citation.
+    - Returns 404 Not Found if the citation ID does not exist in the database, or is in an archived session.
     """
-    db_citation = crud.get_citation(db, citation_id=citation_id)
+    db_citation = await async_crud.get_citation(db, citation_id=citation_id)
+    if db_citation is None and citation_id.isdigit():
+        db_citation = write_behind.queue.pending_citation(int(citation_id)) # Not flushed yet
     if db_citation is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Citation not found")
-    return db_citation
-
+    return expand_documents([db_citation], expand)[0]
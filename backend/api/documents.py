@@ -0,0 +1,54 @@
+# routers/documents.py
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from typing import Any, Dict, List
+
+from backend.core.config import DOCUMENTS_MAX_AGE
+from backend.core.documents import DocumentStore
+from backend.core.instrumentation import cache_lookup
+from backend.core.warmup import retrieval
+
+router = APIRouter(
+    prefix="/documents",
+    tags=["Documents"],
+)
+
+def get_document_store() -> DocumentStore:
+    """Dependency returning the FAQ documents: 503 until the warm-up loaded them."""
+    if not retrieval.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The documents are still loading, retry shortly",
+            headers={"Retry-After": "5"},
+        )
+    return retrieval.documents
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an `If-None-Match` header matches an ETag (weak comparison, as for GET requests)."""
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in (candidate.removeprefix("W/") for candidate in candidates)
+
+@router.get("/", response_model=List[Dict[str, Any]])
+def read_documents(
+    request: Request, response: Response,
+    ids: List[str] = Query(..., description="Document IDs, comma-separated (`?ids=1,4`) or repeated (`?ids=1&ids=4`)"),
+    documents: DocumentStore = Depends(get_document_store),
+):
+    """
+    Retrieves documents by their IDs, in the order of the IDs. Unknown IDs are skipped.
+    - Returns a strong `ETag` derived from the content of the documents and `Cache-Control` headers.
+    - Returns 304 Not Modified when the `If-None-Match` request header matches the ETag.
+    """
+    doc_ids = [doc_id.strip() for value in ids for doc_id in value.split(",") if doc_id.strip()]
+    if not doc_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No document IDs provided")
+    docs = documents.get_many(doc_ids)
+
+    etag = documents.etag(docs)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={DOCUMENTS_MAX_AGE}"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None: # Revalidation of a client (or proxy) cached copy
+        cache_lookup("documents_etag", etag_matches(if_none_match, etag))
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return docs
@@ -0,0 +1,66 @@
+# fastjson.py
+"""Fast JSON responses for large reads (e.g. the messages of a long session).
+
+Rows are turned into plain dicts straight from the ORM objects and encoded to bytes with orjson
+(falls back to the stdlib encoder if orjson is not installed). Returning a `FastJSONResponse` from
+a route skips FastAPI's validation of the result against `response_model`, so it must produce
+the same shape as the response model (the model is still used for the OpenAPI schema).
+"""
+import json
+import datetime
+import typing as tp
+
+try:
+    import orjson
+except ImportError: # Optional dependency
+    orjson = None
+
+from fastapi import Response
+from pydantic import BaseModel
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat() # Same format as orjson and pydantic
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(content: tp.Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_default, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: tp.Any) -> bytes:
+        return dumps(content)
+
+
+def citation_row(citation) -> dict:
+    """`models.CitationBase` fields of a citation."""
+    if isinstance(citation, BaseModel):
+        return citation.model_dump()
+    return {
+        "id": citation.id,
+        "msg_id": citation.msg_id,
+        "doc_ids": citation.doc_ids,
+        "text": citation.text,
+        "start": citation.start,
+        "end": citation.end,
+    }
+
+def message_row(message) -> dict:
+    """`models.MessageResponse` fields of a message (ORM object, or pending `MessageResponse`)."""
+    if isinstance(message, BaseModel):
+        return message.model_dump()
+    return {
+        "role": message.role,
+        "content": message.content,
+        "link": message.link,
+        "id": message.id,
+        "session_id": message.session_id,
+        "timestamp": message.timestamp,
+        "ai_model": message.ai_model,
+        "citations": [citation_row(citation) for citation in message.citations],
+    }
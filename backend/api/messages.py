@@ -0,0 +1,59 @@
+# routers/messages.py
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional, Union
+
+from backend.api.citation import EXPAND_QUERY, expand_documents
+from backend.db import async_crud, async_database, models, pagination, search, write_behind
+
+router = APIRouter(
+    prefix="/messages",
+    tags=["Chat Sessions & Messages"],
+)
+
+@router.get("/search", response_model=List[models.MessageSearchResult])
+async def search_messages(
+    response: Response, q: str = Query(..., min_length=1, max_length=500, description="Words to search for"),
+    session_id: Optional[str] = Query(None, description="Only search the messages of this chat session"),
+    cursor: Optional[str] = None, limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(async_database.get_async_db)
+):
+    """
+    Full-text search of the stored messages, most relevant first.
+    - Every word of `q` must match (whole words; on SQLite, other forms of a word match too).
+    - Each result has an HTML `snippet` of the message with the matching words in `<mark>` tags
+      (the rest of the text is escaped), and its session ID and title.
+    - Archived sessions are not searched until they are read again (see backend/db/archive.py).
+    - Supports cursor pagination: pass the `X-Next-Cursor` response header of a page as `cursor` to get the next one.
+    - Returns 400 Bad Request for a query without words, 501 Not Implemented if the database has no full-text index.
+    """
+    try:
+        results, cursor = await search.search_messages(db, query=q, session_id=session_id, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except search.SearchUnavailable as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+    if cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = cursor
+    return results
+
+@router.get("/{msg_id}/citations", response_model=List[Union[models.CitationExpanded, models.CitationResponse]])
+async def read_message_citations(
+    msg_id: int, expand: Optional[str] = EXPAND_QUERY,
+    db: AsyncSession = Depends(async_database.get_async_db)
+):
+    """
+    Retrieves all the citations of a message, in ID order, in one query.
+    - With `expand=documents`, the cited documents are embedded, so the whole evidence of an
+      answer can be fetched (or prefetched) with a single request.
+    - Returns an empty list for a message without citations.
+    - Returns 404 Not Found if the message does not exist, or is in an archived session
+      (reading the session restores it, see backend/db/archive.py).
+    """
+    citations = await async_crud.get_citations_by_msg_id(db, msg_id=msg_id)
+    if not citations: # Maybe a turn not flushed yet, or a message without citations
+        citations = write_behind.queue.pending_citations_of_message(msg_id)
+        if not citations and write_behind.queue.pending_message(msg_id) is None \
+                and await async_crud.get_message(db, msg_id=msg_id) is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message not found")
+    return expand_documents(citations, expand)
@@ -0,0 +1,32 @@
+# routers/metrics.py
+from fastapi import APIRouter, Response
+from typing import Any, Dict, List
+
+from backend.core import metrics, tracing
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["Metrics"],
+)
+
+@router.get("", response_class=Response)
+def read_prometheus_metrics():
+    """
+    Returns every metric of this worker process in the Prometheus text exposition format:
+    request latency per route and status, SQL statement counts and durations, provider call latency
+    and errors per operation, cache hit rates, admission control, write-behind backlog, index size and
+    the chat pipeline stage histograms. With several workers, scrape each one (or aggregate per pod).
+    """
+    return Response(content=metrics.render_prometheus(), media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+@router.get("/stages", response_model=Dict[str, List[Dict[str, Any]]])
+def read_stage_metrics():
+    """
+    Returns the latency histograms of the chat pipeline stages (query generation, embedding, knn,
+    rerank, time to first token, generation, DB calls) and the tokens billed per stage,
+    as recorded in this worker process since it started.
+    """
+    return {
+        "durations": tracing.STAGE_SECONDS.snapshot(),
+        "tokens": tracing.STAGE_TOKENS.snapshot(),
+    }
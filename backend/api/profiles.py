@@ -0,0 +1,51 @@
+# routers/profiles.py
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import FileResponse, PlainTextResponse
+import os
+
+from backend.core import profiling
+from backend.core.config import PROFILE_SECRET
+
+router = APIRouter(
+    prefix="/profiles",
+    tags=["Profiling"],
+)
+
+def require_signature(request: Request) -> None:
+    """Dependency: the request must carry an `X-Profile` header signed for it (404 when profiling is disabled)."""
+    if not PROFILE_SECRET:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profiling is disabled")
+    header = request.headers.get(profiling.PROFILE_HEADER, "")
+    if not profiling.verify(header, request.method, request.url.path):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Missing or invalid X-Profile signature")
+
+def profile_path(profile_id: str) -> str:
+    try:
+        path = profiling.profiler.path_of(profile_id)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if not os.path.exists(path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    return path
+
+@router.get("/{profile_id}", dependencies=[Depends(require_signature)])
+def read_profile(profile_id: str):
+    """
+    Downloads a request profile (pstats format, e.g. `snakeviz <id>.pstats`).
+    - Requires an `X-Profile` header signed for this request.
+    - Returns 404 Not Found if the profile does not exist (or was pruned).
+    """
+    return FileResponse(profile_path(profile_id), media_type="application/octet-stream", filename=f"{profile_id}.pstats")
+
+@router.get("/{profile_id}/summary", response_class=PlainTextResponse, dependencies=[Depends(require_signature)])
+def read_profile_summary(
+    profile_id: str,
+    sort: str = Query("cumulative", pattern="^(cumulative|tottime|ncalls)$"),
+    limit: int = Query(40, ge=1, le=500),
+):
+    """
+    Returns the top functions of a request profile as text, sorted by `sort`.
+    - Requires an `X-Profile` header signed for this request.
+    """
+    profile_path(profile_id)
+    return profiling.profiler.summary(profile_id, sort=sort, limit=limit)
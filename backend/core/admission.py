@@ -0,0 +1,228 @@
+"""Admission control of the LLM-bound chat turns (per worker process).
+
+- At most `max_in_flight` turns run at once. Up to `max_queue` more wait for a slot, first come
+  first served, for at most `queue_timeout` seconds. By default, `max_in_flight` is what the sync DB
+  connection pool can serve (`pool_capacity`): a turn past the pool would wait for a connection (and
+  time out) inside a threadpool thread, instead of being queued or shed here.
+- Anything beyond that is shed right away with `AdmissionRejected` (503 + Retry-After): under a
+  spike, most users get a fast answer and the rest a fast "retry later", instead of everyone waiting
+  behind an unbounded backlog while the provider starts rate-limiting us.
+- Optional per-session token buckets (`session_rate` turns per second, bursts of `session_burst`)
+  keep a single client from taking all the slots (429 + Retry-After). Only admitted turns use a token:
+  a turn shed for load does not count against its session.
+
+Waiting happens on the event loop, so queued requests do not hold a threadpool thread.
+All the state is only touched from the event loop: no locks needed.
+"""
+import math
+import time
+import asyncio
+import contextlib
+import typing as tp
+from collections import OrderedDict, deque
+
+from backend.core.config import (
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_POOL_HEADROOM,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_QUEUE_TIMEOUT,
+    ADMISSION_SESSION_RATE,
+    ADMISSION_SESSION_BURST,
+)
+from backend.core.metrics import Counter, Gauge
+from backend.db import database
+
+import logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+MAX_RETRY_AFTER = 60 # seconds
+MAX_SESSION_BUCKETS = 10000 # least recently used buckets are dropped past this
+UNBOUNDED_POOL_MAX_IN_FLIGHT = 16 # default cap when the pool has no limit
+
+TURNS_REJECTED = Counter("chat_turns_rejected_total", "Chat turns rejected by admission control", labelnames=("reason",))
+
+
+class AdmissionRejected(Exception):
+    """A chat turn was not admitted; the client should retry after `retry_after` seconds."""
+    def __init__(self, detail: str, retry_after: int, status_code: int = 503, reason: str = "overloaded"):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+        self.status_code = status_code
+        self.reason = reason
+
+
+def pool_capacity(pool, headroom: int = ADMISSION_POOL_HEADROOM) -> int:
+    """Chat turns a connection pool can serve at once: its connections (pool_size + max_overflow) minus `headroom`, at least 1."""
+    size = pool.size() if hasattr(pool, "size") else 1 # e.g. one connection per thread for in-memory SQLite
+    max_overflow = getattr(pool, "_max_overflow", 0)
+    if max_overflow < 0: # No limit
+        return UNBOUNDED_POOL_MAX_IN_FLIGHT
+    return max(size + max_overflow - headroom, 1)
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst` tokens."""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def wait(self) -> float:
+        """Seconds until a token is available (0 if there is one)."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        """Takes a token. Turns of a session admitted concurrently can leave the bucket in debt."""
+        self._refill()
+        self.tokens -= 1
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class AdmissionController:
+    """Caps the concurrent chat turns, with a bounded wait queue and optional per-session rate limits.
+
+    Usage: `async with controller.admit(session_id): ...`. `max_in_flight=0` disables the controller,
+    a negative `max_in_flight` caps the turns at the capacity of the DB connection pool.
+    """
+    def __init__(self, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, max_queue: int = ADMISSION_MAX_QUEUE,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT, session_rate: float = ADMISSION_SESSION_RATE,
+                 session_burst: int = ADMISSION_SESSION_BURST):
+        capacity = pool_capacity(database.engine.pool)
+        if max_in_flight < 0:
+            max_in_flight = capacity
+        elif max_in_flight > capacity:
+            logger.warning(
+                f"ADMISSION_MAX_IN_FLIGHT={max_in_flight} exceeds the {capacity} chat turns the DB connection pool can serve: "
+                f"turns past it wait for a connection in a thread. Raise DB_POOL_SIZE / DB_MAX_OVERFLOW."
+            )
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected: tp.Dict[str, int] = {"queue_full": 0, "queue_timeout": 0, "session_rate": 0}
+        self.turn_seconds = 2.0 # Moving average of the turn durations, for Retry-After
+        self._waiters: tp.Deque[asyncio.Future] = deque()
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_in_flight > 0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, session_id: tp.Optional[str] = None):
+        """Holds a slot for the duration of the block. Raises `AdmissionRejected` if none can be had in time."""
+        if not self.enabled:
+            yield
+            return
+        await self.acquire(session_id)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.turn_seconds = 0.8 * self.turn_seconds + 0.2 * (time.perf_counter() - start)
+            self.release()
+
+    async def acquire(self, session_id: tp.Optional[str] = None) -> None:
+        rate_limited = session_id is not None and self.session_rate > 0
+        if rate_limited:
+            self._check_session_rate(session_id)
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self._admitted(session_id if rate_limited else None)
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._reject("queue_full", "The server is busy, retry shortly")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait({waiter}, timeout=self.queue_timeout)
+        except asyncio.CancelledError: # Client went away while queued
+            self._leave_queue(waiter)
+            raise
+        if not waiter.done():
+            self._leave_queue(waiter)
+            self._reject("queue_timeout", "The server is busy, retry shortly")
+        self._admitted(session_id if rate_limited else None) # The slot was handed over by `release`
+
+    def release(self) -> None:
+        # Hand the slot to the oldest waiter; in_flight is unchanged
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def retry_after(self) -> int:
+        """Estimated seconds until the current backlog is served."""
+        backlog = (len(self._waiters) + 1) / max(self.max_in_flight, 1)
+        return min(max(math.ceil(self.turn_seconds * backlog), 1), MAX_RETRY_AFTER)
+
+    def stats(self) -> tp.Dict[str, tp.Any]:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
+
+    def _leave_queue(self, waiter: asyncio.Future) -> None:
+        if waiter.done() and not waiter.cancelled():
+            self.release() # A slot was handed over just now: pass it on
+            return
+        waiter.cancel()
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+
+    def _admitted(self, session_id: tp.Optional[str]) -> None:
+        self.admitted += 1
+        if session_id is not None:
+            self._bucket(session_id).take()
+
+    def _bucket(self, session_id: str) -> TokenBucket:
+        bucket = self._buckets.get(session_id)
+        if bucket is None:
+            bucket = self._buckets[session_id] = TokenBucket(self.session_rate, self.session_burst)
+            if len(self._buckets) > MAX_SESSION_BUCKETS:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(session_id)
+        return bucket
+
+    def _check_session_rate(self, session_id: str) -> None:
+        wait = self._bucket(session_id).wait()
+        if wait > 0:
+            self.rejected["session_rate"] += 1
+            TURNS_REJECTED.inc(reason="session_rate")
+            raise AdmissionRejected(
+                "Too many messages for this chat session, slow down", retry_after=min(math.ceil(wait), MAX_RETRY_AFTER),
+                status_code=429, reason="session_rate",
+            )
+
+    def _reject(self, reason: str, detail: str) -> None:
+        self.rejected[reason] += 1
+        TURNS_REJECTED.inc(reason=reason)
+        logger.info(f"Chat turn rejected ({reason}): {self.in_flight} in flight, {len(self._waiters)} waiting.")
+        raise AdmissionRejected(detail, retry_after=self.retry_after(), reason=reason)
+
+
+# Shared controller of the chat turns of this worker process
+controller = AdmissionController()
+
+Gauge("chat_turns_in_flight", "Chat turns holding an admission slot", function=lambda: controller.in_flight)
+Gauge("chat_turns_waiting", "Chat turns waiting for an admission slot", function=lambda: controller.waiting)
@@ -1,18 +1,24 @@
 import os
+import re
+import time
+import copy
+import json
+import hashlib
 import typing as tp
 from tqdm import tqdm
 from backend.core.vectorstore import Vectorstore
+from backend.core.llm import get_client
+from backend.core.config import CHAT_MODEL
+from backend.core.singleflight import SingleFlight
+from backend.core.resilience import guarded
+from backend.core.tracing import Span, span, record_span, billed_tokens
 from backend.db.mysql_v1 import MYSQL
-import cohere
 from cohere.types.chat_citation import ChatCitation
 
 import logging
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-from dotenv import load_dotenv
-load_dotenv('.env')
-COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 
 class Chatbot:
     
@@ -25,8 +31,9 @@ class Chatbot:
         - llm: The language model for generating responses.
         """
         self.vectorstore = vectorstore
-        self.llm = cohere.Client(COHERE_API_KEY) # Get your API key here: https://dashboard.cohere.com/api-keys
+        self.llm = get_client() # Cohere client, or a local stand-in depending on LLM_PROVIDER
         self.chat_history: list = []
+        self.inflight = SingleFlight() # Coalesces concurrent identical questions (see chat_coalesced)
         
         self.ANSWER_SYSTEM_PROMPT = """
 You are a helpful, knowledgeable, and honest AI assistant named 'Chatbot Germano'. You must always refer to yourself as 'Chatbot Germano'.
@@ -81,7 +88,31 @@ You are an AI assistant specialized in analyzing user requests and generating op
         self.chat_history = []
         self.chat(message)
 
-    def chat(self, message: str):
+    def coalesce_key(self, message: str, chat_history: tp.List[dict]) -> str:
+        """
+        Key identifying requests that get the same answer: the normalized message,
+        the chat history and the retrieval configuration.
+        """
+        normalized = re.sub(r"\s+", " ", message).strip().lower()
+        history = json.dumps(chat_history, sort_keys=True, default=str)
+        key = f"{normalized}|{hashlib.sha256(history.encode()).hexdigest()}|{self.vectorstore.config_fingerprint()}|{CHAT_MODEL}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def chat_coalesced(self, message: str, chat_history: tp.List[dict]):
+        """
+        Same as `chat`, but concurrent requests with the same `coalesce_key` wait on one
+        in-flight computation (query generation, retrieval, rerank and generation) instead
+        of each running their own. Every caller gets its own copy of the result.
+        """
+        (chatbot_response, citations, documents), shared = self.inflight.do(
+            self.coalesce_key(message, chat_history),
+            lambda: self.chat(message, chat_history=chat_history),
+        )
+        if shared:
+            logger.info("Answer shared with concurrent identical requests.")
+        return chatbot_response, copy.deepcopy(citations), copy.deepcopy(documents)
+
+    def chat(self, message: str, chat_history: tp.Optional[tp.List[dict]] = None):
         """
         1. Give the user message to the LLM to determine if additional context is needed
         2. If so:
@@ -90,16 +121,53 @@ You are an AI assistant specialized in analyzing user requests and generating op
         - The LLM uses the documents as context and responds
         3. If not:
         - The LLM responds directly without additional context
+        
+        Parameters:
+        - message: The user message.
+        - chat_history: The (bounded) history of the chat session, e.g. from `HistoryManager.build_history`.
+          If None, the in-memory history of this Chatbot instance is used and updated.
         """
+        use_own_history = chat_history is None
+        if use_own_history:
+            chat_history = self.chat_history
 
         # Generate search queries, if any
-        response = self.llm.chat(message=message,
-                                preamble=self.SEARCH_QUERY_SYSTEM_PROMPT,
-                                model="command-a-03-2025",
-                                search_queries_only=True, # Generate only search queries, not full responses
-                                chat_history=self.chat_history
-                                )
-        print(f"Search queries: {response}")
+        search_queries = self.generate_search_queries(message, chat_history)
+
+        # If there are search queries, retrieve the documents
+        with span("retrieval"):
+            retrieved_docs = self.retrieve_documents(search_queries) if search_queries else []
+
+        # Use document chunks (if any) to respond. If the LLM is slow or failing, answer from the top FAQ match
+        chatbot_response, citations, documents, new_history = guarded(
+            "chat_stream", self.generate_answer, message, chat_history, retrieved_docs,
+            fallback=lambda: self.fallback_answer(retrieved_docs),
+        )
+        # Update the chat history for the next turn
+        if use_own_history and new_history is not None:
+            self.chat_history = new_history
+
+        return chatbot_response, citations, documents
+
+    def generate_search_queries(self, message: str, chat_history: tp.List[dict]) -> tp.List[str]:
+        """
+        Asks the LLM for the search queries needed to answer `message` (empty if no retrieval is needed).
+        If the LLM is unavailable, the message itself is used as the search query.
+        """
+        with span("query_generation") as query_span:
+            response = guarded(
+                "chat", self.llm.chat,
+                message=message,
+                preamble=self.SEARCH_QUERY_SYSTEM_PROMPT,
+                model=CHAT_MODEL,
+                search_queries_only=True, # Generate only search queries, not full responses
+                chat_history=chat_history,
+                fallback=lambda: None,
+            )
+            query_span.add_tokens(*billed_tokens(response))
+        if response is None:
+            return [message]
+        logger.debug(f"Search queries: {response}")
         search_queries = []
         for query in response.search_queries:
             search_queries.append(query.text)
@@ -109,74 +177,95 @@ You are an AI assistant specialized in analyzing user requests and generating op
         if not search_queries:
             search_queries = response.text.split("\n")
             search_queries = [query.strip() for query in search_queries if query.strip()]  # Clean up the queries
-            print(f"Search queries (from text): {search_queries}")
+            logger.debug(f"Search queries (from text): {search_queries}")
+        return search_queries
 
-        # If there are search queries, retrieve the documents
-        if search_queries:
-            logger.info("Retrieving information...")
-
-            # Retrieve document chunks for each query
-            matching_docs = ([doc for query in search_queries for doc in self.vectorstore.retrieve(query)])
-            ids_set = set()
-            documents = []
-            for doc in matching_docs: # Take only unique documents
-                if doc['id'] not in ids_set:
-                    documents.append(doc)
-                    ids_set.add(doc['id'])
-            print(f"Documents that matched the query: \n{documents}")
-
-            # Use document chunks to respond
+    def retrieve_documents(self, search_queries: tp.List[str]) -> tp.List[dict]:
+        """Retrieves the unique documents matching the search queries; queries that fail are skipped."""
+        logger.info("Retrieving information...")
+
+        # Retrieve document chunks for each query
+        matching_docs = []
+        for query in search_queries:
+            try:
+                matching_docs.extend(self.vectorstore.retrieve(query))
+            except Exception as e:
+                logger.error(f"Retrieval failed for query '{query}': {type(e).__name__}: {e}")
+        ids_set = set()
+        documents = []
+        for doc in matching_docs: # Take only unique documents
+            if doc['id'] not in ids_set:
+                documents.append(doc)
+                ids_set.add(doc['id'])
+        logger.debug(f"Documents that matched the query: \n{documents}")
+        return documents
+
+    def generate_answer(self, message: str, chat_history: tp.List[dict], documents: tp.List[dict]):
+        """
+        Streams the answer of the LLM, grounded in `documents` if any.
+        
+        Returns:
+        - The answer text, its citations, the cited documents and the updated chat history.
+        """
+        generation_span = Span("generation")
+        start = time.perf_counter()
+        if documents:
             response = self.llm.chat_stream(
                 preamble=self.ANSWER_SYSTEM_PROMPT, #.format(context=documents),
                 message=message,
-                model="command-a-03-2025",
+                model=CHAT_MODEL,
                 documents=documents,
-                chat_history=self.chat_history,
+                chat_history=chat_history,
             )
-
         else:
             # If no additional context is needed, respond directly
-            # docs = self.vectorstore.retrieve(message)
             response = self.llm.chat_stream(
                 preamble=self.ANSWER_SYSTEM_PROMPT,
                 message=message,
-                model="command-a-03-2025",
-                # documents=docs,
-                chat_history=self.chat_history,
+                model=CHAT_MODEL,
+                chat_history=chat_history,
             )
 
-        # Print the chatbot response and citations
         chatbot_response = ""
         citations: tp.List[ChatCitation] = []
-        documents: tp.List[dict] = []
-        # print(f"\n\n{'##'*20}\nChatbot:\n{'##'*20}\n")
+        cited_documents: tp.List[dict] = []
+        new_history = None
 
         for event in response:
             if event.event_type == "text-generation":
-                # print(event.text, end="")
+                if not chatbot_response:
+                    record_span(Span("ttft"), time.perf_counter() - start) # Time to first token
                 chatbot_response += event.text
             if event.event_type == "stream-end":
+                generation_span.add_tokens(*billed_tokens(event.response))
                 if event.response.citations:
-                    # citations.extend(event.response.citations)
-                    # print(f"Type event.response.citations: {type(event.response.citations)}")
-                    # print(f"Length of event.response.citations: {len(event.response.citations)}")
-                    # print(f"Type : {type(event.response.citations[0])}")
-                    # print("\n\nCITATIONS:")
                     for citation in event.response.citations:
                         citations.append(citation.dict())
-                    #     print(citation)
                 if event.response.documents:
-                    documents.extend(event.response.documents)
-                    # print(f"Type event.response.documents: {type(event.response.documents)}")
-                    # print(f"Length of event.response.documents: {len(event.response.documents)}")
-                    # print(f"Type : {type(event.response.documents[0])} \t Keys: {event.response.documents[0].keys()}")
-                    # print("\nCITED DOCUMENTS:")
-                    # for document in event.response.documents:
-                    #     print(document)
-                # Update the chat history for the next turn
-                self.chat_history = event.response.chat_history
+                    cited_documents.extend(event.response.documents)
+                new_history = event.response.chat_history
+        record_span(generation_span, time.perf_counter() - start)
                 
-        return chatbot_response, citations, documents
+        return chatbot_response, citations, cited_documents, new_history
+
+    def fallback_answer(self, documents: tp.List[dict]):
+        """
+        Degraded answer used when the LLM cannot answer in time: the top FAQ match, cited as is.
+        Same return values as `generate_answer`.
+        """
+        if not documents:
+            return "Sorry, I can't answer right now. Please try again in a few minutes.", [], [], None
+        doc = documents[0]
+        prefix = "I can't give a complete answer right now, but this is the most relevant entry of our FAQ:\n\n"
+        chatbot_response = prefix + doc["text"]
+        citation = {
+            "start": len(prefix),
+            "end": len(chatbot_response),
+            "text": doc["text"],
+            "document_ids": [doc["id"]],
+            "type": "TEXT_CONTENT",
+        }
+        return chatbot_response, [citation], [doc], None
 
 if __name__ == "__main__":
     
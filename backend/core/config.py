@@ -0,0 +1,115 @@
+# config.py
+import os
+from dotenv import load_dotenv
+load_dotenv('.env')
+
+# --- LLM ---
+COHERE_API_KEY = os.getenv("COHERE_API_KEY") # Get your API key here: https://dashboard.cohere.com/api-keys
+CHAT_MODEL = os.getenv("CHAT_MODEL", "command-a-03-2025")
+
+# --- Chat history compaction ---
+# Number of most recent turns (user + assistant message pairs) sent to the LLM verbatim
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", 6))
+# Max (estimated) tokens of chat history (running summary + verbatim turns) sent with each LLM call
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 2000))
+# Max tokens the LLM may use for the running summary of older turns
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", 400))
+# Max messages folded into the summary per LLM call (older backlogs are folded in several steps)
+HISTORY_SUMMARY_BATCH = int(os.getenv("HISTORY_SUMMARY_BATCH", 20))
+
+# --- LLM / embedding provider ---
+# "cohere" (real API), "synthetic" (local stand-in), "record" (cohere + write cassette) or "replay" (read cassette)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "cohere")
+LLM_CASSETTE_PATH = os.getenv("LLM_CASSETTE_PATH", "./cassettes/cohere.jsonl")
+# Replay the latencies captured in the cassette instead of answering immediately
+LLM_REPLAY_LATENCY = os.getenv("LLM_REPLAY_LATENCY", "0") == "1"
+# Latency distribution per operation in ms, e.g. "embed=lognormal:60:0.3;chat=uniform:200:600".
+# Distributions: fixed:<ms>, uniform:<lo>:<hi>, normal:<mean>:<std>, lognormal:<median>:<sigma>
+SYNTHETIC_LATENCY = os.getenv(
+    "SYNTHETIC_LATENCY",
+    "embed=lognormal:60:0.3;rerank=lognormal:120:0.4;chat=lognormal:400:0.5;chat_stream=lognormal:300:0.5",
+)
+SYNTHETIC_TOKENS_PER_SEC = float(os.getenv("SYNTHETIC_TOKENS_PER_SEC", 60))
+SYNTHETIC_SEED = int(os.getenv("SYNTHETIC_SEED", 0))
+
+# --- Request coalescing ---
+# Concurrent identical questions (same normalized message, history and retrieval config) share one LLM/retrieval run
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "1") == "1"
+
+# --- Provider resilience ---
+# Deadline per provider operation in seconds (chat_stream: whole generation)
+PROVIDER_DEADLINES = os.getenv("PROVIDER_DEADLINES", "embed=5;rerank=3;chat=10;chat_stream=30")
+# Idempotent operations that get a hedged duplicate request when slower than their p95
+PROVIDER_HEDGE_OPS = os.getenv("PROVIDER_HEDGE_OPS", "embed,rerank,chat").split(",")
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", 0.95))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 0.05)) # seconds
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20)) # latencies needed before trusting the p95
+# Circuit breaker: opens when the error rate over the last BREAKER_WINDOW calls reaches BREAKER_ERROR_RATE
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", 20))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", 10))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", 0.5))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 30)) # seconds before a trial call is let through
+PROVIDER_MAX_WORKERS = int(os.getenv("PROVIDER_MAX_WORKERS", 32)) # threads running provider calls
+
+# --- Tracing ---
+# Add a Server-Timing header (per-stage durations) to every response. Without it, clients can still
+# ask for the header on a single request with "X-Server-Timing: 1".
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+# --- Write-behind persistence of chat turns ---
+# Acknowledge a turn once it is appended to a local log; a background worker writes it to the DB in batches.
+# Message/citation IDs are allocated in the process: only enable it with a single API worker process.
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_LOG = os.getenv("WRITE_BEHIND_LOG", "./data/turns.log")
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", 64)) # max turns per DB transaction
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", 0.2)) # seconds between flushes
+# fsync every append (a turn survives a machine crash); without it, only a process crash
+WRITE_BEHIND_FSYNC = os.getenv("WRITE_BEHIND_FSYNC", "1") == "1"
+
+# --- Database connection pool (sync and async engines; ignored for SQLite) ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10)) # connections kept open
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20)) # extra connections opened under load
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10)) # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800)) # seconds; MySQL drops idle connections (wait_timeout)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1" # check connections before handing them out
+# Async engine URL; derived from DATABASE_URL when empty (sqlite -> sqlite+aiosqlite, mysql -> mysql+aiomysql)
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", "")
+
+# --- Startup ---
+# Re-run the FAQ database SQL script (drops the database) even if it did not change since the last init
+FAQ_DB_FORCE_INIT = os.getenv("FAQ_DB_FORCE_INIT", "0") == "1"
+# Directory of a prebuilt retrieval index (`python -m backend.core.index_store build --out <dir>`).
+# When set, workers memory-map it instead of embedding the FAQ corpus on startup.
+INDEX_DIR = os.getenv("INDEX_DIR", "")
+
+# --- HTTP caching ---
+# Cache lifetime of document responses (GET /documents); they only change with a new ingest
+DOCUMENTS_MAX_AGE = int(os.getenv("DOCUMENTS_MAX_AGE", 3600)) # seconds
+# Responses larger than this are gzip-compressed (when the client accepts gzip)
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", 1024)) # bytes
+
+# --- Admission control of chat turns (per worker process) ---
+# LLM turns running at once; 0 disables it. Unset: as many as the DB connection pool can serve
+# (pool_size + max_overflow - ADMISSION_POOL_HEADROOM), since every turn needs a connection to store its messages
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT") or -1)
+ADMISSION_POOL_HEADROOM = int(os.getenv("ADMISSION_POOL_HEADROOM", 2)) # connections left to the other requests
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 32)) # turns waiting for a slot; more get a 503
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 2.0)) # seconds a turn may wait for a slot
+# Per-session token bucket: turns per second and burst size (0 = no per-session limit)
+ADMISSION_SESSION_RATE = float(os.getenv("ADMISSION_SESSION_RATE", 0))
+ADMISSION_SESSION_BURST = int(os.getenv("ADMISSION_SESSION_BURST", 5))
+
+# --- Per-request profiling ---
+# Key of the signed `X-Profile` header that turns on cProfile for a single request (empty: profiling disabled)
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./data/profiles")
+PROFILE_MAX_CONCURRENT = int(os.getenv("PROFILE_MAX_CONCURRENT", 1)) # requests profiled at once (profiling is costly)
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 50)) # most recent profiles kept on disk
+PROFILE_SIGNATURE_TTL = int(os.getenv("PROFILE_SIGNATURE_TTL", 300)) # seconds a signed header stays valid
+
+# --- Archival of idle chat sessions ---
+# Sessions without messages for this many days are moved to compressed archives (0: never);
+# they are restored on their next access
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", 0))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", 3600)) # seconds between archival runs
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", 100)) # max sessions archived per run
@@ -0,0 +1,60 @@
+"""Id-indexed, read-only access to the FAQ documents, with content hashes for HTTP caching."""
+import json
+import hashlib
+import threading
+import typing as tp
+
+from backend.core.instrumentation import cache_lookup
+
+
+def content_hash(doc: dict) -> str:
+    """Hash of the content of a document (stable across processes and restarts)."""
+    return hashlib.sha256(json.dumps(doc, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class DocumentStore:
+    """Looks documents up by ID in O(1) instead of scanning the corpus.
+
+    Documents only change with a new ingest (a new store), so their hashes are computed once, on first use.
+    Memory-mapped documents (`index_store.MappedDocs`) are looked up in their own mapped ID index;
+    an in-memory list gets a dict of its IDs.
+    """
+    def __init__(self, docs: tp.Sequence[dict]):
+        self.docs = docs
+        self.positions: tp.Optional[tp.Dict[str, int]] = None
+        self._position_of: tp.Callable[[str], tp.Optional[int]] = getattr(docs, "position_of", None)
+        if self._position_of is None:
+            self.positions = {str(doc["id"]): position for position, doc in enumerate(docs)}
+            self._position_of = self.positions.get
+        self._hashes: tp.Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.docs) if self.positions is None else len(self.positions)
+
+    def get(self, doc_id: tp.Any) -> tp.Optional[dict]:
+        position = self._position_of(str(doc_id))
+        return None if position is None else self.docs[position]
+
+    def get_many(self, doc_ids: tp.Iterable[tp.Any]) -> tp.List[dict]:
+        """The documents with the given IDs, in the order of the IDs; unknown IDs are skipped."""
+        docs = (self.get(doc_id) for doc_id in doc_ids)
+        return [doc for doc in docs if doc is not None]
+
+    def hash_of(self, doc: dict) -> str:
+        doc_id = str(doc["id"])
+        with self._lock:
+            cached = self._hashes.get(doc_id)
+        cache_lookup("document_hash", cached is not None)
+        if cached is None:
+            cached = content_hash(doc)
+            with self._lock:
+                self._hashes[doc_id] = cached
+        return cached
+
+    def etag(self, docs: tp.Sequence[dict]) -> str:
+        """Strong ETag of a list of documents: changes iff a document, or the list, changes."""
+        digest = hashlib.sha256()
+        for doc in docs:
+            digest.update(self.hash_of(doc).encode())
+        return f'"{digest.hexdigest()[:32]}"'
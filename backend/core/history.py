@@ -0,0 +1,137 @@
+import threading
+import typing as tp
+from sqlalchemy.orm import Session
+
+from backend.core.config import (
+    CHAT_MODEL,
+    HISTORY_KEEP_TURNS,
+    HISTORY_TOKEN_BUDGET,
+    HISTORY_SUMMARY_MAX_TOKENS,
+    HISTORY_SUMMARY_BATCH,
+)
+from backend.core.resilience import guarded
+from backend.db import crud, database, write_behind
+
+import logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Cohere chat_history roles for our message roles
+ROLE_MAP = {"user": "USER", "assistant": "CHATBOT"}
+
+SUMMARY_SYSTEM_PROMPT = """
+You maintain a running summary of a conversation between a user and 'Chatbot Germano', an e-commerce support assistant.
+You receive the current summary (possibly empty) and the next part of the conversation.
+
+**Instructions:**
+* Return the updated summary only, without any introductory text.
+* Keep the facts the user shared (orders, products, preferences, problems) and the answers already given.
+* Drop greetings, filler and anything that does not help to answer follow-up questions.
+* Be concise: a few short sentences or bullet points.
+"""
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token), good enough to enforce a prompt budget."""
+    return len(text) // 4 + 1
+
+
+class HistoryManager:
+    """Builds the bounded chat history sent to the LLM for a chat session.
+
+    The last `keep_turns` turns are sent verbatim, older turns are folded into a running
+    summary stored in the `conversation_summaries` table. Folding runs off the request path
+    (see `compact`), and every message is folded exactly once, so the prompt size, and thus the
+    latency of a turn, does not depend on the length of the conversation.
+    While the summary is behind (compaction lagging or failing, or running in another worker), the
+    messages it misses are sent verbatim too, within the token budget; the ones that do not fit are logged.
+    """
+    def __init__(self, llm, keep_turns: int = HISTORY_KEEP_TURNS, token_budget: int = HISTORY_TOKEN_BUDGET):
+        self.llm = llm
+        self.keep_messages = 2 * keep_turns # A turn is a user message and an assistant message
+        self.token_budget = token_budget
+        self._compacting: tp.Set[str] = set() # Session IDs currently being compacted
+        self._lock = threading.Lock()
+
+    def build_history(self, db: Session, session_id: str) -> tp.List[dict]:
+        """
+        Returns the Cohere `chat_history` for the next turn of a session: the running summary
+        (as a SYSTEM message) followed by the messages it does not cover, newest first, within the token budget.
+        """
+        db_summary = crud.get_conversation_summary(db, session_id=session_id)
+        after_id = db_summary.last_msg_id if db_summary else 0
+        # Messages not folded yet: the verbatim window, plus up to a summary batch while the summary is behind
+        limit = self.keep_messages + HISTORY_SUMMARY_BATCH
+        messages = crud.get_recent_messages(db, session_id=session_id, limit=limit + 1, after_id=after_id)
+        # Turns still waiting in the write-behind queue are the newest ones (read-your-writes)
+        newest_id = messages[-1].id if messages else after_id
+        pending = [message for message in write_behind.queue.pending_messages(session_id) if message.id > newest_id]
+        messages = list(messages) + pending
+        older_left_out = len(messages) > limit # Even older messages are not in the summary either
+        messages = messages[-limit:]
+
+        budget = self.token_budget
+        history = []
+        if db_summary:
+            summary_message = f"Summary of the earlier conversation:\n{db_summary.summary}"
+            budget -= estimate_tokens(summary_message)
+            history.append({"role": "SYSTEM", "message": summary_message})
+
+        # Walk from the newest message back and stop when the budget is exhausted
+        recent = []
+        for message in reversed(messages):
+            budget -= estimate_tokens(message.content)
+            if budget < 0:
+                break
+            recent.append({"role": ROLE_MAP.get(message.role, "USER"), "message": message.content})
+        history.extend(reversed(recent))
+        left_out = len(messages) - len(recent)
+        if left_out or older_left_out:
+            logger.warning(
+                f"Left {left_out}{'+' if older_left_out else ''} messages of session {session_id} out of its chat history: "
+                f"they are not in its summary yet and do not fit in the {self.token_budget} token budget."
+            )
+        return history
+
+    def compact(self, session_id: str) -> None:
+        """
+        Folds the messages older than the verbatim window into the running summary of the session.
+        Meant to run as a background task after a turn; it opens its own DB session.
+        """
+        with self._lock:
+            if session_id in self._compacting:
+                return
+            self._compacting.add(session_id)
+
+        db = database.SessionLocal()
+        try:
+            while True:
+                db_summary = crud.get_conversation_summary(db, session_id=session_id)
+                after_id = db_summary.last_msg_id if db_summary else 0
+                to_fold = crud.get_messages_to_fold(
+                    db, session_id=session_id, after_id=after_id,
+                    keep=self.keep_messages, limit=HISTORY_SUMMARY_BATCH,
+                )
+                if not to_fold:
+                    break
+                summary = self.summarize(db_summary.summary if db_summary else "", to_fold)
+                crud.upsert_conversation_summary(db, session_id=session_id, summary=summary, last_msg_id=to_fold[-1].id)
+                logger.info(f"Folded {len(to_fold)} messages of session {session_id} into its summary.")
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error compacting the history of session {session_id}: {e}", exc_info=True)
+        finally:
+            db.close()
+            with self._lock:
+                self._compacting.discard(session_id)
+
+    def summarize(self, summary: str, messages: tp.List[database.Message]) -> str:
+        """Asks the LLM to merge `messages` into the existing `summary`."""
+        transcript = "\n".join(f"{message.role}: {message.content}" for message in messages)
+        response = guarded(
+            "chat", self.llm.chat,
+            preamble=SUMMARY_SYSTEM_PROMPT,
+            message=f"Current summary:\n{summary or '(empty)'}\n\nConversation:\n{transcript}",
+            model=CHAT_MODEL,
+            max_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+        )
+        return response.text.strip()
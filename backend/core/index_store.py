@@ -0,0 +1,202 @@
+"""Prebuilt retrieval index, shared read-only by every worker process of a host.
+
+`python -m backend.core.index_store build --out ./index` embeds the FAQ corpus once and writes:
+- `embeddings.npy`: float32 matrix (documents x dimensions) of the document embeddings
+- `docs.bin` + `offsets.npy`: the documents as concatenated JSON records and their byte offsets
+- `doc_ids.npy` + `doc_positions.npy`: the document IDs, sorted, and the position of each, to look
+  documents up by ID with a binary search of the mapped arrays instead of a dict per worker
+- `manifest.json`: document count, dimensions, models and a checksum of the corpus
+Each build goes to a new directory `<out>.<build time>`; `<out>` is a symlink to the current one,
+swapped atomically, so a worker starting meanwhile loads either the old or the new index, never a mix.
+
+With `INDEX_DIR` set, workers memory-map these files instead of embedding the corpus and building
+an hnswlib graph each. Mapped pages live in the OS page cache, shared by all the workers, so the
+memory of a worker does not grow with the corpus. Search is exact (one matrix-vector product over
+the mapped embeddings), since an hnswlib graph can only be loaded as a private copy.
+"""
+import os
+import re
+import sys
+import json
+import mmap
+import shutil
+import contextlib
+import hashlib
+import argparse
+import datetime
+import typing as tp
+from collections.abc import Sequence
+
+import numpy as np
+
+import logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILE = "embeddings.npy"
+DOCS_FILE = "docs.bin"
+OFFSETS_FILE = "offsets.npy"
+IDS_FILE = "doc_ids.npy"
+ID_POSITIONS_FILE = "doc_positions.npy"
+MANIFEST_FILE = "manifest.json"
+VERSION_FORMAT = "%Y%m%dT%H%M%S%fZ" # suffix of the build directories
+
+
+def id_arrays(docs: tp.Sequence[dict]) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """The IDs of the documents (as strings), sorted, and the position of each document."""
+    ids = np.asarray([str(doc["id"]) for doc in docs], dtype=str)
+    positions = np.argsort(ids, kind="stable").astype(np.int64) # Duplicate IDs: in document order
+    return ids[positions], positions
+
+
+class MappedDocs(Sequence):
+    """Read-only list of documents decoded on access from a memory-mapped `docs.bin`."""
+    def __init__(self, docs_path: str, offsets_path: str, ids_path: tp.Optional[str] = None, id_positions_path: tp.Optional[str] = None):
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        with open(docs_path, "rb") as f:
+            # An empty file cannot be mapped
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        if ids_path and os.path.exists(ids_path):
+            self.ids = np.load(ids_path, mmap_mode="r")
+            self.id_positions = np.load(id_positions_path, mmap_mode="r")
+        else: # Index built before the ID files: decode the IDs once, in this worker
+            logger.warning(f"No {IDS_FILE} next to {docs_path}: rebuild the index to share the ID lookup between workers.")
+            self.ids, self.id_positions = id_arrays(self)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Document index {i} out of range")
+        return json.loads(self._data[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def position_of(self, doc_id: str) -> tp.Optional[int]:
+        """Position of the document with this ID (the last one, if several have it), or None."""
+        i = int(np.searchsorted(self.ids, doc_id, side="right")) - 1
+        if i < 0 or self.ids[i] != doc_id:
+            return None
+        return int(self.id_positions[i])
+
+
+class ExactIndex:
+    """Exact inner-product search over (memory-mapped) embeddings, with the `knn_query` interface of hnswlib."""
+    def __init__(self, embeddings: np.ndarray):
+        self.embeddings = embeddings
+
+    def get_current_count(self) -> int:
+        return len(self.embeddings)
+
+    def knn_query(self, queries, k: int = 1) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """(labels, distances) of the `k` nearest documents of each query, nearest first. Distance = 1 - inner product."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        scores = queries @ self.embeddings.T
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        labels = np.take_along_axis(top, order, axis=1)
+        return labels, 1 - np.take_along_axis(top_scores, order, axis=1)
+
+
+class IndexStore:
+    """The files of a built index, memory-mapped read-only."""
+    def __init__(self, index_dir: str):
+        # Every file from the same build, even if the `index_dir` symlink is swapped meanwhile
+        index_dir = os.path.realpath(index_dir)
+        with open(os.path.join(index_dir, MANIFEST_FILE), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.embeddings = np.load(os.path.join(index_dir, EMBEDDINGS_FILE), mmap_mode="r")
+        self.docs = MappedDocs(
+            os.path.join(index_dir, DOCS_FILE), os.path.join(index_dir, OFFSETS_FILE),
+            os.path.join(index_dir, IDS_FILE), os.path.join(index_dir, ID_POSITIONS_FILE),
+        )
+        self.index = ExactIndex(self.embeddings)
+        if len(self.docs) != len(self.embeddings):
+            raise ValueError(f"Corrupt index in {index_dir}: {len(self.docs)} documents, {len(self.embeddings)} embeddings")
+
+
+def corpus_checksum(docs: tp.Sequence[dict]) -> str:
+    """Checksum of the documents, to tell whether an index is stale."""
+    digest = hashlib.sha256()
+    for doc in docs:
+        digest.update(json.dumps(doc, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def build(docs: tp.List[dict], embeddings: tp.Sequence[tp.Sequence[float]], out_dir: str, **manifest) -> None:
+    """
+    Writes an index to a new build directory and atomically points the `out_dir` symlink to it.
+    Workers keep their mapping of the old files. The previous build is kept (a worker may be loading
+    it), older ones are removed.
+    """
+    out_dir = out_dir.rstrip(os.sep)
+    built_at = datetime.datetime.now(datetime.timezone.utc)
+    version_dir = f"{out_dir}.{built_at.strftime(VERSION_FORMAT)}"
+    os.makedirs(version_dir)
+
+    matrix = np.asarray(embeddings, dtype=np.float32).reshape(len(docs), -1)
+    np.save(os.path.join(version_dir, EMBEDDINGS_FILE), matrix)
+    offsets = [0]
+    with open(os.path.join(version_dir, DOCS_FILE), "wb") as f:
+        for doc in docs:
+            record = json.dumps(doc, default=str, separators=(",", ":")).encode()
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+    np.save(os.path.join(version_dir, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    ids, positions = id_arrays(docs)
+    np.save(os.path.join(version_dir, IDS_FILE), ids)
+    np.save(os.path.join(version_dir, ID_POSITIONS_FILE), positions)
+    with open(os.path.join(version_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "documents": len(docs),
+            "dimensions": int(matrix.shape[1]) if len(docs) else 0,
+            "corpus_sha256": corpus_checksum(docs),
+            "built_at": built_at.isoformat(),
+            **manifest,
+        }, f, indent=2)
+
+    previous_dir = os.path.realpath(out_dir) if os.path.islink(out_dir) else None
+    if os.path.isdir(out_dir) and not os.path.islink(out_dir):
+        # Index built before the symlinks: move it aside (the only non-atomic swap)
+        shutil.rmtree(f"{out_dir}.old", ignore_errors=True)
+        os.rename(out_dir, f"{out_dir}.old")
+    link = f"{out_dir}.link"
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(link)
+    os.symlink(os.path.basename(version_dir), link) # Relative: the builds sit next to the link
+    os.replace(link, out_dir)
+    _remove_old_builds(out_dir, keep={os.path.realpath(version_dir), previous_dir})
+    logger.info(f"Built an index of {len(docs)} documents in {version_dir} ({out_dir}).")
+
+def _remove_old_builds(out_dir: str, keep: tp.Set[tp.Optional[str]]) -> None:
+    parent, name = os.path.split(os.path.abspath(out_dir))
+    pattern = re.compile(re.escape(name) + r"\.(\d{8}T\d{12}Z|old)")
+    for entry in os.listdir(parent):
+        path = os.path.join(parent, entry)
+        if pattern.fullmatch(entry) and os.path.realpath(path) not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def main(argv: tp.Optional[tp.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Build the shared retrieval index of the FAQ corpus.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Embed the FAQ corpus and write the index files")
+    build_parser.add_argument("--out", default=os.getenv("INDEX_DIR") or "./index", help="Index directory")
+    args = parser.parse_args(argv)
+
+    from backend.db.mysql_v1 import MYSQL
+    from backend.core.vectorstore import embed_documents, EMBED_MODEL, RERANK_MODEL
+
+    MYSQL.init_db_if_changed("ecommerce_faq")
+    docs = MYSQL.load_faq_data()
+    build(docs, embed_documents(docs), args.out, embed_model=EMBED_MODEL, rerank_model=RERANK_MODEL)
+    print(f"Index of {len(docs)} documents written to {args.out}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
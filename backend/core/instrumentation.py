@@ -0,0 +1,62 @@
+"""Metrics of the API process: HTTP requests, SQL statements, provider calls and caches.
+
+They are recorded where the work happens (middleware in `main.py`, SQLAlchemy event listeners,
+`resilience.py`, ...) and exposed with the other metrics of `REGISTRY` on `GET /metrics`.
+"""
+import time
+
+from sqlalchemy import event
+
+from backend.core.metrics import Counter, Histogram
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Latency of the HTTP requests (until the response starts)",
+    labelnames=("method", "route", "status"),
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Duration of the SQL statements", labelnames=("engine", "statement"),
+)
+DB_ERRORS = Counter("db_errors_total", "SQL statements that failed", labelnames=("engine",))
+PROVIDER_CALL_SECONDS = Histogram(
+    "provider_call_duration_seconds", "Latency of the LLM / embedding provider calls, hedging included",
+    labelnames=("op", "outcome"),
+)
+PROVIDER_ERRORS = Counter(
+    "provider_errors_total", "Failed provider calls (error, timeout or open circuit)", labelnames=("op", "kind"),
+)
+PROVIDER_HEDGES = Counter("provider_hedged_requests_total", "Duplicate requests sent for slow provider calls", labelnames=("op",))
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Cache lookups by result (hit or miss)", labelnames=("cache", "result"),
+)
+
+# Statement label values; anything else is "OTHER" (keeps the number of series bounded)
+STATEMENT_KINDS = {"SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "BEGIN", "COMMIT", "ROLLBACK", "PRAGMA"}
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+def statement_kind(statement: str) -> str:
+    words = statement.lstrip().split(None, 1)
+    kind = words[0].upper() if words else ""
+    return kind if kind in STATEMENT_KINDS else "OTHER"
+
+def instrument_engine(engine, name: str) -> None:
+    """Times every SQL statement of `engine` (a sync `Engine`, or the `sync_engine` of an async one)."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("query_start")
+        if starts:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - starts.pop(), engine=name, statement=statement_kind(statement))
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(context):
+        if context.connection is not None:
+            starts = context.connection.info.get("query_start")
+            if starts:
+                starts.pop()
+        DB_ERRORS.inc(engine=name)
@@ -0,0 +1,329 @@
+"""LLM / embedding provider clients.
+
+`get_client()` returns the client used by `Vectorstore` and `Chatbot`, selected with `LLM_PROVIDER`:
+- "cohere": the real Cohere API.
+- "synthetic": a local, deterministic stand-in for `embed`, `rerank`, `chat` and `chat_stream`, with
+  configurable latency distributions (`SYNTHETIC_LATENCY`) and streaming token rate (`SYNTHETIC_TOKENS_PER_SEC`).
+- "record": the real Cohere API, with every response appended to the cassette at `LLM_CASSETTE_PATH`.
+- "replay": answers from the cassette only (optionally with the recorded latencies, `LLM_REPLAY_LATENCY=1`).
+
+The stand-ins return objects exposing the same attributes the engine reads from the cohere SDK responses,
+so the rest of the code does not know which provider it talks to.
+"""
+import os
+import re
+import json
+import math
+import time
+import random
+import hashlib
+import threading
+import typing as tp
+import numpy as np
+import cohere
+
+from backend.core.config import (
+    COHERE_API_KEY,
+    LLM_PROVIDER,
+    LLM_CASSETTE_PATH,
+    LLM_REPLAY_LATENCY,
+    SYNTHETIC_LATENCY,
+    SYNTHETIC_TOKENS_PER_SEC,
+    SYNTHETIC_SEED,
+)
+
+import logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+EMBED_DIM = 1024 # Same dimension as embed-english-v3.0
+
+
+class _Obj(dict):
+    """A dict with attribute access, mimicking the (pydantic) response objects of the cohere SDK."""
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.get(name) # Missing fields are None, like optional SDK fields
+
+    def dict(self) -> dict:
+        return _to_plain(self)
+
+
+def _wrap(value):
+    """Recursively converts plain JSON values into `_Obj` responses."""
+    if isinstance(value, dict):
+        return _Obj({key: _wrap(val) for key, val in value.items()})
+    if isinstance(value, list):
+        return [_wrap(val) for val in value]
+    return value
+
+def _to_plain(value):
+    """Recursively converts SDK objects into plain JSON values."""
+    # Dicts first: `_Obj` answers any attribute, including `model_dump`
+    if isinstance(value, dict):
+        return {key: _to_plain(val) for key, val in value.items()}
+    if hasattr(value, "model_dump"):
+        return _to_plain(value.model_dump(mode="json"))
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(val) for val in value]
+    return value
+
+def _tokens(text: str) -> tp.List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+# --- Synthetic stand-in ---
+
+class LatencyModel:
+    """Samples per-operation latencies (in seconds) from the distributions described by `spec`.
+
+    `spec` looks like "embed=lognormal:60:0.3;chat=uniform:200:600" (values in ms). Supported distributions:
+    fixed:<ms>, uniform:<lo>:<hi>, normal:<mean>:<std>, lognormal:<median>:<sigma>.
+    Operations without a distribution have no latency.
+    """
+    def __init__(self, spec: str, seed: int = 0):
+        self.dists: tp.Dict[str, tp.Tuple[str, tp.List[float]]] = {}
+        for item in filter(None, (part.strip() for part in spec.split(";"))):
+            op, dist = item.split("=", 1)
+            name, *params = dist.split(":")
+            if name not in ("fixed", "uniform", "normal", "lognormal"):
+                raise ValueError(f"Unknown latency distribution '{name}' for '{op}'")
+            self.dists[op.strip()] = (name, [float(p) for p in params])
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self, op: str) -> float:
+        if op not in self.dists:
+            return 0.0
+        name, params = self.dists[op]
+        with self._lock:
+            if name == "fixed":
+                ms = params[0]
+            elif name == "uniform":
+                ms = self.rng.uniform(params[0], params[1])
+            elif name == "normal":
+                ms = self.rng.gauss(params[0], params[1])
+            else: # lognormal, parametrized by its median
+                ms = params[0] * math.exp(params[1] * self.rng.gauss(0.0, 1.0))
+        return max(ms, 0.0) / 1000
+
+
+class SyntheticClient:
+    """Deterministic local stand-in for the Cohere operations used by the engine.
+
+    - embed: bag-of-words hashed into EMBED_DIM dims, so texts sharing words are close in the index.
+    - rerank: word overlap between the query and the rank fields.
+    - chat (search_queries_only): the user message is the search query.
+    - chat / chat_stream: an answer quoting the first document, cited, streamed at `tokens_per_sec`.
+    """
+    def __init__(self, latency: tp.Optional[LatencyModel] = None, tokens_per_sec: float = SYNTHETIC_TOKENS_PER_SEC):
+        self.latency = latency or LatencyModel(SYNTHETIC_LATENCY, seed=SYNTHETIC_SEED)
+        self.tokens_per_sec = tokens_per_sec
+
+    def _wait(self, op: str) -> None:
+        delay = self.latency.sample(op)
+        if delay:
+            time.sleep(delay)
+
+    @staticmethod
+    def _embed_text(text: str) -> tp.List[float]:
+        vec = np.zeros(EMBED_DIM, dtype=np.float32)
+        for token in _tokens(text):
+            digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+            vec[int.from_bytes(digest, "little") % EMBED_DIM] += 1.0
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            vec[0], norm = 1.0, 1.0
+        return (vec / norm).tolist()
+
+    def embed(self, texts: tp.List[str], **kwargs) -> _Obj:
+        self._wait("embed")
+        return _wrap({
+            "embeddings": [self._embed_text(text) for text in texts],
+            "meta": {"billed_units": {"input_tokens": sum(len(_tokens(text)) for text in texts)}},
+        })
+
+    def rerank(self, query: str, documents: list, top_n: tp.Optional[int] = None,
+               rank_fields: tp.Optional[tp.List[str]] = None, **kwargs) -> _Obj:
+        self._wait("rerank")
+        query_tokens = set(_tokens(query))
+        scores = []
+        for index, doc in enumerate(documents):
+            if isinstance(doc, dict):
+                doc = " ".join(str(doc.get(field, "")) for field in (rank_fields or doc.keys()))
+            doc_tokens = set(_tokens(str(doc)))
+            overlap = len(query_tokens & doc_tokens) / (len(query_tokens | doc_tokens) or 1)
+            scores.append((overlap, -index))
+        ranked = sorted(scores, reverse=True)[:top_n or len(documents)]
+        return _wrap({"results": [{"index": -neg_index, "relevance_score": score} for score, neg_index in ranked]})
+
+    def _answer(self, message: str, documents: tp.Optional[list]) -> tp.Tuple[str, list, list]:
+        """Returns the answer text, its citations and the cited documents."""
+        if not documents:
+            return ("Chatbot Germano here. This answer is not grounded in the provided documents: "
+                    f"I could not find anything about '{message[:80]}'."), [], []
+        doc = documents[0]
+        prefix = "According to our FAQ: "
+        cited = str(doc.get("text", "")).replace("\n", " ")
+        text = prefix + cited
+        citation = {"start": len(prefix), "end": len(text), "text": cited,
+                    "document_ids": [str(doc.get("id", "0"))], "type": "TEXT_CONTENT"}
+        return text, [citation], [doc]
+
+    def chat(self, message: str, search_queries_only: bool = False, max_tokens: tp.Optional[int] = None,
+             chat_history: tp.Optional[list] = None, documents: tp.Optional[list] = None, **kwargs) -> _Obj:
+        self._wait("chat")
+        if search_queries_only:
+            return _wrap({"text": "", "search_queries": [{"text": message}] if message.strip() else []})
+        text, citations, cited_docs = self._answer(message, documents)
+        if max_tokens:
+            text = " ".join(text.split(" ")[:max_tokens])
+            citations = [c for c in citations if c["end"] <= len(text)]
+        return _wrap(self._final_response(message, text, citations, cited_docs, chat_history))
+
+    def chat_stream(self, message: str, chat_history: tp.Optional[list] = None,
+                    documents: tp.Optional[list] = None, **kwargs) -> tp.Iterator[_Obj]:
+        self._wait("chat_stream") # Time to first token
+        text, citations, cited_docs = self._answer(message, documents)
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            if i and self.tokens_per_sec > 0:
+                time.sleep(1 / self.tokens_per_sec)
+            yield _wrap({"event_type": "text-generation", "text": word if i == 0 else " " + word})
+        yield _wrap({
+            "event_type": "stream-end",
+            "finish_reason": "COMPLETE",
+            "response": self._final_response(message, text, citations, cited_docs, chat_history),
+        })
+
+    @staticmethod
+    def _final_response(message, text, citations, documents, chat_history) -> dict:
+        return {
+            "text": text,
+            "citations": citations or None,
+            "documents": documents or None,
+            "chat_history": list(_to_plain(chat_history or [])) + [
+                {"role": "USER", "message": message},
+                {"role": "CHATBOT", "message": text},
+            ],
+            "meta": {"billed_units": {"input_tokens": len(_tokens(message)), "output_tokens": len(_tokens(text))}},
+        }
+
+
+# --- Record / replay ---
+
+def _cassette_key(op: str, kwargs: dict) -> str:
+    payload = json.dumps({"op": op, **_to_plain(kwargs)}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class RecordingClient:
+    """Forwards calls to `client` and appends every response (with its latency) to a JSONL cassette."""
+    def __init__(self, client, cassette_path: str = LLM_CASSETTE_PATH):
+        self.client = client
+        self.cassette_path = cassette_path
+        os.makedirs(os.path.dirname(os.path.abspath(cassette_path)), exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _record(self, op: str, kwargs: dict, entry: dict) -> None:
+        line = json.dumps({"key": _cassette_key(op, kwargs), "op": op, **entry})
+        with self._lock, open(self.cassette_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def _call(self, op: str, **kwargs):
+        start = time.perf_counter()
+        response = getattr(self.client, op)(**kwargs)
+        self._record(op, kwargs, {"latency": time.perf_counter() - start, "response": _to_plain(response)})
+        return response
+
+    def embed(self, **kwargs):
+        return self._call("embed", **kwargs)
+
+    def rerank(self, **kwargs):
+        return self._call("rerank", **kwargs)
+
+    def chat(self, **kwargs):
+        return self._call("chat", **kwargs)
+
+    def chat_stream(self, **kwargs):
+        start = time.perf_counter()
+        events = []
+        for event in self.client.chat_stream(**kwargs):
+            events.append({"t": time.perf_counter() - start, "event": _to_plain(event)})
+            yield event
+        self._record("chat_stream", kwargs, {"events": events})
+
+
+class ReplayClient:
+    """Answers from a cassette written by `RecordingClient`; unknown requests raise a LookupError.
+
+    Identical requests recorded several times are replayed in round-robin order.
+    """
+    def __init__(self, cassette_path: str = LLM_CASSETTE_PATH, replay_latency: bool = LLM_REPLAY_LATENCY):
+        self.replay_latency = replay_latency
+        self.entries: tp.Dict[str, tp.List[dict]] = {}
+        with open(cassette_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries.setdefault(entry["key"], []).append(entry)
+        self._cursor: tp.Dict[str, int] = {}
+        self._lock = threading.Lock()
+        logger.info(f"Loaded {sum(map(len, self.entries.values()))} recorded responses from {cassette_path}")
+
+    def _next(self, op: str, kwargs: dict) -> dict:
+        key = _cassette_key(op, kwargs)
+        if key not in self.entries:
+            raise LookupError(f"No recorded '{op}' response for this request in the cassette")
+        with self._lock:
+            i = self._cursor.get(key, 0)
+            self._cursor[key] = i + 1
+        entries = self.entries[key]
+        return entries[i % len(entries)]
+
+    def _call(self, op: str, **kwargs):
+        entry = self._next(op, kwargs)
+        if self.replay_latency:
+            time.sleep(entry["latency"])
+        return _wrap(entry["response"])
+
+    def embed(self, **kwargs):
+        return self._call("embed", **kwargs)
+
+    def rerank(self, **kwargs):
+        return self._call("rerank", **kwargs)
+
+    def chat(self, **kwargs):
+        return self._call("chat", **kwargs)
+
+    def chat_stream(self, **kwargs):
+        entry = self._next("chat_stream", kwargs)
+        start = time.perf_counter()
+        for recorded in entry["events"]:
+            if self.replay_latency:
+                time.sleep(max(recorded["t"] - (time.perf_counter() - start), 0.0))
+            yield _wrap(recorded["event"])
+
+
+# --- Client selection ---
+
+_clients: tp.Dict[str, tp.Any] = {}
+_clients_lock = threading.Lock()
+
+def get_client(provider: str = LLM_PROVIDER):
+    """Returns the (shared) client for `provider`: "cohere", "synthetic", "record" or "replay"."""
+    with _clients_lock:
+        if provider not in _clients:
+            if provider == "cohere":
+                _clients[provider] = cohere.Client(COHERE_API_KEY)
+            elif provider == "synthetic":
+                _clients[provider] = SyntheticClient()
+            elif provider == "record":
+                _clients[provider] = RecordingClient(cohere.Client(COHERE_API_KEY))
+            elif provider == "replay":
+                _clients[provider] = ReplayClient()
+            else:
+                raise ValueError(f"Unknown LLM provider: {provider}. Use 'cohere', 'synthetic', 'record' or 'replay'.")
+            logger.info(f"Using LLM provider '{provider}'")
+        return _clients[provider]
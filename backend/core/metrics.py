@@ -0,0 +1,219 @@
+"""In-process metrics (no external service needed).
+
+Every metric registers itself in `REGISTRY`; `render_prometheus()` returns all of them in the
+Prometheus text exposition format (served by `GET /metrics`).
+"""
+import math
+import bisect
+import threading
+import typing as tp
+
+# Default latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384)
+
+LabelValues = tp.Tuple[str, ...]
+
+
+def _json_bound(value: tp.Optional[float]):
+    """Infinity is not valid JSON."""
+    return "+Inf" if value == float("inf") else value
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: tp.Sequence[tp.Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels) + "}"
+
+
+class Registry:
+    """The metrics of the process, in registration order."""
+    def __init__(self):
+        self.metrics: tp.List[tp.Any] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric) -> None:
+        with self._lock:
+            if any(existing.name == metric.name for existing in self.metrics):
+                raise ValueError(f"Duplicate metric name: {metric.name}")
+            self.metrics.append(metric)
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            help_text = metric.documentation.replace("\\", "\\\\").replace("\n", "\\n")
+            lines.append(f"# HELP {metric.name} {help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def render_prometheus() -> str:
+    return REGISTRY.render()
+
+
+class Counter:
+    """Thread-safe monotonic counter with optional labels, e.g. `c.inc(op="embed")`."""
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tp.Sequence[str] = (), registry: tp.Optional[Registry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: tp.Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        return [("", list(zip(self.labelnames, key)), value) for key, value in items]
+
+
+class Gauge:
+    """Current value(s) of something, set explicitly or read from `function` at exposition time.
+
+    `function` returns a number, or a dict of label values (tuples, in `labelnames` order) to numbers.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tp.Sequence[str] = (),
+                 function: tp.Optional[tp.Callable[[], tp.Any]] = None, registry: tp.Optional[Registry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values: tp.Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def set(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                values = self.function()
+            except Exception: # A broken callback must not break the whole exposition
+                return []
+            if values is None:
+                return []
+            if not isinstance(values, dict):
+                values = {(): values}
+            items = [(tuple(str(v) for v in key), value) for key, value in values.items()]
+        else:
+            with self._lock:
+                items = list(self.values.items())
+        return [("", list(zip(self.labelnames, key)), value) for key, value in items]
+
+
+class _HistogramSeries:
+    """Bucket counts, count and sum of one label combination of a histogram."""
+    def __init__(self, n_buckets: int):
+        self.bucket_counts = [0] * (n_buckets + 1) # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram:
+    """Thread-safe histogram with fixed buckets and optional labels.
+
+    Usage: `h = Histogram("name", "help", labelnames=("stage",))` then `h.observe(0.12, stage="rerank")`.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tp.Sequence[float] = LATENCY_BUCKETS,
+                 labelnames: tp.Sequence[str] = (), registry: tp.Optional[Registry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self.series: tp.Dict[LabelValues, _HistogramSeries] = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = _HistogramSeries(len(self.buckets))
+            series.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            series.count += 1
+            series.sum += value
+
+    def quantile(self, q: float, series: _HistogramSeries) -> tp.Optional[float]:
+        """Estimates the `q` quantile of a series (upper bound of the bucket it falls in)."""
+        if series.count == 0:
+            return None
+        rank = q * series.count
+        cumulative = 0
+        for upper, count in zip(self.buckets + (float("inf"),), series.bucket_counts):
+            cumulative += count
+            if cumulative >= rank:
+                return upper
+        return float("inf")
+
+    def snapshot(self) -> tp.List[dict]:
+        """JSON-friendly view of every series: labels, count, sum, p50/p95/p99 and cumulative buckets."""
+        with self._lock:
+            items = [(key, series.count, series.sum, list(series.bucket_counts)) for key, series in self.series.items()]
+        result = []
+        for key, count, total, bucket_counts in items:
+            series = _HistogramSeries(len(self.buckets))
+            series.count, series.sum, series.bucket_counts = count, total, bucket_counts
+            cumulative, buckets = 0, {}
+            for upper, n in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += n
+                buckets["+Inf" if upper == float("inf") else str(upper)] = cumulative
+            result.append({
+                "labels": dict(zip(self.labelnames, key)),
+                "count": count,
+                "sum": total,
+                "p50": _json_bound(self.quantile(0.50, series)),
+                "p95": _json_bound(self.quantile(0.95, series)),
+                "p99": _json_bound(self.quantile(0.99, series)),
+                "buckets": buckets,
+            })
+        return result
+
+    def samples(self):
+        """Cumulative `_bucket` samples (with an `le` label), `_sum` and `_count` of every series."""
+        with self._lock:
+            items = [(key, series.sum, series.count, list(series.bucket_counts)) for key, series in self.series.items()]
+        samples = []
+        for key, total, count, bucket_counts in items:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for upper, n in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += n
+                samples.append(("_bucket", labels + [("le", _format_value(upper))], cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
@@ -0,0 +1,153 @@
+"""Opt-in profiling of single requests (cProfile), to see where the time of a slow request goes on real traffic.
+
+- A request is profiled when it carries a valid signed `X-Profile` header:
+  `<unix time>:<hex HMAC-SHA256 of "<unix time>:<METHOD>:<path>" keyed with PROFILE_SECRET>`.
+  Get one with `python -m backend.core.profiling sign POST /sessions/<id>/messages/`.
+  Without PROFILE_SECRET, nothing is ever profiled.
+- Only the code wrapped in `profiled()` is profiled (the chat turn and the history read), in the
+  thread running it. On the event loop, that includes the other requests interleaved with it;
+  provider calls run in the provider thread pool and show up as time spent waiting on them.
+- At most PROFILE_MAX_CONCURRENT requests are profiled at once; the others run unprofiled. A thread
+  has a single profiler: a section that starts while another one is profiled in the same thread
+  (e.g. two profiled requests on the event loop) is not profiled, and the profile of the first one
+  includes it.
+- Profiles are saved in pstats format (`snakeviz`, `flameprof`, `python -m pstats`) as
+  `PROFILE_DIR/<id>.pstats`, keeping the last PROFILE_KEEP; the id is returned in `X-Profile-Id`.
+"""
+import io
+import os
+import sys
+import hmac
+import time
+import uuid
+import pstats
+import hashlib
+import cProfile
+import threading
+import contextlib
+import contextvars
+import typing as tp
+
+from backend.core.config import PROFILE_SECRET, PROFILE_DIR, PROFILE_MAX_CONCURRENT, PROFILE_KEEP, PROFILE_SIGNATURE_TTL
+
+import logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+PROFILE_STATUS_HEADER = "X-Profile-Status"
+
+
+def sign(method: str, path: str, timestamp: tp.Optional[int] = None, secret: str = PROFILE_SECRET) -> str:
+    """Value of the `X-Profile` header for a request."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    digest = hmac.new(secret.encode(), f"{timestamp}:{method.upper()}:{path}".encode(), hashlib.sha256).hexdigest()
+    return f"{timestamp}:{digest}"
+
+def verify(header: str, method: str, path: str, secret: str = PROFILE_SECRET, ttl: int = PROFILE_SIGNATURE_TTL) -> bool:
+    """Whether an `X-Profile` header is signed with `secret` for this request and not expired."""
+    if not secret:
+        return False
+    timestamp, _, _ = header.partition(":")
+    if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > ttl:
+        return False
+    return hmac.compare_digest(header, sign(method, path, int(timestamp), secret))
+
+
+class ProfileCapture:
+    """The profiles of the `profiled()` sections of one request."""
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.profiles: tp.List[cProfile.Profile] = []
+
+_current_capture: contextvars.ContextVar[tp.Optional[ProfileCapture]] = contextvars.ContextVar("current_capture", default=None)
+
+@contextlib.contextmanager
+def profiled() -> tp.Iterator[None]:
+    """Profiles the enclosed block if the current request is being profiled (no-op otherwise)."""
+    capture = _current_capture.get()
+    if capture is None:
+        yield
+        return
+    if sys.getprofile() is not None: # Another profiler is active in this thread: enabling ours would replace it
+        yield
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError: # Python 3.12+: another profiler is active in the process (sys.monitoring)
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+        capture.profiles.append(profile)
+
+
+class RequestProfiler:
+    """Hands out the profiling slots and stores the profiles."""
+    def __init__(self, directory: str = PROFILE_DIR, max_concurrent: int = PROFILE_MAX_CONCURRENT, keep: int = PROFILE_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self._slots = threading.BoundedSemaphore(max(max_concurrent, 1))
+
+    def begin(self) -> tp.Optional[ProfileCapture]:
+        """Starts profiling the current request (context), or returns None if every slot is taken."""
+        if not self._slots.acquire(blocking=False):
+            return None
+        capture = ProfileCapture()
+        _current_capture.set(capture)
+        return capture
+
+    def end(self, capture: ProfileCapture) -> tp.Optional[str]:
+        """Saves the profile of a request and frees its slot. Returns the profile id (None if nothing was profiled)."""
+        _current_capture.set(None)
+        try:
+            if not capture.profiles:
+                return None
+            stats = pstats.Stats(capture.profiles[0])
+            for profile in capture.profiles[1:]:
+                stats.add(profile)
+            os.makedirs(self.directory, exist_ok=True)
+            stats.dump_stats(self.path_of(capture.id))
+            self._prune()
+            return capture.id
+        except OSError as e:
+            logger.error(f"Could not save profile {capture.id}: {e}")
+            return None
+        finally:
+            self._slots.release()
+
+    def path_of(self, profile_id: str) -> str:
+        if len(profile_id) != 32 or any(c not in "0123456789abcdef" for c in profile_id): # No path tricks
+            raise ValueError(f"Invalid profile id: {profile_id}")
+        return os.path.join(self.directory, f"{profile_id}.pstats")
+
+    def summary(self, profile_id: str, sort: str = "cumulative", limit: int = 40) -> str:
+        """Text report of the `limit` top functions of a profile."""
+        output = io.StringIO()
+        stats = pstats.Stats(self.path_of(profile_id), stream=output)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def _prune(self) -> None:
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".pstats")]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:max(len(paths) - self.keep, 0)]:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+
+# Shared profiler of this worker process
+profiler = RequestProfiler()
+
+
+if __name__ == "__main__":
+    # python -m backend.core.profiling sign <METHOD> <path>
+    if len(sys.argv) != 4 or sys.argv[1] != "sign":
+        sys.exit("Usage: python -m backend.core.profiling sign <METHOD> <path>")
+    if not PROFILE_SECRET:
+        sys.exit("PROFILE_SECRET is not set")
+    print(f"{PROFILE_HEADER}: {sign(sys.argv[2], sys.argv[3])}")
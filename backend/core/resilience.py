@@ -0,0 +1,211 @@
+"""Deadlines, hedged requests and circuit breaking for provider (LLM / embedding) calls.
+
+Every provider call goes through `guarded(op, fn, ...)`:
+- The call runs in a worker thread and must finish within the deadline of `op` (`PROVIDER_DEADLINES`).
+- For idempotent operations (`PROVIDER_HEDGE_OPS`), a duplicate request is sent when the first one is
+  slower than the recent p95 latency of `op`; the first successful response wins.
+- Each operation has a circuit breaker that opens when its recent error rate is too high. While it is
+  open, calls fail immediately and `fallback` (the degraded path) is used instead.
+
+Timed out calls cannot be killed: they finish in the background and their result is dropped.
+"""
+import time
+import threading
+import contextvars
+import typing as tp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from backend.core.config import (
+    PROVIDER_DEADLINES,
+    PROVIDER_HEDGE_OPS,
+    HEDGE_QUANTILE,
+    HEDGE_MIN_DELAY,
+    HEDGE_MIN_SAMPLES,
+    BREAKER_WINDOW,
+    BREAKER_MIN_CALLS,
+    BREAKER_ERROR_RATE,
+    BREAKER_COOLDOWN,
+    PROVIDER_MAX_WORKERS,
+)
+from backend.core.instrumentation import PROVIDER_CALL_SECONDS, PROVIDER_ERRORS, PROVIDER_HEDGES
+
+import logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+T = tp.TypeVar("T")
+DEFAULT_DEADLINE = 30.0 # seconds, for operations missing from PROVIDER_DEADLINES
+
+
+class ProviderTimeout(TimeoutError):
+    """A provider call did not finish within its deadline."""
+
+class CircuitOpenError(RuntimeError):
+    """The circuit breaker of a provider operation is open, the call was not attempted."""
+
+
+class LatencyWindow:
+    """Rolling window of the latencies of the last `size` successful calls."""
+    def __init__(self, size: int = 200):
+        self.samples: tp.Deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self.samples.append(seconds)
+
+    def quantile(self, q: float) -> tp.Optional[float]:
+        """The `q` quantile of the window, or None until HEDGE_MIN_SAMPLES latencies were seen."""
+        with self._lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class CircuitBreaker:
+    """Error-rate circuit breaker.
+
+    - closed: calls go through; opens when at least `error_rate` of the last `window` calls failed.
+    - open: calls are rejected for `cooldown` seconds.
+    - half-open: a single trial call goes through; its outcome closes or re-opens the breaker.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, window: int = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS,
+                 error_rate: float = BREAKER_ERROR_RATE, cooldown: float = BREAKER_COOLDOWN):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.outcomes: tp.Deque[bool] = deque(maxlen=window) # True = success
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may be attempted now."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    return False
+                self._trial_in_flight = True
+                return True
+            return self.state == self.CLOSED
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_in_flight = False
+                if success:
+                    self.state = self.CLOSED
+                    self.outcomes.clear()
+                else:
+                    self._open()
+                return
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.error_rate:
+                self._open()
+
+    def _open(self) -> None:
+        if self.state != self.OPEN:
+            logger.error(f"Circuit breaker '{self.name}' opened.")
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+
+class ProviderGuard:
+    """Deadline, hedging and circuit breaker for one provider operation."""
+    def __init__(self, op: str, deadline: float, hedge: bool, executor: ThreadPoolExecutor):
+        self.op = op
+        self.deadline = deadline
+        self.hedge = hedge
+        self.executor = executor
+        self.latencies = LatencyWindow()
+        self.breaker = CircuitBreaker(op)
+
+    def hedge_delay(self) -> float:
+        """Delay after which a duplicate request is sent: the recent p95 latency (half the deadline until known)."""
+        p95 = self.latencies.quantile(HEDGE_QUANTILE)
+        if p95 is None:
+            return self.deadline / 2
+        return max(p95, HEDGE_MIN_DELAY)
+
+    def call(self, fn: tp.Callable[..., T], *args, **kwargs) -> T:
+        if not self.breaker.allow():
+            PROVIDER_ERRORS.inc(op=self.op, kind="circuit_open")
+            raise CircuitOpenError(f"Circuit breaker '{self.op}' is open")
+
+        start = time.perf_counter()
+        hedge_at = start + self.hedge_delay() if self.hedge else None
+        deadline_at = start + self.deadline
+        # Calls run in the context of the caller, so their spans land in the caller's request trace
+        pending = {self.executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)}
+        error: tp.Optional[BaseException] = None
+        try:
+            while True:
+                now = time.perf_counter()
+                if now >= deadline_at:
+                    raise ProviderTimeout(f"'{self.op}' did not finish within {self.deadline}s")
+                wake_at = min(deadline_at, hedge_at) if hedge_at else deadline_at
+                done, pending = wait(pending, timeout=max(wake_at - now, 0), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        self.latencies.add(time.perf_counter() - start)
+                        PROVIDER_CALL_SECONDS.observe(time.perf_counter() - start, op=self.op, outcome="ok")
+                        self.breaker.record(True)
+                        return future.result()
+                    error = future.exception()
+                if not pending: # Every attempt failed
+                    raise error
+                if hedge_at and time.perf_counter() >= hedge_at:
+                    logger.info(f"Hedging slow '{self.op}' call after {hedge_at - start:.3f}s")
+                    pending.add(self.executor.submit(contextvars.copy_context().run, fn, *args, **kwargs))
+                    PROVIDER_HEDGES.inc(op=self.op)
+                    hedge_at = None # A single duplicate per call
+        except BaseException as e:
+            self.breaker.record(False)
+            kind = "timeout" if isinstance(e, ProviderTimeout) else "error"
+            PROVIDER_CALL_SECONDS.observe(time.perf_counter() - start, op=self.op, outcome=kind)
+            PROVIDER_ERRORS.inc(op=self.op, kind=kind)
+            raise
+
+
+def _parse_deadlines(spec: str) -> tp.Dict[str, float]:
+    deadlines = {}
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        op, seconds = item.split("=", 1)
+        deadlines[op.strip()] = float(seconds)
+    return deadlines
+
+_deadlines = _parse_deadlines(PROVIDER_DEADLINES)
+_hedge_ops = {op.strip() for op in PROVIDER_HEDGE_OPS if op.strip()}
+_executor = ThreadPoolExecutor(max_workers=PROVIDER_MAX_WORKERS, thread_name_prefix="provider")
+_guards: tp.Dict[str, ProviderGuard] = {}
+_guards_lock = threading.Lock()
+
+def get_guard(op: str) -> ProviderGuard:
+    """Returns the (shared) guard of a provider operation, e.g. "embed", "rerank", "chat", "chat_stream"."""
+    with _guards_lock:
+        if op not in _guards:
+            _guards[op] = ProviderGuard(op, _deadlines.get(op, DEFAULT_DEADLINE), op in _hedge_ops, _executor)
+        return _guards[op]
+
+def guarded(op: str, fn: tp.Callable[..., T], *args, fallback: tp.Optional[tp.Callable[[], T]] = None, **kwargs) -> T:
+    """
+    Calls `fn(*args, **kwargs)` with the deadline, hedging and circuit breaker of `op`.
+    If the call fails (error, timeout or open circuit) and a `fallback` is given, returns `fallback()` instead.
+    """
+    try:
+        return get_guard(op).call(fn, *args, **kwargs)
+    except Exception as e:
+        if fallback is None:
+            raise
+        logger.error(f"'{op}' failed ({type(e).__name__}: {e}), using the degraded path.")
+        return fallback()
@@ -0,0 +1,62 @@
+import threading
+import typing as tp
+
+T = tp.TypeVar("T")
+
+
+class _Call:
+    """An in-flight computation that other callers can wait on."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: tp.Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single execution.
+
+    The first caller for a key runs `fn`; callers arriving while it is still running wait for it
+    and get the same result (or exception). Nothing is cached: once the call finishes the key is
+    released, and the next caller runs `fn` again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: tp.Dict[str, _Call] = {}
+
+    def do(self, key: str, fn: tp.Callable[[], T]) -> tp.Tuple[T, bool]:
+        """Runs `fn` once for all concurrent callers of `key`.
+
+        Returns:
+            Tuple[T, bool]: The result of `fn` and whether it was shared with (computed by) another caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, call.waiters > 0
+
+    def in_flight(self) -> int:
+        """Number of keys currently being computed."""
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,108 @@
+"""Span-style latency tracing of the chat pipeline.
+
+`with span("rerank"):` times a stage. Every span is recorded in the in-process `STAGE_SECONDS`
+histogram (served by `GET /metrics/stages`), and, when a request trace is active (see `start_trace`),
+added to it so that the request can return a `Server-Timing` header.
+"""
+import time
+import inspect
+import functools
+import contextlib
+import contextvars
+import typing as tp
+
+from backend.core.metrics import Histogram, TOKEN_BUCKETS
+
+STAGE_SECONDS = Histogram(
+    "chat_stage_duration_seconds", "Duration of the stages of the chat pipeline", labelnames=("stage",),
+)
+STAGE_TOKENS = Histogram(
+    "chat_stage_tokens", "Tokens billed by the provider per stage", buckets=TOKEN_BUCKETS,
+    labelnames=("stage", "direction"),
+)
+
+
+class Span:
+    def __init__(self, name: str):
+        self.name = name
+        self.duration = 0.0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def add_tokens(self, input_tokens: tp.Optional[int] = 0, output_tokens: tp.Optional[int] = 0) -> None:
+        self.input_tokens += int(input_tokens or 0)
+        self.output_tokens += int(output_tokens or 0)
+
+
+class Trace:
+    """The spans of one request."""
+    def __init__(self):
+        self.spans: tp.List[Span] = []
+
+    def server_timing(self) -> str:
+        """`Server-Timing` header value, with the durations of spans sharing a name summed up."""
+        stages: tp.Dict[str, Span] = {}
+        for span in list(self.spans):
+            total = stages.setdefault(span.name, Span(span.name))
+            total.duration += span.duration
+            total.add_tokens(span.input_tokens, span.output_tokens)
+        entries = []
+        for name, total in stages.items():
+            entry = f"{name};dur={total.duration * 1000:.1f}"
+            if total.input_tokens or total.output_tokens:
+                entry += f';desc="tokens in={total.input_tokens} out={total.output_tokens}"'
+            entries.append(entry)
+        return ", ".join(entries)
+
+_current_trace: contextvars.ContextVar[tp.Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+
+def start_trace() -> Trace:
+    """Starts collecting the spans of the current request (context)."""
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+@contextlib.contextmanager
+def span(name: str) -> tp.Iterator[Span]:
+    """Times the enclosed block as the stage `name`."""
+    current = Span(name)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        record_span(current, time.perf_counter() - start)
+
+def record_span(current: Span, duration: float) -> None:
+    """Records a finished span (also used for stages that are not a block, e.g. time to first token)."""
+    current.duration = duration
+    STAGE_SECONDS.observe(duration, stage=current.name)
+    if current.input_tokens:
+        STAGE_TOKENS.observe(current.input_tokens, stage=current.name, direction="input")
+    if current.output_tokens:
+        STAGE_TOKENS.observe(current.output_tokens, stage=current.name, direction="output")
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append(current)
+
+def traced(name: str):
+    """Decorator timing every call of the function (or coroutine function) as the stage `name`."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def billed_tokens(response) -> tp.Tuple[int, int]:
+    """(input, output) tokens billed for a provider response, (0, 0) if unknown."""
+    billed_units = getattr(getattr(response, "meta", None), "billed_units", None)
+    return (int(getattr(billed_units, "input_tokens", 0) or 0),
+            int(getattr(billed_units, "output_tokens", 0) or 0))
@@ -1,6 +1,6 @@
 import os, sys
 import json
-import cohere
+import hashlib
 # import uuid
 import hnswlib
 from typing import List, Dict
@@ -12,44 +12,73 @@ import logging
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-from dotenv import load_dotenv
-load_dotenv('.env')
+from types import SimpleNamespace
+from backend.core.llm import get_client
+from backend.core.resilience import guarded
+from backend.core.tracing import span, billed_tokens
 
-COHERE_API_KEY = os.getenv("COHERE_API_KEY")
-co = cohere.Client(COHERE_API_KEY) # Get your API key here: https://dashboard.cohere.com/api-keys
+# Cohere client, or a local stand-in depending on LLM_PROVIDER (see backend/core/llm.py)
+co = get_client()
+
+EMBED_MODEL = "embed-english-v3.0"
+RERANK_MODEL = "rerank-english-v3.0"
+
+def embed_documents(docs: List[Dict[str, str]]) -> List[List[float]]:
+    """
+    Embeds the document chunks using the Cohere API.
+
+    With the Embed v3 model, we need to define an input_type, of which there are four options depending
+    on the type of task. Using these input types ensures the highest possible quality for the respective tasks.
+    Since our document chunks will be used for retrieval, we use search_document as the input_type
+    """
+    # Since the endpoint has a limit of 96 documents per call, we send them in batches.
+    batch_size = 90
+    docs_embs = []
+    for i in tqdm( range(0, len(docs), batch_size), desc="Embedding documents"):
+        batch = docs[i : min(i + batch_size, len(docs))]
+        texts = [item["text"] for item in batch]
+        docs_embs_batch = guarded(
+            "embed", co.embed, texts=texts, model=EMBED_MODEL, input_type="search_document"
+        ).embeddings
+        docs_embs.extend(docs_embs_batch)
+    return docs_embs
 
 class Vectorstore:
     """The Vectorstore class handles the ingestion of documents into embeddings (or vectors)
     and the retrieval of relevant documents given a query.
     """
+    retrieve_top_k = 10
+    rerank_top_k = 3
+
     def __init__(self, docs: List[Dict[str, str]]):
         self.docs = docs
         self.docs_embs = [] # embeddings of the chunked documents
-        self.retrieve_top_k = 10
-        self.rerank_top_k = 3
         self.embed()
         self.index()
 
-    def embed(self) -> None:
+    @classmethod
+    def from_index(cls, index_dir: str) -> "Vectorstore":
         """
-        Embeds the document chunks using the Cohere API.
-
-        With the Embed v3 model, we need to define an input_type, of which there are four options depending
-        on the type of task. Using these input types ensures the highest possible quality for the respective tasks.
-        Since our document chunks will be used for retrieval, we use search_document as the input_type
+        Vector store over an index built by `python -m backend.core.index_store build`.
+        Documents and embeddings are memory-mapped read-only, so the worker processes of a host
+        share them through the OS page cache; nothing is embedded at startup.
         """
-        
-        # Since the endpoint has a limit of 96 documents per call, we send them in batches.
-        batch_size = 90
+        from backend.core.index_store import IndexStore # numpy is only needed for prebuilt indexes
+
+        store = IndexStore(index_dir)
+        vectorstore = cls.__new__(cls)
+        vectorstore.docs = store.docs
+        vectorstore.docs_embs = store.embeddings
+        vectorstore.docs_len = len(store.docs)
+        vectorstore.idx = store.index
+        vectorstore.manifest = store.manifest
+        logger.info(f"Mapped the index in {index_dir} ({vectorstore.docs_len} documents).")
+        return vectorstore
+
+    def embed(self) -> None:
+        """Embeds the documents of the vector store (see `embed_documents`)."""
         self.docs_len = len(self.docs)
-        for i in tqdm( range(0, self.docs_len, batch_size), desc="Embedding documents"):
-            batch = self.docs[i : min(i + batch_size, self.docs_len)]
-            texts = [item["text"] for item in batch]
-            docs_embs_batch = co.embed(
-                texts=texts, model="embed-english-v3.0", input_type="search_document"
-            ).embeddings
-            self.docs_embs.extend(docs_embs_batch)
-            
+        self.docs_embs = embed_documents(self.docs)
         logger.info(f"Embedded {len(self.docs_embs)} documents successfully.")
 
     def index(self) -> None:
@@ -81,6 +110,13 @@ class Vectorstore:
 
         logger.info(f"Indexing complete with {self.idx.get_current_count()} documents.")
 
+    def config_fingerprint(self) -> str:
+        """Short hash of everything that changes what `retrieve` returns for a query."""
+        config = f"{self.docs_len}|{self.retrieve_top_k}|{self.rerank_top_k}|{EMBED_MODEL}|{RERANK_MODEL}"
+        if getattr(self, "manifest", None): # Prebuilt index: a rebuilt corpus changes the answers
+            config += f"|{self.manifest['corpus_sha256']}"
+        return hashlib.sha256(config.encode()).hexdigest()[:16]
+
     def retrieve(self, query: str) -> List[Dict[str, str]]:
         """Retrieves document chunks based on the given query using Semantic Search.
         It has 2 steps: Dense retrieval and Reranking.
@@ -98,35 +134,45 @@ class Vectorstore:
         """
 
         # Dense retrieval with input_type=”search_query” for queries
-        query_emb = co.embed(
-            texts=[query], model="embed-english-v3.0", input_type="search_query"
-        ).embeddings
+        with span("embed_query") as embed_span:
+            embed_response = guarded(
+                "embed", co.embed, texts=[query], model=EMBED_MODEL, input_type="search_query"
+            )
+            embed_span.add_tokens(*billed_tokens(embed_response))
+        query_emb = embed_response.embeddings
 
-        doc_ids = self.idx.knn_query(query_emb, k=self.retrieve_top_k)[0][0]
+        with span("knn"):
+            labels, distances = self.idx.knn_query(query_emb, k=self.retrieve_top_k)
+        doc_ids = labels[0]
         logger.info(f"Retrieved document IDs: {doc_ids}")
 
         # Reranking for additional boost in relevance
         rank_fields = ["title", "text"] # We'll use the title and text fields for reranking
 
-        docs_to_rerank = [self.docs[doc_id] for doc_id in doc_ids]
-
-        rerank_results = co.rerank(
-            query=query,
-            documents=docs_to_rerank,
-            top_n=self.rerank_top_k,
-            model="rerank-english-v3.0",
-            rank_fields=rank_fields
-        )
+        docs_to_rerank = [self.docs[int(doc_id)] for doc_id in doc_ids]
+
+        # If rerank is slow or failing, degrade to the dense retrieval order
+        with span("rerank"):
+            rerank_results = guarded(
+                "rerank", co.rerank,
+                query=query,
+                documents=docs_to_rerank,
+                top_n=self.rerank_top_k,
+                model=RERANK_MODEL,
+                rank_fields=rank_fields,
+                fallback=lambda: self.knn_ranking(distances[0]),
+            )
 
         doc_ids_reranked = [doc_ids[result.index] for result in rerank_results.results]
         logger.info(f"Rerank results: {rerank_results.results}")
 
         docs_retrieved = []
         for i, doc_id in enumerate(doc_ids_reranked):
+            doc = docs_to_rerank[rerank_results.results[i].index] # Already loaded for the rerank
             docs_retrieved.append(
                 {
-                    "title": self.docs[doc_id]["title"],
-                    "text": self.docs[doc_id]["text"],
+                    "title": doc["title"],
+                    "text": doc["text"],
                     "id": str(doc_id),
                     "relevance_score": str(rerank_results.results[i].relevance_score),
                 }
@@ -134,6 +180,14 @@ class Vectorstore:
 
         return docs_retrieved
 
+    def knn_ranking(self, distances) -> SimpleNamespace:
+        """Rerank-like results keeping the dense retrieval order (degraded path when rerank is unavailable)."""
+        # With the "ip" space, hnswlib returns 1 - inner product as the distance
+        return SimpleNamespace(results=[
+            SimpleNamespace(index=i, relevance_score=float(1 - distance))
+            for i, distance in enumerate(distances[:self.rerank_top_k])
+        ])
+
 
 
 if __name__ == "__main__":
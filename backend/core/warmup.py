@@ -0,0 +1,100 @@
+"""Background warm-up of the retrieval engine (FAQ corpus, vector store and chatbot).
+
+The server binds and serves `/healthz` right away; the engine is built in a background thread
+started by the application lifespan, and `/readyz` (and the chat endpoints) succeed once it is loaded.
+"""
+import time
+import threading
+import typing as tp
+
+from backend.core.config import FAQ_DB_FORCE_INIT, INDEX_DIR
+from backend.core.documents import DocumentStore
+from backend.core.metrics import Gauge
+
+import logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+FAQ_DATABASE = "ecommerce_faq"
+
+
+class RetrievalEngine:
+    """The FAQ documents, their vector store and the chatbot answering from them."""
+    def __init__(self):
+        self.faq_data: tp.Sequence[dict] = []
+        self.vectorstore = None
+        self.documents: tp.Optional[DocumentStore] = None # FAQ documents by ID
+        self.chatbot = None
+        self.error: tp.Optional[str] = None # Why the last warm-up failed
+        self.warmup_seconds: tp.Optional[float] = None
+        self._ready = threading.Event()
+        self._thread: tp.Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def index_documents(self) -> tp.Optional[int]:
+        return len(self.vectorstore.docs) if self.ready else None
+
+    def index_bytes(self) -> tp.Optional[int]:
+        """Size of the document embeddings (float32), for capacity planning."""
+        if not self.ready:
+            return None
+        embeddings = self.vectorstore.docs_embs
+        if hasattr(embeddings, "nbytes"): # Memory-mapped numpy array of a prebuilt index
+            return int(embeddings.nbytes)
+        return len(embeddings) * len(embeddings[0]) * 4 if len(embeddings) else 0
+
+    def start(self) -> None:
+        """Starts the warm-up in a background thread (once)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.warm_up, name="warm-up", daemon=True)
+            self._thread.start()
+
+    def wait(self, timeout: tp.Optional[float] = None) -> bool:
+        """Blocks until the engine is ready (e.g. for scripts); returns whether it is."""
+        return self._ready.wait(timeout)
+
+    def warm_up(self, retry_delay: float = 10.0) -> None:
+        """Builds the engine, retrying every `retry_delay` seconds (e.g. while MySQL is still starting)."""
+        while not self._build():
+            time.sleep(retry_delay)
+
+    def _build(self) -> bool:
+        # Heavy modules (hnswlib, unstructured, MySQL driver) are imported here, off the bind path
+        from backend.db.mysql_v1 import MYSQL
+        from backend.core.vectorstore import Vectorstore
+        from backend.core.chat_engine import Chatbot
+
+        start = time.perf_counter()
+        try:
+            if INDEX_DIR:
+                # Prebuilt index, memory-mapped and shared with the other workers
+                self.vectorstore = Vectorstore.from_index(INDEX_DIR)
+                self.faq_data = self.vectorstore.docs
+            else:
+                # Only replays the SQL script (which drops the database) when it changed
+                MYSQL.init_db_if_changed(FAQ_DATABASE, force=FAQ_DB_FORCE_INIT)
+                self.faq_data = MYSQL.load_faq_data()
+                self.vectorstore = Vectorstore(docs=self.faq_data)
+            self.documents = DocumentStore(self.faq_data)
+            self.chatbot = Chatbot(vectorstore=self.vectorstore)
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            logger.error(f"Warm-up of the retrieval engine failed: {e}", exc_info=True)
+            return False
+        self.warmup_seconds = time.perf_counter() - start
+        self.error = None
+        self._ready.set()
+        logger.info(f"Retrieval engine ready in {self.warmup_seconds:.1f}s ({len(self.faq_data)} documents).")
+        return True
+
+
+# Shared engine, warmed up by the application lifespan (backend/main.py)
+retrieval = RetrievalEngine()
+
+Gauge("retrieval_ready", "Whether the retrieval engine is loaded (1) or warming up (0)", function=lambda: int(retrieval.ready))
+Gauge("retrieval_warmup_seconds", "Duration of the warm-up of the retrieval engine", function=lambda: retrieval.warmup_seconds)
+Gauge("retrieval_index_documents", "Documents in the retrieval index", function=retrieval.index_documents)
+Gauge("retrieval_index_bytes", "Size of the embeddings of the retrieval index", function=retrieval.index_bytes)
@@ -0,0 +1,276 @@
+"""Hot/cold tiering of chat sessions.
+
+- Sessions without a message for ARCHIVE_AFTER_DAYS are archived: their messages, citations and citation
+  documents are moved out of the hot tables into one zlib-compressed JSON blob per session
+  (`session_archives`). The session row, its activity summary and its history summary stay, so the
+  session list is unchanged and the hot tables (and their indexes) only hold the active conversations.
+- An archived session is restored on its next access (reading the session or its messages, or sending
+  a message): `ensure_hot` / `rehydrate`. Messages keep their IDs, unless the database reused some of
+  them in the meantime (SQLite reuses the IDs above the largest remaining one); then the restored
+  messages and citations get new IDs, in the same order, and the `message_epoch` of the session is
+  bumped, so that clients syncing with `after=<message_id>` know to reload it.
+- The reads by message, citation or document ID (`/messages/{id}/citations`, `/citations/...`) and the
+  full-text search only see hot sessions: the messages and citations of an archived session are not
+  found (404, or absent from lists) until the session is read again.
+- Archival runs every ARCHIVE_INTERVAL seconds in a background thread, at most ARCHIVE_BATCH sessions
+  per run, one transaction per session. It can also be run by hand:
+  `python -m backend.db.archive run [--days N]`, and sessions deleted with
+  `python -m backend.db.archive delete <session_id>...` (see also `crud.delete_chat_sessions`).
+
+SQLite reuses the pages freed by archival for new rows; run `VACUUM` to give the space back to the file system.
+"""
+import sys
+import json
+import zlib
+import datetime
+import argparse
+import threading
+import typing as tp
+
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session, selectinload
+
+from backend.core.config import ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL, ARCHIVE_BATCH
+from backend.core.metrics import Counter
+from backend.db import crud, database
+
+import logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SESSIONS_ARCHIVED = Counter("sessions_archived_total", "Idle chat sessions moved to the archive")
+SESSIONS_REHYDRATED = Counter("sessions_rehydrated_total", "Archived chat sessions restored on access")
+
+
+def _utcnow() -> datetime.datetime:
+    # Naive UTC, like the CURRENT_TIMESTAMP server default of the timestamp columns
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def _message_record(message: database.Message) -> dict:
+    """A stored message in the format of the write-behind log (see `crud._turn_rows`)."""
+    return {
+        "id": message.id,
+        "session_id": message.session_id,
+        "role": message.role,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        "ai_model": message.ai_model,
+        "link": message.link,
+        "citations": [
+            {"id": citation.id, "msg_id": citation.msg_id, "start": citation.start, "end": citation.end,
+             "text": citation.text, "doc_ids": citation.doc_ids}
+            for citation in message.citations
+        ],
+    }
+
+
+# --- Archival ---
+
+def archive_session(db: Session, session_id: str, idle_before: tp.Optional[datetime.datetime] = None) -> bool:
+    """
+    Moves the messages of a session to its archive, in one transaction.
+    Returns False (and changes nothing) if the session is already archived, has no message,
+    or has had a message since `idle_before`.
+    """
+    session = database.ChatSession
+    claim = update(session).where(session.id == session_id, session.archived_at.is_(None), session.message_count > 0)
+    if idle_before is not None:
+        claim = claim.where(session.last_message_at < idle_before)
+    # Claim the session first: a concurrent archival or rehydration of the same session waits or gives up
+    if not db.execute(claim.values(archived_at=_utcnow()).execution_options(synchronize_session=False)).rowcount:
+        db.rollback()
+        return False
+    messages = db.query(database.Message)\
+        .options(selectinload(database.Message.citations))\
+        .filter(database.Message.session_id == session_id)\
+        .order_by(database.Message.timestamp.asc(), database.Message.id.asc())\
+        .all()
+    if not messages:
+        db.rollback()
+        return False
+    records = [_message_record(message) for message in messages]
+    db.add(database.SessionArchive(
+        session_id=session_id,
+        payload=zlib.compress(json.dumps(records, separators=(",", ":")).encode()),
+        message_count=len(records),
+        max_message_id=max(record["id"] for record in records),
+        max_citation_id=max((citation["id"] for record in records for citation in record["citations"]), default=0),
+    ))
+    db.flush()
+    # Only the archived rows: a turn stored meanwhile stays hot, and is merged back on rehydration
+    for statement in crud._message_deletes([session_id], message_ids=[record["id"] for record in records]):
+        db.execute(statement.execution_options(synchronize_session=False))
+    db.commit()
+    SESSIONS_ARCHIVED.inc()
+    return True
+
+def archive_idle_sessions(db: Session, idle_days: float = ARCHIVE_AFTER_DAYS, limit: int = ARCHIVE_BATCH) -> int:
+    """Archives up to `limit` sessions without a message for `idle_days`, least recently active first. Returns how many."""
+    idle_before = _utcnow() - datetime.timedelta(days=idle_days)
+    session_ids = [
+        row.id for row in db.query(database.ChatSession.id) # Range read of the last activity index
+            .filter(database.ChatSession.last_message_at < idle_before)
+            .filter(database.ChatSession.archived_at.is_(None), database.ChatSession.message_count > 0)
+            .order_by(database.ChatSession.last_message_at.asc())
+            .limit(limit)
+    ]
+    archived = 0
+    for session_id in session_ids:
+        try:
+            archived += archive_session(db, session_id, idle_before=idle_before)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error archiving chat session {session_id}: {e}", exc_info=True)
+    if archived:
+        logger.info(f"Archived {archived} chat sessions idle for more than {idle_days} days.")
+    return archived
+
+
+# --- Rehydration ---
+
+def ensure_hot(db: Session, chat_session: database.ChatSession) -> None:
+    """Restores the messages of a session if it is archived (no-op, and no query, otherwise)."""
+    if chat_session.archived_at is not None:
+        rehydrate(db, chat_session.id)
+
+def rehydrate(db: Session, session_id: str) -> bool:
+    """
+    Moves the messages of an archived session back to the hot tables, in one transaction.
+    Returns False if the session is not archived (e.g. a concurrent request restored it first).
+    Async code calls it with `await db.run_sync(archive.rehydrate, session_id)`.
+    """
+    session = database.ChatSession
+    claim = update(session).where(session.id == session_id, session.archived_at.is_not(None))
+    if not db.execute(claim.values(archived_at=None).execution_options(synchronize_session=False)).rowcount:
+        db.rollback()
+        return False
+    archive = db.get(database.SessionArchive, session_id)
+    if archive is not None:
+        records = json.loads(zlib.decompress(archive.payload))
+        message_ids = [record["id"] for record in records]
+        citation_ids = [citation["id"] for record in records for citation in record["citations"]]
+        reused = db.query(database.Message.id).filter(database.Message.id.in_(message_ids)).first() or \
+            (citation_ids and db.query(database.Citation.id).filter(database.Citation.id.in_(citation_ids)).first())
+        if reused:
+            _insert_renumbered(db, session_id, records)
+        else:
+            _, table_rows = crud._turn_rows([{"messages": records}], stored=set())
+            for table, rows in table_rows:
+                if rows:
+                    db.execute(table.insert(), rows)
+        db.delete(archive)
+    db.commit()
+    SESSIONS_REHYDRATED.inc()
+    return True
+
+def _insert_renumbered(db: Session, session_id: str, records: tp.List[dict]) -> None:
+    """Inserts archived messages under new IDs (in the same order), and points the history summary to them."""
+    restored = []
+    for record in records:
+        message = database.Message(
+            session_id=session_id,
+            role=record["role"],
+            content=record["content"],
+            timestamp=datetime.datetime.fromisoformat(record["timestamp"]),
+            ai_model=record["ai_model"],
+            link=record["link"],
+            citations=[
+                crud._build_citation({**citation, "document_ids": citation["doc_ids"]})
+                for citation in record["citations"]
+            ],
+        )
+        db.add(message)
+        db.flush() # One at a time, so the new IDs keep the order of the old ones
+        restored.append((record["id"], message.id))
+    new_ids = dict(restored)
+    db.execute(
+        update(database.ChatSession).where(database.ChatSession.id == session_id)
+        .values(message_epoch=database.ChatSession.message_epoch + 1)
+        .execution_options(synchronize_session=False)
+    )
+    summary = db.get(database.ConversationSummary, session_id)
+    if summary is not None and summary.last_msg_id in new_ids:
+        summary.last_msg_id = new_ids[summary.last_msg_id]
+    logger.info(f"Restored chat session {session_id} under new message IDs (the old ones were reused).")
+
+def max_archived_ids(db: Session) -> tp.Tuple[int, int]:
+    """Largest message and citation IDs held by the archives (so that they are not handed out again)."""
+    max_message_id, max_citation_id = db.query(
+        func.max(database.SessionArchive.max_message_id), func.max(database.SessionArchive.max_citation_id),
+    ).one()
+    return max_message_id or 0, max_citation_id or 0
+
+
+# --- Background archival ---
+
+class Archiver:
+    """Archives the idle sessions every `interval` seconds, in a background thread."""
+    def __init__(self, idle_days: float = ARCHIVE_AFTER_DAYS, interval: float = ARCHIVE_INTERVAL, batch_size: int = ARCHIVE_BATCH):
+        self.idle_days = idle_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._worker: tp.Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.idle_days > 0
+
+    def start(self) -> None:
+        if not self.enabled or self._worker is not None:
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._run, name="archiver", daemon=True)
+        self._worker.start()
+
+    def stop(self) -> None:
+        if self._worker is None:
+            return
+        self._stop.set()
+        self._worker.join()
+        self._worker = None
+
+    def run_once(self) -> int:
+        db = database.SessionLocal()
+        try:
+            return archive_idle_sessions(db, idle_days=self.idle_days, limit=self.batch_size)
+        finally:
+            db.close()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Error archiving idle chat sessions: {e}", exc_info=True)
+
+
+# Shared archiver, started on application startup when ARCHIVE_AFTER_DAYS is set
+archiver = Archiver()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archival of idle chat sessions")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="Archive the idle sessions now")
+    run.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS or 30, help="Idle days before archival")
+    run.add_argument("--limit", type=int, default=ARCHIVE_BATCH)
+    remove = commands.add_parser("delete", help="Delete sessions with all their messages (hot or archived)")
+    remove.add_argument("session_ids", nargs="+")
+    args = parser.parse_args(sys.argv[1:])
+
+    database.create_db_and_tables()
+    db = database.SessionLocal()
+    try:
+        if args.command == "run":
+            total = 0
+            while True: # Batches until nothing is left to archive
+                archived = archive_idle_sessions(db, idle_days=args.days, limit=args.limit)
+                total += archived
+                if archived < args.limit:
+                    break
+            print(f"Archived {total} chat sessions.")
+        else:
+            print(f"Deleted {crud.delete_chat_sessions(db, args.session_ids)} chat sessions.")
+    finally:
+        db.close()
@@ -0,0 +1,254 @@
+# async_crud.py
+"""Async versions of the functions of `crud.py`, for `AsyncSession`s (see `async_database.py`).
+
+Same names, arguments and results as the sync functions. Relationships are never lazy-loaded in
+async code: the functions return objects with everything the API models read already loaded.
+"""
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from backend.db import models, database, pagination
+from backend.db.crud import SESSION_SORT_COLUMNS, _activity_updates, _build_citation, _keyset_filter, _session_activity, _session_deletes, _turn_rows
+from backend.core.tracing import traced
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+# --- Chat Session CRUD ---
+
+@traced("db.create_chat_session")
+async def create_chat_session(db: AsyncSession, session_create: models.ChatSessionCreate) -> database.ChatSession:
+    """Creates a new chat session in the database."""
+    session_id = str(uuid.uuid4())
+    # Use provided title or generate a default one
+    title = session_create.title or f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    db_session = database.ChatSession(id=session_id, title=title)
+    db.add(db_session)
+    await db.commit()
+    await db.refresh(db_session) # created_at is set by the server
+    return db_session
+
+@traced("db.get_chat_session")
+async def get_chat_session(db: AsyncSession, session_id: str) -> Optional[database.ChatSession]:
+    """Retrieves a single chat session by its ID."""
+    return await db.get(database.ChatSession, session_id)
+
+@traced("db.get_chat_sessions")
+async def get_chat_sessions(db: AsyncSession, cursor: Optional[str] = None, limit: int = 100, sort: str = "created") -> List[database.ChatSession]:
+    """Retrieves a page of chat sessions, newest first (by creation or by last activity), starting after `cursor`."""
+    timestamp_col = getattr(database.ChatSession, SESSION_SORT_COLUMNS[sort])
+    query = select(database.ChatSession)
+    if cursor:
+        query = query.where(_keyset_filter(timestamp_col, database.ChatSession.id, cursor, descending=True))
+    query = query.order_by(timestamp_col.desc(), database.ChatSession.id.desc()).limit(limit)
+    return list((await db.scalars(query)).all())
+
+@traced("db.delete_chat_sessions")
+async def delete_chat_sessions(db: AsyncSession, session_ids: List[str]) -> int:
+    """Deletes chat sessions with everything that belongs to them (see `crud.delete_chat_sessions`)."""
+    deleted = 0
+    for statement in _session_deletes(session_ids):
+        deleted = (await db.execute(statement.execution_options(synchronize_session=False))).rowcount # Sessions come last
+    await db.commit()
+    return deleted
+
+# --- Message CRUD ---
+
+@traced("db.create_message")
+async def create_message(db: AsyncSession, session_id: str, message: models.MessageCreate) -> database.Message:
+    """Creates a new message within a specific chat session."""
+    db_message = database.Message(
+        session_id=session_id,
+        role=message.role,
+        content=message.content,
+        ai_model=message.ai_model,
+        link=message.link,
+        citations=[]
+    )
+    db.add(db_message)
+    await db.flush() # id and timestamp come back with the INSERT (eager_defaults)
+    await db.execute(_session_activity(session_id, 1, db_message.timestamp, db_message.content))
+    await db.commit()
+    return db_message
+
+@traced("db.create_turn")
+async def create_turn(
+    db: AsyncSession, session_id: str, user_message: models.MessageCreate,
+    assistant_message: models.MessageCreate, citations: List[Dict[str, Any]]
+) -> Tuple[database.Message, database.Message]:
+    """
+    Stores a whole chat turn in a single transaction: the user message, the assistant message,
+    the citations of the assistant message (with their documents) and the activity summary of the session.
+    """
+    db_user_message = database.Message(
+        session_id=session_id,
+        role=user_message.role,
+        content=user_message.content,
+        ai_model=user_message.ai_model,
+        link=user_message.link,
+        citations=[]
+    )
+    db_assistant_message = database.Message(
+        session_id=session_id,
+        role=assistant_message.role,
+        content=assistant_message.content,
+        ai_model=assistant_message.ai_model,
+        link=assistant_message.link,
+        citations=[_build_citation(citation) for citation in citations or []]
+    )
+    db.add_all([db_user_message, db_assistant_message])
+    await db.flush()
+    await db.execute(_session_activity(session_id, 2, db_assistant_message.timestamp, db_assistant_message.content))
+    await db.commit()
+    return db_user_message, db_assistant_message
+
+@traced("db.insert_turns")
+async def insert_turns(db: AsyncSession, turns: List[Dict[str, Any]]) -> int:
+    """Stores chat turns logged by the write-behind queue, skipping the ones already stored (see `crud.insert_turns`)."""
+    session_ids = {turn["session_id"] for turn in turns}
+    live = set((await db.scalars(select(database.ChatSession.id).where(database.ChatSession.id.in_(session_ids)))).all())
+    turns = [turn for turn in turns if turn["session_id"] in live]
+    message_ids = [message["id"] for turn in turns for message in turn["messages"]]
+    stored = set((await db.scalars(select(database.Message.id).where(database.Message.id.in_(message_ids)))).all())
+    inserted, table_rows = _turn_rows(turns, stored)
+    for table, rows in table_rows:
+        if rows:
+            await db.execute(table.insert(), rows)
+    for statement in _activity_updates(table_rows[0][1]):
+        await db.execute(statement)
+    await db.commit()
+    return inserted
+
+@traced("db.get_messages_for_session")
+async def get_messages_for_session(db: AsyncSession, session_id: str, cursor: Optional[str] = None, limit: int = 100) -> List[database.Message]:
+    """Retrieves a page of messages of a chat session, oldest first, starting after `cursor`."""
+    query = select(database.Message).where(database.Message.session_id == session_id)
+    if cursor:
+        query = query.where(_keyset_filter(database.Message.timestamp, database.Message.id, cursor))
+    query = query.order_by(database.Message.timestamp.asc(), database.Message.id.asc()).limit(limit)
+    return list((await db.scalars(query)).all())
+
+@traced("db.get_messages_with_citations")
+async def get_messages_with_citations(db: AsyncSession, session_id: str, cursor: Optional[str] = None, limit: int = 100) -> List[database.Message]:
+    """Same as `get_messages_for_session`, with the citations of the messages loaded in one extra query."""
+    query = select(database.Message)\
+              .options(selectinload(database.Message.citations))\
+              .where(database.Message.session_id == session_id)
+    if cursor:
+        query = query.where(_keyset_filter(database.Message.timestamp, database.Message.id, cursor))
+    query = query.order_by(database.Message.timestamp.asc(), database.Message.id.asc()).limit(limit)
+    return list((await db.scalars(query)).all())
+
+@traced("db.get_messages_after")
+async def get_messages_after(db: AsyncSession, session_id: str, after_id: int, limit: int = 100) -> List[database.Message]:
+    """Retrieves up to `limit` messages of a session with an ID greater than `after_id`, oldest first, with their citations."""
+    query = select(database.Message)\
+              .options(selectinload(database.Message.citations))\
+              .where(database.Message.session_id == session_id, database.Message.id > after_id)\
+              .order_by(database.Message.id.asc())\
+              .limit(limit)
+    return list((await db.scalars(query)).all())
+
+@traced("db.get_recent_messages")
+async def get_recent_messages(db: AsyncSession, session_id: str, limit: int, after_id: int = 0) -> List[database.Message]:
+    """Retrieves the `limit` newest messages of a session with an ID greater than `after_id`, oldest first."""
+    query = select(database.Message)\
+              .where(database.Message.session_id == session_id, database.Message.id > after_id)\
+              .order_by(database.Message.id.desc())\
+              .limit(limit)
+    return list((await db.scalars(query)).all())[::-1]
+
+@traced("db.get_messages_to_fold")
+async def get_messages_to_fold(db: AsyncSession, session_id: str, after_id: int, keep: int, limit: int) -> List[database.Message]:
+    """Retrieves up to `limit` of the oldest messages newer than `after_id`, skipping the `keep` newest ones."""
+    newest_to_fold = await db.scalar(
+        select(database.Message.id)
+        .where(database.Message.session_id == session_id, database.Message.id > after_id)
+        .order_by(database.Message.id.desc())
+        .offset(keep)
+        .limit(1)
+    )
+    if newest_to_fold is None: # Not more than `keep` messages since the last summary
+        return []
+    query = select(database.Message)\
+              .where(database.Message.session_id == session_id,
+                     database.Message.id > after_id,
+                     database.Message.id <= newest_to_fold)\
+              .order_by(database.Message.id.asc())\
+              .limit(limit)
+    return list((await db.scalars(query)).all())
+
+# --- Conversation Summary CRUD ---
+
+@traced("db.get_conversation_summary")
+async def get_conversation_summary(db: AsyncSession, session_id: str) -> Optional[database.ConversationSummary]:
+    """Retrieves the running summary of a chat session, if any."""
+    return await db.get(database.ConversationSummary, session_id)
+
+@traced("db.upsert_conversation_summary")
+async def upsert_conversation_summary(db: AsyncSession, session_id: str, summary: str, last_msg_id: int) -> database.ConversationSummary:
+    """Creates or replaces the running summary of a chat session."""
+    db_summary = await db.get(database.ConversationSummary, session_id)
+    if db_summary is None:
+        db_summary = database.ConversationSummary(session_id=session_id, summary=summary, last_msg_id=last_msg_id)
+        db.add(db_summary)
+    else:
+        db_summary.summary = summary
+        db_summary.last_msg_id = last_msg_id
+    await db.commit()
+    return db_summary
+
+# --- Citation CRUD ---
+
+@traced("db.create_citations")
+async def create_citations(db: AsyncSession, message_id: str, citations: List[Dict[str, Any]]) -> List[database.Citation]:
+    """Creates new citations for a specific message, with their documents inserted in bulk."""
+    citations_list = [_build_citation(citation, msg_id=message_id) for citation in citations]
+    db.add_all(citations_list)
+    await db.commit()
+    return citations_list
+
+@traced("db.get_citation")
+async def get_citation(db: AsyncSession, citation_id: str) -> Optional[database.Citation]:
+    """Retrieves citation details by ID."""
+    return await db.scalar(select(database.Citation).where(database.Citation.id == citation_id))
+
+@traced("db.get_message")
+async def get_message(db: AsyncSession, msg_id: int) -> Optional[database.Message]:
+    """Retrieves a stored message by ID (None if it does not exist, or is in an archived session)."""
+    return await db.get(database.Message, msg_id)
+
+@traced("db.get_citations_by_msg_id")
+async def get_citations_by_msg_id(db: AsyncSession, msg_id: int) -> List[database.Citation]:
+    """Retrieves all citations associated with a specific message ID."""
+    query = select(database.Citation).where(database.Citation.msg_id == msg_id).order_by(database.Citation.id)
+    return list((await db.scalars(query)).all())
+
+@traced("db.get_citations")
+async def get_citations(db: AsyncSession, cursor: Optional[str] = None, limit: int = 100) -> List[database.Citation]:
+    """Retrieves a page of citations, in ID order, starting after `cursor`."""
+    query = select(database.Citation)
+    if cursor:
+        _, last_id = pagination.decode_cursor(cursor)
+        query = query.where(database.Citation.id > last_id)
+    return list((await db.scalars(query.order_by(database.Citation.id).limit(limit))).all())
+
+@traced("db.get_citations_by_doc_id")
+async def get_citations_by_doc_id(db: AsyncSession, doc_id: str, cursor: Optional[str] = None, limit: int = 100) -> List[database.Citation]:
+    """Retrieves a page of the citations of a document (reverse lookup), in ID order, starting after `cursor`."""
+    query = select(database.Citation)\
+              .join(database.CitationDocument, database.CitationDocument.citation_id == database.Citation.id)\
+              .where(database.CitationDocument.doc_id == str(doc_id))
+    if cursor:
+        _, last_id = pagination.decode_cursor(cursor)
+        query = query.where(database.Citation.id > last_id)
+    return list((await db.scalars(query.order_by(database.Citation.id).limit(limit))).all())
+
+@traced("db.get_message_ids_citing_docs")
+async def get_message_ids_citing_docs(db: AsyncSession, doc_ids: List[str]) -> List[int]:
+    """IDs of the messages citing any of the documents, e.g. to invalidate answers when FAQ documents change."""
+    query = select(database.Citation.msg_id)\
+              .join(database.CitationDocument, database.CitationDocument.citation_id == database.Citation.id)\
+              .where(database.CitationDocument.doc_id.in_([str(doc_id) for doc_id in doc_ids]))\
+              .distinct()
+    return list((await db.scalars(query)).all())
@@ -0,0 +1,34 @@
+# async_database.py
+"""Async engine and sessions for the same database as `database.py` (see `async_crud.py`).
+
+The sync `engine` / `SessionLocal` stay available for scripts, background threads and startup.
+"""
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from backend.core.config import ASYNC_DATABASE_URL
+from backend.core.instrumentation import instrument_engine
+from backend.db.database import DATABASE_URL, engine_options
+
+# Async driver of each sync backend
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "mysql": "aiomysql", "postgresql": "asyncpg"}
+
+def async_url(url: str) -> str:
+    """Async variant of a sync database URL, e.g. sqlite:///./test2.db -> sqlite+aiosqlite:///./test2.db"""
+    sync_url = make_url(url)
+    backend = sync_url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver known for '{backend}', set ASYNC_DATABASE_URL")
+    return sync_url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}").render_as_string(hide_password=False)
+
+ASYNC_URL = ASYNC_DATABASE_URL or async_url(DATABASE_URL)
+async_engine = create_async_engine(ASYNC_URL, **engine_options(ASYNC_URL))
+instrument_engine(async_engine.sync_engine, "async")
+
+# Objects stay loaded after commit: lazy refreshes are not possible outside of an await
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+async def get_async_db():
+    """FastAPI dependency to get an async DB session."""
+    async with AsyncSessionLocal() as db:
+        yield db
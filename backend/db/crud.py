@@ -1,12 +1,127 @@
 # crud.py
-from sqlalchemy.orm import Session
-from backend.db import models, database
+from sqlalchemy import and_, case, delete, literal, or_, select, update
+from sqlalchemy.orm import Session, selectinload
+from backend.db import models, database, pagination
+from backend.core.tracing import traced
 import uuid
+import contextlib
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+
+def _keyset_filter(timestamp_col, id_col, cursor: str, descending: bool = False):
+    """Filter selecting the rows after the (timestamp, id) position encoded in `cursor`."""
+    timestamp, row_id = pagination.decode_cursor(cursor)
+    if descending:
+        return or_(timestamp_col < timestamp, and_(timestamp_col == timestamp, id_col < row_id))
+    return or_(timestamp_col > timestamp, and_(timestamp_col == timestamp, id_col > row_id))
+
+@contextlib.contextmanager
+def _keep_loaded_on_commit(db: Session):
+    """Keeps the attributes of the objects loaded after commit, so returning them needs no refresh SELECTs."""
+    expire_on_commit = db.expire_on_commit
+    db.expire_on_commit = False
+    try:
+        yield
+    finally:
+        db.expire_on_commit = expire_on_commit
+
+def _build_citation(citation: Dict[str, Any], **kwargs) -> database.Citation:
+    """Citation (with its documents) from a Cohere citation dict:
+    {'start': 0, 'end': 41, 'text': '', 'document_ids': ['4'], 'type': 'TEXT_CONTENT'}
+    """
+    return database.Citation(
+        text=citation['text'],
+        start=citation['start'],
+        end=citation['end'],
+        documents=[
+            database.CitationDocument(doc_id=str(doc_id), position=position)
+            for position, doc_id in enumerate(dict.fromkeys(citation['document_ids'])) # Unique, in order
+        ],
+        **kwargs
+    )
+
+def _turn_rows(turns: List[Dict[str, Any]], stored: set) -> Tuple[int, List[Tuple[Any, List[dict]]]]:
+    """
+    Rows of the logged turns (see `insert_turns`) that are not `stored` yet, as (table, rows) pairs
+    in foreign key order, and the number of turns they belong to.
+    """
+    message_rows, citation_rows, document_rows = [], [], []
+    inserted = 0
+    for turn in turns:
+        if any(message["id"] in stored for message in turn["messages"]):
+            continue
+        inserted += 1
+        for message in turn["messages"]:
+            message_rows.append({
+                "id": message["id"],
+                "session_id": message["session_id"],
+                "role": message["role"],
+                "content": message["content"],
+                "timestamp": datetime.fromisoformat(message["timestamp"]),
+                "ai_model": message["ai_model"],
+                "link": message["link"],
+            })
+            for citation in message["citations"]:
+                citation_rows.append({key: citation[key] for key in ("id", "msg_id", "start", "end", "text")})
+                document_rows.extend(
+                    {"citation_id": citation["id"], "doc_id": doc_id, "position": position}
+                    for position, doc_id in enumerate(citation["doc_ids"])
+                )
+    return inserted, [(database.Message.__table__, message_rows),
+                      (database.Citation.__table__, citation_rows),
+                      (database.CitationDocument.__table__, document_rows)]
+
+def _session_activity(session_id: str, count: int, last_message_at: datetime, last_content: str):
+    """
+    UPDATE of the activity summary of a session for `count` new messages, the newest one at `last_message_at`.
+    The count is incremented in SQL, and the last message only moves forward, so concurrent writers cannot undo each other.
+    """
+    session = database.ChatSession
+    last_message_at = literal(last_message_at, session.last_message_at.type)
+    newer = or_(session.last_message_at.is_(None), session.last_message_at <= last_message_at)
+    return update(session).where(session.id == session_id).values(
+        message_count=session.message_count + count,
+        last_message_at=case((newer, last_message_at), else_=session.last_message_at),
+        last_message_preview=case((newer, last_content[:database.PREVIEW_LENGTH]), else_=session.last_message_preview),
+    ).execution_options(synchronize_session=False)
+
+def _activity_updates(message_rows: List[dict]) -> list:
+    """Activity summary UPDATEs (see `_session_activity`) of the sessions of the message rows of `_turn_rows`."""
+    activity: Dict[str, Tuple[int, datetime, str]] = {}
+    for row in message_rows:
+        count, last_message_at, last_content = activity.get(row["session_id"], (0, None, None))
+        if last_message_at is None or row["timestamp"] >= last_message_at:
+            last_message_at, last_content = row["timestamp"], row["content"]
+        activity[row["session_id"]] = (count + 1, last_message_at, last_content)
+    return [_session_activity(session_id, *summary) for session_id, summary in activity.items()]
+
+def _message_deletes(session_ids: List[str], message_ids: Optional[List[int]] = None) -> list:
+    """
+    DELETEs of the messages of sessions (only `message_ids` among them, if given), with their citations
+    and citation documents (children first).
+    """
+    selected = database.Message.session_id.in_(session_ids)
+    if message_ids is not None:
+        selected = and_(selected, database.Message.id.in_(message_ids))
+    messages = select(database.Message.id).where(selected)
+    citations = select(database.Citation.id).where(database.Citation.msg_id.in_(messages))
+    return [
+        delete(database.CitationDocument).where(database.CitationDocument.citation_id.in_(citations)),
+        delete(database.Citation).where(database.Citation.msg_id.in_(messages)),
+        delete(database.Message).where(selected),
+    ]
+
+def _session_deletes(session_ids: List[str]) -> list:
+    """DELETEs of chat sessions and everything that belongs to them, hot or archived (children first)."""
+    return _message_deletes(session_ids) + [
+        delete(database.ConversationSummary).where(database.ConversationSummary.session_id.in_(session_ids)),
+        delete(database.SessionArchive).where(database.SessionArchive.session_id.in_(session_ids)),
+        delete(database.ChatSession).where(database.ChatSession.id.in_(session_ids)),
+    ]
 
 # --- Chat Session CRUD ---
 
+@traced("db.create_chat_session")
 def create_chat_session(db: Session, session_create: models.ChatSessionCreate) -> database.ChatSession:
     """Creates a new chat session in the database."""
     session_id = str(uuid.uuid4())
@@ -18,16 +133,44 @@ def create_chat_session(db: Session, session_create: models.ChatSessionCreate) -
     db.refresh(db_session)
     return db_session
 
+@traced("db.get_chat_session")
 def get_chat_session(db: Session, session_id: str) -> Optional[database.ChatSession]:
     """Retrieves a single chat session by its ID."""
     return db.query(database.ChatSession).filter(database.ChatSession.id == session_id).first()
 
-def get_chat_sessions(db: Session, skip: int = 0, limit: int = 100) -> List[database.ChatSession]:
-    """Retrieves a list of chat sessions with pagination."""
-    return db.query(database.ChatSession).order_by(database.ChatSession.created_at.desc()).offset(skip).limit(limit).all()
+# Timestamp column the session list can be sorted by (newest first)
+SESSION_SORT_COLUMNS = {
+    "created": "created_at",
+    "activity": "last_message_at",
+}
+
+@traced("db.get_chat_sessions")
+def get_chat_sessions(db: Session, cursor: Optional[str] = None, limit: int = 100, sort: str = "created") -> List[database.ChatSession]:
+    """
+    Retrieves a page of chat sessions, newest first, starting after `cursor` (keyset pagination).
+    `sort="activity"` orders them by their last message instead of their creation (one index range read either way).
+    """
+    timestamp_col = getattr(database.ChatSession, SESSION_SORT_COLUMNS[sort])
+    query = db.query(database.ChatSession)
+    if cursor:
+        query = query.filter(_keyset_filter(timestamp_col, database.ChatSession.id, cursor, descending=True))
+    return query.order_by(timestamp_col.desc(), database.ChatSession.id.desc()).limit(limit).all()
+
+@traced("db.delete_chat_sessions")
+def delete_chat_sessions(db: Session, session_ids: List[str]) -> int:
+    """
+    Deletes chat sessions with their messages, citations, summaries and archives, in a single transaction
+    (a few set-based DELETEs, whatever the number of sessions). Returns the number of sessions deleted.
+    """
+    deleted = 0
+    for statement in _session_deletes(session_ids):
+        deleted = db.execute(statement.execution_options(synchronize_session=False)).rowcount # Sessions come last
+    db.commit()
+    return deleted
 
 # --- Message CRUD ---
 
+@traced("db.create_message")
 def create_message(db: Session, session_id: str, message: models.MessageCreate) -> database.Message:
     """Creates a new message within a specific chat session."""
     db_message = database.Message(
@@ -35,71 +178,203 @@ def create_message(db: Session, session_id: str, message: models.MessageCreate)
         role=message.role,
         content=message.content,
         ai_model=message.ai_model,
-        link=message.link
+        link=message.link,
+        citations=[] # Known empty: reading them after commit needs no query
         # timestamp is handled by server_default
     )
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    db.flush() # id and timestamp come back with the INSERT (eager_defaults)
+    db.execute(_session_activity(session_id, 1, db_message.timestamp, db_message.content))
+    with _keep_loaded_on_commit(db):
+        db.commit()
     return db_message
 
-def get_messages_for_session(db: Session, session_id: str, skip: int = 0, limit: int = 1000) -> List[database.Message]:
-    """Retrieves all messages for a given chat session, oldest first."""
-    # Limit 1000 to avoid overwhelming requests, adjust as needed
+@traced("db.create_turn")
+def create_turn(
+    db: Session, session_id: str, user_message: models.MessageCreate,
+    assistant_message: models.MessageCreate, citations: List[Dict[str, Any]]
+) -> Tuple[database.Message, database.Message]:
+    """
+    Stores a whole chat turn in a single transaction: the user message, the assistant message,
+    the citations of the assistant message (with their documents) and the activity summary of the session.
+    Generated IDs and timestamps come back from the INSERTs (RETURNING), so nothing is re-read.
+    """
+    db_user_message = database.Message(
+        session_id=session_id,
+        role=user_message.role,
+        content=user_message.content,
+        ai_model=user_message.ai_model,
+        link=user_message.link,
+        citations=[] # Known empty: reading them after commit needs no query (nor a pool connection)
+    )
+    db_assistant_message = database.Message(
+        session_id=session_id,
+        role=assistant_message.role,
+        content=assistant_message.content,
+        ai_model=assistant_message.ai_model,
+        link=assistant_message.link,
+        citations=[_build_citation(citation) for citation in citations or []]
+    )
+    db.add_all([db_user_message, db_assistant_message])
+    db.flush()
+    db.execute(_session_activity(session_id, 2, db_assistant_message.timestamp, db_assistant_message.content))
+    with _keep_loaded_on_commit(db):
+        db.commit()
+    return db_user_message, db_assistant_message
+
+@traced("db.insert_turns")
+def insert_turns(db: Session, turns: List[Dict[str, Any]]) -> int:
+    """
+    Stores chat turns logged by the write-behind queue (backend/db/write_behind.py), with their
+    pre-assigned IDs and timestamps, in a single transaction: one multi-row INSERT per table, then
+    one activity summary UPDATE per session.
+    Turns already stored are skipped, so replaying the log after a crash is idempotent, and so are
+    the turns of sessions deleted in the meantime.
+    Returns the number of turns inserted.
+    """
+    session_ids = {turn["session_id"] for turn in turns}
+    live = {row.id for row in db.query(database.ChatSession.id).filter(database.ChatSession.id.in_(session_ids))}
+    turns = [turn for turn in turns if turn["session_id"] in live]
+    message_ids = [message["id"] for turn in turns for message in turn["messages"]]
+    stored = {row.id for row in db.query(database.Message.id).filter(database.Message.id.in_(message_ids))}
+    inserted, table_rows = _turn_rows(turns, stored)
+    for table, rows in table_rows:
+        if rows:
+            db.execute(table.insert(), rows)
+    for statement in _activity_updates(table_rows[0][1]):
+        db.execute(statement)
+    db.commit()
+    return inserted
+
+@traced("db.get_messages_for_session")
+def get_messages_for_session(db: Session, session_id: str, cursor: Optional[str] = None, limit: int = 100) -> List[database.Message]:
+    """Retrieves a page of messages of a chat session, oldest first, starting after `cursor`."""
+    query = db.query(database.Message).filter(database.Message.session_id == session_id)
+    if cursor:
+        query = query.filter(_keyset_filter(database.Message.timestamp, database.Message.id, cursor))
+    return query.order_by(database.Message.timestamp.asc(), database.Message.id.asc()).limit(limit).all()
+
+@traced("db.get_messages_with_citations")
+def get_messages_with_citations(db: Session, session_id: str, cursor: Optional[str] = None, limit: int = 100) -> List[database.Message]:
+    """Same as `get_messages_for_session`, with the citations of the messages loaded in one extra query."""
+    query = db.query(database.Message)\
+              .options(selectinload(database.Message.citations))\
+              .filter(database.Message.session_id == session_id)
+    if cursor:
+        query = query.filter(_keyset_filter(database.Message.timestamp, database.Message.id, cursor))
+    return query.order_by(database.Message.timestamp.asc(), database.Message.id.asc()).limit(limit).all()
+
+@traced("db.get_messages_after")
+def get_messages_after(db: Session, session_id: str, after_id: int, limit: int = 100) -> List[database.Message]:
+    """Retrieves up to `limit` messages of a session with an ID greater than `after_id`, oldest first, with their citations."""
+    return db.query(database.Message)\
+             .options(selectinload(database.Message.citations))\
+             .filter(database.Message.session_id == session_id, database.Message.id > after_id)\
+             .order_by(database.Message.id.asc())\
+             .limit(limit)\
+             .all()
+
+@traced("db.get_recent_messages")
+def get_recent_messages(db: Session, session_id: str, limit: int, after_id: int = 0) -> List[database.Message]:
+    """Retrieves the `limit` newest messages of a session with an ID greater than `after_id`, oldest first."""
+    messages = db.query(database.Message)\
+                 .filter(database.Message.session_id == session_id, database.Message.id > after_id)\
+                 .order_by(database.Message.id.desc())\
+                 .limit(limit)\
+                 .all()
+    return messages[::-1]
+
+@traced("db.get_messages_to_fold")
+def get_messages_to_fold(db: Session, session_id: str, after_id: int, keep: int, limit: int) -> List[database.Message]:
+    """Retrieves up to `limit` of the oldest messages newer than `after_id`, skipping the `keep` newest ones."""
+    newest_to_fold = db.query(database.Message.id)\
+                    .filter(database.Message.session_id == session_id, database.Message.id > after_id)\
+                    .order_by(database.Message.id.desc())\
+                    .offset(keep)\
+                    .limit(1)\
+                    .scalar()
+    if newest_to_fold is None: # Not more than `keep` messages since the last summary
+        return []
     return db.query(database.Message)\
-             .filter(database.Message.session_id == session_id)\
-             .order_by(database.Message.timestamp.asc())\
-             .offset(skip)\
+             .filter(database.Message.session_id == session_id,
+                     database.Message.id > after_id,
+                     database.Message.id <= newest_to_fold)\
+             .order_by(database.Message.id.asc())\
              .limit(limit)\
              .all()
 
+# --- Conversation Summary CRUD ---
+
+@traced("db.get_conversation_summary")
+def get_conversation_summary(db: Session, session_id: str) -> Optional[database.ConversationSummary]:
+    """Retrieves the running summary of a chat session, if any."""
+    return db.get(database.ConversationSummary, session_id)
+
+@traced("db.upsert_conversation_summary")
+def upsert_conversation_summary(db: Session, session_id: str, summary: str, last_msg_id: int) -> database.ConversationSummary:
+    """Creates or replaces the running summary of a chat session."""
+    db_summary = db.get(database.ConversationSummary, session_id)
+    if db_summary is None:
+        db_summary = database.ConversationSummary(session_id=session_id, summary=summary, last_msg_id=last_msg_id)
+        db.add(db_summary)
+    else:
+        db_summary.summary = summary
+        db_summary.last_msg_id = last_msg_id
+    db.commit()
+    return db_summary
+
 # --- Citation CRUD ---
 
+@traced("db.create_citations")
 def create_citations(db: Session, message_id: str, citations: List[Dict[str, Any]]) -> List[database.Citation]:
-    """Creates new citations for a specific message."""
-    citations_list = []
-    returned_citation_list = []
-    # Citations: [{'start': 0, 'end': 41, 'text': '', 'document_ids': ['4'], 'type': 'TEXT_CONTENT'}]
-    for citation in citations:
-        db_citation = database.Citation(
-            # id=citation['id'],
-            msg_id=message_id,
-            doc_ids=",".join([idx for idx in citation['document_ids']]),
-            text=citation['text'],
-            start=citation['start'],
-            end=citation['end']
-        )
-        citations_list.append(db_citation)
+    """Creates new citations for a specific message, with their documents inserted in bulk."""
+    citations_list = [_build_citation(citation, msg_id=message_id) for citation in citations]
     db.add_all(citations_list)
-    db.commit()
-    db.refresh(db_citation)
-    
-    for citation in citations_list:
-        citation.doc_ids = [idx for idx in citation.doc_ids.split(",")]
-        returned_citation_list.append(citation)
-    return returned_citation_list
+    with _keep_loaded_on_commit(db):
+        db.commit()
+    return citations_list
 
+@traced("db.get_citation")
 def get_citation(db: Session, citation_id: str) -> Optional[database.Citation]:
     """Retrieves citation details by ID."""
-    citation = db.query(database.Citation).filter(database.Citation.id == citation_id).first()
-    citation.doc_ids = [idx for idx in citation.doc_ids.split(",")]
-    return citation
+    return db.query(database.Citation).filter(database.Citation.id == citation_id).first()
 
+@traced("db.get_message")
+def get_message(db: Session, msg_id: int) -> Optional[database.Message]:
+    """Retrieves a stored message by ID (None if it does not exist, or is in an archived session)."""
+    return db.get(database.Message, msg_id)
+
+@traced("db.get_citations_by_msg_id")
 def get_citations_by_msg_id(db: Session, msg_id: int) -> List[database.Citation]:
     """Retrieves all citations associated with a specific message ID."""
-    temp_citations = db.query(database.Citation).filter(database.Citation.msg_id == msg_id).all()
-    citations = []
-    for citation in temp_citations:
-        citation.doc_ids = [idx for idx in citation.doc_ids.split(",")]
-        citations.append(citation)
-    return citations
-
-def get_citations(db: Session, skip: int = 0, limit: int = 100) -> List[database.Citation]:
-    """Retrieves a list of all citations."""
-    temp_citations = db.query(database.Citation).order_by(database.Citation.id).offset(skip).limit(limit).all()
-    citations = []
-    for citation in temp_citations:
-        citation.doc_ids = [idx for idx in citation.doc_ids.split(",")]
-        citations.append(citation)
-    return citations
+    return db.query(database.Citation).filter(database.Citation.msg_id == msg_id).order_by(database.Citation.id).all()
+
+@traced("db.get_citations")
+def get_citations(db: Session, cursor: Optional[str] = None, limit: int = 100) -> List[database.Citation]:
+    """Retrieves a page of citations, in ID order, starting after `cursor`."""
+    query = db.query(database.Citation)
+    if cursor:
+        _, last_id = pagination.decode_cursor(cursor)
+        query = query.filter(database.Citation.id > last_id)
+    return query.order_by(database.Citation.id).limit(limit).all()
 
+@traced("db.get_citations_by_doc_id")
+def get_citations_by_doc_id(db: Session, doc_id: str, cursor: Optional[str] = None, limit: int = 100) -> List[database.Citation]:
+    """Retrieves a page of the citations of a document (reverse lookup), in ID order, starting after `cursor`."""
+    query = db.query(database.Citation)\
+              .join(database.CitationDocument, database.CitationDocument.citation_id == database.Citation.id)\
+              .filter(database.CitationDocument.doc_id == str(doc_id))
+    if cursor:
+        _, last_id = pagination.decode_cursor(cursor)
+        query = query.filter(database.Citation.id > last_id)
+    return query.order_by(database.Citation.id).limit(limit).all()
+
+@traced("db.get_message_ids_citing_docs")
+def get_message_ids_citing_docs(db: Session, doc_ids: List[str]) -> List[int]:
+    """IDs of the messages citing any of the documents, e.g. to invalidate answers when FAQ documents change."""
+    rows = db.query(database.Citation.msg_id)\
+             .join(database.CitationDocument, database.CitationDocument.citation_id == database.Citation.id)\
+             .filter(database.CitationDocument.doc_id.in_([str(doc_id) for doc_id in doc_ids]))\
+             .distinct()\
+             .all()
+    return [row.msg_id for row in rows]
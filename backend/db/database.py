@@ -2,20 +2,37 @@
 from html import escape
 import os
 import re
-from sqlalchemy import create_engine, Column, String, Text, TIMESTAMP, Integer, ForeignKey, MetaData, Table
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, inspect, select, text, Column, String, Text, TIMESTAMP, Integer, LargeBinary, ForeignKey, MetaData, Table, Index
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import sessionmaker, declarative_base, relationship
 from sqlalchemy.sql import func
 import datetime
 import uuid
 
+from backend.core.config import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING
+from backend.core.instrumentation import instrument_engine
+
 # from chatbot import Chatbot
 # from vector_store import Vectorstore
 
 # --- Configuration ---
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test2.db")
-# Use connect_args for SQLite only to disable same-thread check needed for FastAPI background tasks/dependencies
-engine_args = {"connect_args": {"check_same_thread": False}} if DATABASE_URL.startswith("sqlite") else {}
-engine = create_engine(DATABASE_URL, **engine_args)
+
+def engine_options(url: str) -> dict:
+    """Engine keyword arguments for a database URL (shared by the sync and the async engine)."""
+    if url.startswith("sqlite"):
+        # Use connect_args for SQLite only to disable same-thread check needed for FastAPI background tasks/dependencies
+        return {"connect_args": {"check_same_thread": False}}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+instrument_engine(engine, "sync") # SQL statement counts and durations (see GET /metrics)
 
 # SessionLocal class: each instance is a database session
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -23,44 +40,205 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # Base class for SQLAlchemy models (declarative approach)
 Base = declarative_base()
 
+# SQLite stores timestamps as text. Bind them in the format of its CURRENT_TIMESTAMP server default
+# (no microseconds), so that comparisons with server-generated values, e.g. keyset cursors, are exact.
+Timestamp = TIMESTAMP().with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite",
+)
+
+# Length of the text of the last message kept on its session, for the session list
+PREVIEW_LENGTH = 120
+
 # --- SQLAlchemy Models (Define Table Structure) ---
 
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
+    __table_args__ = (
+        Index("ix_chat_sessions_created_at_id", "created_at", "id"), # Keyset pagination of the session list
+        Index("ix_chat_sessions_last_message_at_id", "last_message_at", "id"), # Same, by last activity
+    )
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     title = Column(String, nullable=False)
-    created_at = Column(TIMESTAMP, server_default=func.now())
+    created_at = Column(Timestamp, server_default=func.now())
+    # Activity summary, kept up to date by the writes of messages (see `crud._session_activity`),
+    # so the session list is read from this table alone
+    last_message_at = Column(Timestamp, default=func.now()) # Creation time until the first message
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_preview = Column(String(PREVIEW_LENGTH), nullable=True)
+    archived_at = Column(Timestamp, nullable=True) # Set while its messages are in `session_archives`
+    # Bumped when its messages get new IDs (restored from the archive under new IDs): clients that
+    # sync with `after=<message_id>` reload the session when it changes
+    message_epoch = Column(Integer, nullable=False, default=0, server_default="0")
+
+    messages = relationship("Message", back_populates="session", order_by="Message.timestamp")
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_session_timestamp_id", "session_id", "timestamp", "id"), # Ordered reads of a session
+    )
+    # Fetch the server-generated id/timestamp in the INSERT itself (RETURNING) instead of a refresh SELECT
+    __mapper_args__ = {"eager_defaults": True}
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    session_id = Column(Integer, ForeignKey("chat_sessions.id"), nullable=False, index=True)
+    session_id = Column(String, ForeignKey("chat_sessions.id"), nullable=False, index=True)
     role = Column(String, nullable=False) # 'user' or 'assistant'
     content = Column(Text, nullable=False)
-    timestamp = Column(TIMESTAMP, server_default=func.now())
+    timestamp = Column(Timestamp, server_default=func.now())
     ai_model = Column(String, nullable=True)
     link = Column(String, nullable=True)
 
+    session = relationship("ChatSession", back_populates="messages")
+    citations = relationship("Citation", back_populates="message", order_by="Citation.id")
+
 class Citation(Base):
     __tablename__ = "citations"
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     msg_id = Column(Integer, ForeignKey("messages.id"), nullable=False, index=True)
-    # List of document IDs associated with this citation
-    doc_ids = Column(String, nullable=False) # Store as comma-separated string
     start = Column(Integer, nullable=True) # Start index of the citation in the document text
     end = Column(Integer, nullable=True) # End index of the citation in the document text
     text = Column(Text, nullable=False)
 
+    message = relationship("Message", back_populates="citations")
+    # Documents associated with this citation, loaded with one query per batch of citations
+    documents = relationship(
+        "CitationDocument", lazy="selectin", order_by="CitationDocument.position", cascade="all, delete-orphan"
+    )
+
+    @property
+    def doc_ids(self):
+        """List of document IDs associated with this citation."""
+        return [document.doc_id for document in self.documents]
+
+class CitationDocument(Base):
+    __tablename__ = "citation_documents"
+    __table_args__ = (
+        Index("ix_citation_documents_doc_id_citation_id", "doc_id", "citation_id"), # Reverse lookup: citations of a document
+    )
+    citation_id = Column(Integer, ForeignKey("citations.id"), primary_key=True)
+    doc_id = Column(String, primary_key=True)
+    position = Column(Integer, nullable=False, default=0) # Order of the document within the citation
+
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summaries"
+    # Running summary of the older turns of a chat session (see backend/core/history.py)
+    session_id = Column(String, ForeignKey("chat_sessions.id"), primary_key=True)
+    summary = Column(Text, nullable=False)
+    last_msg_id = Column(Integer, nullable=False) # ID of the newest message folded into the summary
+    updated_at = Column(Timestamp, server_default=func.now(), onupdate=func.now())
+
+class SessionArchive(Base):
+    __tablename__ = "session_archives"
+    # Messages and citations of an idle chat session, moved out of the hot tables (see backend/db/archive.py)
+    session_id = Column(String, ForeignKey("chat_sessions.id"), primary_key=True)
+    payload = Column(LargeBinary(2**32 - 1), nullable=False) # zlib-compressed JSON
+    message_count = Column(Integer, nullable=False)
+    max_message_id = Column(Integer, nullable=False) # IDs reserved by the archive (see write_behind.py)
+    max_citation_id = Column(Integer, nullable=False, default=0)
+    archived_at = Column(Timestamp, server_default=func.now())
+
 # --- Database Initialization ---
 
 def create_db_and_tables():
     """Creates database tables if they don't exist."""
     try:
         Base.metadata.create_all(bind=engine)
+        migrate_session_activity()
+        migrate_session_archival()
+        create_search_index()
+        # create_all skips the indexes of tables that already exist
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+        migrate_legacy_citation_doc_ids()
         print("Database tables checked/created successfully.")
     except Exception as e:
         print(f"Error creating database tables: {e}")
 
+def migrate_legacy_citation_doc_ids():
+    """Moves the comma-separated `citations.doc_ids` of older databases into `citation_documents`."""
+    columns = {column["name"] for column in inspect(engine).get_columns("citations")}
+    if "doc_ids" not in columns:
+        return
+    with engine.begin() as connection:
+        rows = connection.execute(text("SELECT id, doc_ids FROM citations")).fetchall()
+        documents = [
+            {"citation_id": citation_id, "doc_id": doc_id, "position": position}
+            for citation_id, doc_ids in rows
+            for position, doc_id in enumerate(dict.fromkeys(filter(None, (doc_ids or "").split(","))))
+        ]
+        if documents:
+            connection.execute(CitationDocument.__table__.insert(), documents)
+        connection.execute(text("ALTER TABLE citations DROP COLUMN doc_ids"))
+    print(f"Migrated {len(rows)} citations to the citation_documents table.")
+
+def migrate_session_activity():
+    """Adds the activity summary columns to the `chat_sessions` of older databases and fills them from the messages."""
+    columns = {column["name"] for column in inspect(engine).get_columns("chat_sessions")}
+    if "message_count" in columns:
+        return
+    sessions, messages = ChatSession.__table__, Message.__table__
+    last_message = lambda column: (
+        select(column).where(messages.c.session_id == sessions.c.id)
+        .order_by(messages.c.timestamp.desc(), messages.c.id.desc()).limit(1).scalar_subquery()
+    )
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE chat_sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0"))
+        connection.execute(text("ALTER TABLE chat_sessions ADD COLUMN last_message_at TIMESTAMP"))
+        connection.execute(text(f"ALTER TABLE chat_sessions ADD COLUMN last_message_preview VARCHAR({PREVIEW_LENGTH})"))
+        connection.execute(sessions.update().values(
+            message_count=select(func.count()).where(messages.c.session_id == sessions.c.id).scalar_subquery(),
+            last_message_at=func.coalesce(last_message(messages.c.timestamp), sessions.c.created_at),
+            last_message_preview=func.substr(last_message(messages.c.content), 1, PREVIEW_LENGTH),
+        ))
+    print("Added the activity summary to the chat_sessions table.")
+
+def migrate_session_archival():
+    """Adds the `archived_at` and `message_epoch` columns to the `chat_sessions` of older databases."""
+    columns = {column["name"] for column in inspect(engine).get_columns("chat_sessions")}
+    with engine.begin() as connection:
+        if "archived_at" not in columns:
+            connection.execute(text("ALTER TABLE chat_sessions ADD COLUMN archived_at TIMESTAMP"))
+        if "message_epoch" not in columns:
+            connection.execute(text("ALTER TABLE chat_sessions ADD COLUMN message_epoch INTEGER NOT NULL DEFAULT 0"))
+
+# Full-text index of the message contents (see backend/db/search.py)
+SEARCH_TABLE = "messages_fts" # SQLite: FTS5 table over `messages.content`, kept in sync by triggers
+SEARCH_INDEX = "ft_messages_content" # MySQL: FULLTEXT index of `messages.content`, kept in sync by InnoDB
+
+def create_search_index():
+    """Creates the full-text index of the messages if it does not exist, and fills it with the stored messages."""
+    if engine.dialect.name == "sqlite":
+        if SEARCH_TABLE in inspect(engine).get_table_names():
+            return
+        with engine.begin() as connection:
+            # External content table: the index holds no copy of the text, `snippet()` reads it from `messages`
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+                "content, content='messages', content_rowid='id', tokenize='porter unicode61 remove_diacritics 2')"
+            ))
+            connection.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert AFTER INSERT ON messages BEGIN "
+                f"INSERT INTO {SEARCH_TABLE}(rowid, content) VALUES (new.id, new.content); END"
+            ))
+            connection.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete AFTER DELETE ON messages BEGIN "
+                f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, content) VALUES ('delete', old.id, old.content); END"
+            ))
+            connection.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update AFTER UPDATE OF content ON messages BEGIN "
+                f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, content) VALUES ('delete', old.id, old.content); "
+                f"INSERT INTO {SEARCH_TABLE}(rowid, content) VALUES (new.id, new.content); END"
+            ))
+            connection.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')")) # Existing messages
+        print(f"Created the {SEARCH_TABLE} full-text index.")
+    elif engine.dialect.name == "mysql":
+        if SEARCH_INDEX in {index["name"] for index in inspect(engine).get_indexes("messages")}:
+            return
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE messages ADD FULLTEXT INDEX {SEARCH_INDEX} (content)"))
+        print(f"Created the {SEARCH_INDEX} full-text index.")
+
 def get_db():
     """FastAPI dependency to get a DB session."""
     db = SessionLocal()
@@ -26,6 +26,10 @@ class CitationResponse(CitationBase):
     class Config:
         from_attributes = True # Enable ORM mode
 
+class CitationExpanded(CitationResponse):
+    # Citation with its documents embedded (`?expand=documents`)
+    documents: List[Dict[str, Any]] = Field(..., description="The cited documents, in the order of doc_ids")
+
 # --- Base Models ---
 class MessageBase(BaseModel):
     role: str = Field(..., description="Role of the message sender ('user' or 'assistant')")
@@ -48,6 +52,20 @@ class MessageResponse(MessageBase):
     class Config:
         from_attributes = True # Enable ORM mode for SQLAlchemy model conversion
 
+class TurnResponse(MessageResponse):
+    # Assistant message of a chat turn, with the stored user message, so clients can append both without a refetch
+    user_message: MessageResponse = Field(..., description="The user message of the turn, as stored")
+    message_epoch: int = Field(0, description="Message epoch of the session: if it changed, reload the session instead")
+
+class MessageSearchResult(BaseModel):
+    id: int = Field(..., description="ID of the matching message")
+    session_id: str
+    session_title: str
+    role: str
+    timestamp: Optional[datetime.datetime] = None
+    snippet: str = Field(..., description="HTML excerpt of the message, with the matching words in <mark> tags")
+    score: float = Field(..., description="Relevance (higher is better; comparable within one search only)")
+
 # --- Chat Session Models ---
 class ChatSessionBase(BaseModel):
     title: str = Field(..., description="Title of the chat session")
@@ -56,10 +74,20 @@ class ChatSessionCreate(BaseModel):
     # Optional title when creating a session
     title: Optional[str] = Field(None, description="Optional initial title for the chat session")
 
+class SessionIdsRequest(BaseModel):
+    session_ids: List[str] = Field(..., description="IDs of the chat sessions")
+
+class SessionsDeletedResponse(BaseModel):
+    deleted: int = Field(..., description="Number of chat sessions deleted")
+
 class ChatSessionResponse(ChatSessionBase):
     # Fields returned in API responses for chat sessions
     id: str
     created_at: datetime.datetime
+    last_message_at: Optional[datetime.datetime] = Field(None, description="Time of the last message (creation time if none)")
+    message_count: int = Field(0, description="Number of stored messages")
+    last_message_preview: Optional[str] = Field(None, description="Beginning of the last message")
+    message_epoch: int = Field(0, description="Changes when the message IDs of the session change (reload it)")
 
     class Config:
         from_attributes = True # Enable ORM mode
@@ -1,4 +1,5 @@
 import os
+import hashlib
 # import uuid
 import typing as tp
 from unstructured.partition.html import partition_html
@@ -35,16 +36,53 @@ class MYSQL:
         return engine
     
     @staticmethod
-    def create_and_init_db(database_name: str = "ecommerce_faq"):
-        """Create a (new) database and initialize it."""
-        
+    def sql_file_path(database_name: str) -> str:
+        """Path of the SQL script that creates and fills a database."""
         if database_name == "ecommerce_faq":
-            sql_file_path = os.path.join(WORKING_DIR, "ecommerce-faq-database_mysql.sql")
+            return os.path.join(WORKING_DIR, "ecommerce-faq-database_mysql.sql")
         elif database_name == "ecommerce_ticketing":
-            sql_file_path = os.path.join(WORKING_DIR, "ecommerce-ticket-database-sql_mysql.sql")
-        else:
-            raise ValueError(f"Unknown database name: {database_name}. Use 'ecommerce_faq' or 'ecommerce_ticketing'.")
+            return os.path.join(WORKING_DIR, "ecommerce-ticket-database-sql_mysql.sql")
+        raise ValueError(f"Unknown database name: {database_name}. Use 'ecommerce_faq' or 'ecommerce_ticketing'.")
+
+    @staticmethod
+    def init_db_if_changed(database_name: str = "ecommerce_faq", force: bool = False) -> bool:
+        """Create and initialize a database only if its SQL script changed since the last init.
+
+        `create_and_init_db` drops the database, so it only runs when the checksum of the script
+        differs from the one stored in the `init_meta` table of the database (or the database is missing).
+
+        Returns:
+            bool: Whether the database was (re)initialized.
+        """
+        with open(MYSQL.sql_file_path(database_name), 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+
+        engine = create_engine(f"mysql+mysqlconnector://{USER}:{PASSWORD}@{HOST}:{PORT}/")
+        applied = None
+        with engine.connect() as connection:
+            try:
+                applied = connection.execute(text(f"SELECT checksum FROM {database_name}.init_meta WHERE id = 1")).scalar()
+            except Exception: # Database or table missing
+                pass
+        if applied == checksum and not force:
+            logger.info(f"Database {database_name} is up to date (checksum {checksum[:12]}), skipping init.")
+            return False
+
+        MYSQL.create_and_init_db(database_name)
+        with engine.begin() as connection:
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {database_name}.init_meta "
+                "(id INT PRIMARY KEY, checksum CHAR(64) NOT NULL, applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)"
+            ))
+            connection.execute(text(f"REPLACE INTO {database_name}.init_meta (id, checksum) VALUES (1, :checksum)"),
+                               {"checksum": checksum})
+        return True
+
+    @staticmethod
+    def create_and_init_db(database_name: str = "ecommerce_faq"):
+        """Create a (new) database and initialize it."""
         
+        sql_file_path = MYSQL.sql_file_path(database_name)
         logger.info(f"Reading SQL file: {sql_file_path}")
         with open(sql_file_path, 'r', encoding='utf-8') as f:
             sql_script = f.read()
@@ -95,18 +133,23 @@ class MYSQL:
             result = connection.execute(text(query))
             rows = result.fetchall()
         
-        documents = []
-        for i, row in tqdm(enumerate(rows), desc="Loading FAQ data", total=len(rows)):
-            documents.append({
-                "title": "Ecommerce FAQ",
-                "text": f"Question: {row[1]}\nAnswer: {row[2]}",
-                "category_id": row[0],
-                "id": i 
-                })
-            
+        documents = MYSQL.faq_documents(rows)
         logger.info(f"Loaded {len(documents)} Ecommerce FAQ documents")
             
         return documents
+
+    @staticmethod
+    def faq_documents(rows: tp.Sequence[tp.Sequence[tp.Any]]) -> tp.List[tp.Dict[str, tp.Any]]:
+        """Shapes `(category_id, question, answer)` rows of `faq_items` into FAQ documents (IDs in row order)."""
+        return [
+            {
+                "title": "Ecommerce FAQ",
+                "text": f"Question: {question}\nAnswer: {answer}",
+                "category_id": category_id,
+                "id": i,
+            }
+            for i, (category_id, question, answer) in enumerate(rows)
+        ]
         
     def load_ticketing_data():
         """Load Ecommerce Ticketing data from the MySQL database
@@ -0,0 +1,43 @@
+# pagination.py
+import base64
+import datetime
+import json
+from typing import Any, List, Optional, Tuple
+
+# Response header carrying the cursor of the next page (absent on the last page)
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(timestamp: Optional[datetime.datetime], row_id: Any) -> str:
+    """Encodes the (timestamp, id) position of the last row of a page as an opaque cursor."""
+    payload = json.dumps([timestamp.isoformat() if timestamp else None, row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime.datetime], Any]:
+    """Decodes a cursor made by `encode_cursor`. Raises ValueError if it is malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return (datetime.datetime.fromisoformat(timestamp) if timestamp else None), row_id
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def encode_score_cursor(score: float, row_id: Any) -> str:
+    """Cursor of the last row of a page of results ranked by (score, id), e.g. search results."""
+    payload = json.dumps([score, row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_score_cursor(cursor: str) -> Tuple[float, Any]:
+    """Decodes a cursor made by `encode_score_cursor`. Raises ValueError if it is malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        score, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return float(score), row_id
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def next_cursor(rows: List[Any], limit: int, timestamp_attr: Optional[str] = None) -> Optional[str]:
+    """Cursor of the page following `rows`, or None if `rows` is the last page."""
+    if len(rows) < limit or not rows:
+        return None
+    last = rows[-1]
+    return encode_cursor(getattr(last, timestamp_attr) if timestamp_attr else None, last.id)
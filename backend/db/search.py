@@ -0,0 +1,140 @@
+"""Full-text search of the chat messages.
+
+- SQLite: FTS5 table `messages_fts` over `messages.content` (Porter stemming: "refunds" finds "refund"),
+  kept in sync by triggers on `messages`, ranked by BM25, snippets from FTS5 `snippet()`.
+- MySQL: FULLTEXT index of `messages.content` (InnoDB keeps it in sync), ranked by `MATCH ... AGAINST`
+  relevance; snippets are cut around the first match here. Words shorter than `innodb_ft_min_token_size`
+  (3 by default) and stopwords are not indexed.
+Both are created by `database.create_search_index` on startup.
+
+Every word of the query must match. Words are not matched as prefixes: ranking a prefix query scores
+every word it expands to, which is orders of magnitude slower on a large index. Results are ordered by
+relevance, then by message ID, and paginated by keyset cursor on (score, ID): no OFFSET scans.
+Only stored, hot messages are searched: turns still in the write-behind queue appear once written,
+and archived sessions (see archive.py) once restored.
+"""
+import re
+import html
+import typing as tp
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.core.tracing import traced
+from backend.db import database, pagination
+
+MAX_TERMS = 16
+SNIPPET_TOKENS = 16 # SQLite: words around the matches
+SNIPPET_CHARS = 160 # MySQL: characters around the first match
+# Highlight markers, swapped for <mark> tags once the snippet is HTML-escaped
+MARK_OPEN, MARK_CLOSE = "\x02", "\x03"
+ELLIPSIS = "…"
+
+
+class SearchUnavailable(Exception):
+    """The database has no full-text index (unsupported backend, or SQLite without FTS5)."""
+
+
+def query_terms(query: str) -> tp.List[str]:
+    """Words of a search query (operators and punctuation are not interpreted)."""
+    return re.findall(r"\w+", query.lower())[:MAX_TERMS]
+
+def _fts5_query(terms: tp.List[str]) -> str:
+    return " ".join(f'"{term}"' for term in terms)
+
+def _boolean_mode_query(terms: tp.List[str]) -> str:
+    return " ".join(f"+{term}" for term in terms)
+
+def _statement(dialect: str, terms: tp.List[str], session_id: tp.Optional[str], cursor: tp.Optional[str], limit: int):
+    """Search statement for a database backend, and its parameters."""
+    params: tp.Dict[str, tp.Any] = {"limit": limit}
+    filters = ""
+    if session_id:
+        filters += " AND m.session_id = :session_id"
+        params["session_id"] = session_id
+    if cursor:
+        params["score"], params["after_id"] = pagination.decode_score_cursor(cursor)
+
+    if dialect == "sqlite":
+        # FTS5 rank: BM25, lower is better
+        if cursor:
+            filters += f" AND ({database.SEARCH_TABLE}.rank > :score OR ({database.SEARCH_TABLE}.rank = :score AND m.id > :after_id))"
+        params.update(query=_fts5_query(terms), mark_open=MARK_OPEN, mark_close=MARK_CLOSE, ellipsis=ELLIPSIS, tokens=SNIPPET_TOKENS)
+        sql = f"""
+            SELECT m.id, m.session_id, s.title AS session_title, m.role, m.timestamp,
+                   snippet({database.SEARCH_TABLE}, 0, :mark_open, :mark_close, :ellipsis, :tokens) AS snippet,
+                   {database.SEARCH_TABLE}.rank AS sort_key
+            FROM {database.SEARCH_TABLE}
+            JOIN messages m ON m.id = {database.SEARCH_TABLE}.rowid
+            JOIN chat_sessions s ON s.id = m.session_id
+            WHERE {database.SEARCH_TABLE} MATCH :query{filters}
+            ORDER BY {database.SEARCH_TABLE}.rank, m.id
+            LIMIT :limit
+        """
+    elif dialect == "mysql":
+        # MATCH relevance: higher is better; negated so that both backends sort ascending
+        match = "MATCH(m.content) AGAINST (:query IN BOOLEAN MODE)"
+        if cursor:
+            filters += f" AND (-{match} > :score OR (-{match} = :score AND m.id > :after_id))"
+        params["query"] = _boolean_mode_query(terms)
+        sql = f"""
+            SELECT m.id, m.session_id, s.title AS session_title, m.role, m.timestamp,
+                   m.content AS snippet, -{match} AS sort_key
+            FROM messages m
+            JOIN chat_sessions s ON s.id = m.session_id
+            WHERE {match}{filters}
+            ORDER BY sort_key, m.id
+            LIMIT :limit
+        """
+    else:
+        raise SearchUnavailable(f"Full-text search is not available on {dialect}")
+    return text(sql).columns(timestamp=database.Timestamp), params
+
+def _cut_snippet(content: str, terms: tp.List[str]) -> str:
+    """Window of `content` around the first match, with the matches between markers."""
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(term) for term in terms) + r")\w*", re.IGNORECASE)
+    first = pattern.search(content)
+    start = max((first.start() if first else 0) - SNIPPET_CHARS // 4, 0)
+    window = content[start:start + SNIPPET_CHARS]
+    window = pattern.sub(lambda match: f"{MARK_OPEN}{match.group(0)}{MARK_CLOSE}", window)
+    return (ELLIPSIS if start else "") + window + (ELLIPSIS if start + SNIPPET_CHARS < len(content) else "")
+
+def _highlight(snippet: str) -> str:
+    """HTML of a snippet: escaped text, matches in <mark> tags."""
+    return html.escape(snippet).replace(MARK_OPEN, "<mark>").replace(MARK_CLOSE, "</mark>")
+
+@traced("db.search_messages")
+async def search_messages(
+    db: AsyncSession, query: str, session_id: tp.Optional[str] = None, cursor: tp.Optional[str] = None, limit: int = 20
+) -> tp.Tuple[tp.List[dict], tp.Optional[str]]:
+    """
+    A page of the messages matching `query` (in one session, or in all of them), best first,
+    starting after `cursor`. Returns the results and the cursor of the next page (None on the last page).
+    Raises ValueError for an empty query or a malformed cursor, `SearchUnavailable` without a full-text index.
+    """
+    terms = query_terms(query)
+    if not terms:
+        raise ValueError("The search query has no words")
+    dialect = db.bind.dialect.name
+    statement, params = _statement(dialect, terms, session_id, cursor, limit)
+    try:
+        rows = (await db.execute(statement, params)).mappings().all()
+    except OperationalError as e:
+        if database.SEARCH_TABLE in str(e) or "fts5" in str(e): # e.g. SQLite built without FTS5
+            raise SearchUnavailable("The full-text index of the messages is missing") from e
+        raise
+    results = [
+        {
+            "id": row["id"],
+            "session_id": row["session_id"],
+            "session_title": row["session_title"],
+            "role": row["role"],
+            "timestamp": row["timestamp"],
+            "snippet": _highlight(row["snippet"] if dialect == "sqlite" else _cut_snippet(row["snippet"], terms)),
+            "score": -row["sort_key"],
+        }
+        for row in rows
+    ]
+    next_cursor = pagination.encode_score_cursor(rows[-1]["sort_key"], rows[-1]["id"]) if len(rows) == limit else None
+    return results, next_cursor
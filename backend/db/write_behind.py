@@ -0,0 +1,384 @@
+"""Write-behind persistence of chat turns.
+
+A turn (user message, assistant message and its citations) is appended to a local append-only log
+and acknowledged right away; a background worker writes the logged turns to the `messages`,
+`citations` and `citation_documents` tables in batches (one transaction per batch).
+
+- IDs and timestamps are assigned when the turn is logged, so the response does not wait for the DB.
+  The ID allocator lives in the process: write-behind needs a single API worker process.
+- The log is the source of truth until a batch commits. A checkpoint file holds the sequence number
+  of the last flushed turn; on startup, logged turns after the checkpoint are replayed. Replaying a
+  turn that was committed just before a crash is a no-op (see `crud.insert_turns`).
+- Reads see the turns that are not flushed yet through `pending_messages` / `pending_citation`.
+- A batch that the database rejects is retried turn by turn. A turn rejected on its own (constraint
+  violation, bad data) is moved to the dead-letter file `<log>.dead` (with the error), so that it does
+  not block the turns behind it. Connection-level errors (database down, locked, pool timeout) leave
+  everything pending for the next flush.
+"""
+import os
+import json
+import threading
+import datetime
+import typing as tp
+from collections import OrderedDict
+
+from sqlalchemy import exc, func
+
+from backend.core.config import (
+    WRITE_BEHIND_LOG,
+    WRITE_BEHIND_BATCH,
+    WRITE_BEHIND_INTERVAL,
+    WRITE_BEHIND_FSYNC,
+)
+from backend.core.metrics import Counter, Gauge
+from backend.db import archive, crud, database, models
+
+import logging
+logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEAD_LETTERS = Counter("write_behind_dead_letters_total", "Chat turns the database rejected, moved to the dead-letter file")
+
+def _is_transient(error: Exception) -> bool:
+    """Whether a failed write may succeed as is later (database unreachable, locked, busy), rather than being rejected for its data."""
+    if isinstance(error, exc.DBAPIError):
+        return isinstance(error, (exc.OperationalError, exc.InterfaceError)) or error.connection_invalidated
+    return isinstance(error, (exc.TimeoutError, OSError)) # Pool timeout, network
+
+
+class WriteBehindQueue:
+    """Durable queue of chat turns waiting to be written to the database."""
+    def __init__(self, log_path: str = WRITE_BEHIND_LOG, batch_size: int = WRITE_BEHIND_BATCH,
+                 interval: float = WRITE_BEHIND_INTERVAL, fsync: bool = WRITE_BEHIND_FSYNC):
+        self.log_path = log_path
+        self.checkpoint_path = f"{log_path}.checkpoint"
+        self.dead_letter_path = f"{log_path}.dead"
+        self.batch_size = batch_size
+        self.interval = interval
+        self.fsync = fsync
+        self._pending: "OrderedDict[int, dict]" = OrderedDict() # seq -> logged turn, in log order
+        self._by_session: tp.Dict[str, tp.List[dict]] = {} # session ID -> pending turns
+        self._citations: tp.Dict[int, dict] = {} # citation ID -> pending citation
+        self._next_seq = 1
+        self._next_message_id = 1
+        self._next_citation_id = 1
+        self._log = None
+        self._lock = threading.Lock() # Pending state, ID allocation and log appends
+        self._flush_lock = threading.Lock() # A single flush at a time
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._worker: tp.Optional[threading.Thread] = None
+
+    @property
+    def started(self) -> bool:
+        return self._log is not None
+
+    # --- Lifecycle ---
+
+    def start(self) -> None:
+        """Replays the unflushed turns of the log, then starts the background flusher."""
+        if self.started:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+        checkpoint = self._read_checkpoint()
+        self._repair_log()
+        replayed = [turn for turn in self._read_log() if turn["seq"] > checkpoint]
+        for turn in replayed:
+            self._add_pending(turn)
+        self._next_seq = max([checkpoint] + [turn["seq"] for turn in replayed]) + 1
+        self._seed_ids(replayed)
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        if replayed:
+            logger.info(f"Replaying {len(replayed)} unflushed chat turns from {self.log_path}.")
+            self.flush()
+
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._worker.start()
+
+    def stop(self) -> None:
+        """Stops the flusher after writing every pending turn it can to the database."""
+        if not self.started:
+            return
+        self._stop.set()
+        self._wake.set()
+        if self._worker is not None:
+            self._worker.join()
+        self.flush()
+        with self._lock:
+            self._log.close()
+            self._log = None
+
+    # --- Hot path ---
+
+    def submit(
+        self, session_id: str, user_message: models.MessageCreate,
+        assistant_message: tp.Optional[models.MessageCreate] = None, citations: tp.Optional[tp.List[tp.Dict[str, tp.Any]]] = None
+    ) -> tp.Tuple[models.MessageResponse, tp.Optional[models.MessageResponse]]:
+        """
+        Logs a chat turn and returns its user and assistant messages as they will be stored.
+        Without `assistant_message` (the answer failed), only the user message is logged.
+        The turn is durable when this returns; it reaches the database with the next flush.
+        """
+        if not self.started:
+            raise RuntimeError("The write-behind queue is not started")
+        # Naive UTC, like the CURRENT_TIMESTAMP server default of the timestamp columns
+        timestamp = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None).isoformat()
+        with self._lock:
+            user_id, assistant_id = self._next_message_id, self._next_message_id + 1
+            self._next_message_id += 2
+            turn_citations = []
+            for citation in citations or []:
+                turn_citations.append({
+                    "id": self._next_citation_id,
+                    "msg_id": assistant_id,
+                    "text": citation["text"],
+                    "start": citation["start"],
+                    "end": citation["end"],
+                    "doc_ids": [str(doc_id) for doc_id in dict.fromkeys(citation["document_ids"])], # Unique, in order
+                })
+                self._next_citation_id += 1
+            messages = [self._message_record(user_id, session_id, user_message, timestamp, [])]
+            if assistant_message is not None:
+                messages.append(self._message_record(assistant_id, session_id, assistant_message, timestamp, turn_citations))
+            turn = {"seq": self._next_seq, "session_id": session_id, "messages": messages}
+            self._next_seq += 1
+            # Appends are serialized by the lock, so the log order is the sequence order
+            self._log.write(json.dumps(turn, separators=(",", ":")) + "\n")
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+            self._add_pending(turn)
+            full_batch = len(self._pending) >= self.batch_size
+
+        if full_batch:
+            self._wake.set()
+        user, assistant = (turn["messages"] + [None])[:2]
+        return models.MessageResponse(**user), (models.MessageResponse(**assistant) if assistant else None)
+
+    def pending_count(self) -> int:
+        """Number of turns not in the database yet."""
+        with self._lock:
+            return len(self._pending)
+
+    # --- Read-your-writes overlay ---
+
+    def pending_messages(self, session_id: str) -> tp.List[models.MessageResponse]:
+        """Messages of a session that are not in the database yet, oldest first."""
+        with self._lock:
+            turns = list(self._by_session.get(session_id, ()))
+        return [models.MessageResponse(**message) for turn in turns for message in turn["messages"]]
+
+    def pending_message(self, msg_id: int) -> tp.Optional[models.MessageResponse]:
+        """A message that is not in the database yet, if any."""
+        with self._lock:
+            turns = list(self._pending.values())
+        for turn in turns:
+            for message in turn["messages"]:
+                if message["id"] == msg_id:
+                    return models.MessageResponse(**message)
+        return None
+
+    def pending_citation(self, citation_id: int) -> tp.Optional[models.CitationResponse]:
+        """A citation that is not in the database yet, if any."""
+        with self._lock:
+            citation = self._citations.get(citation_id)
+        return models.CitationResponse(**citation) if citation else None
+
+    def pending_citations_of_message(self, msg_id: int) -> tp.List[models.CitationResponse]:
+        """Citations of a message that are not in the database yet, in ID order."""
+        with self._lock:
+            citations = [citation for citation in self._citations.values() if citation["msg_id"] == msg_id]
+        return [models.CitationResponse(**citation) for citation in sorted(citations, key=lambda c: c["id"])]
+
+    def discard_sessions(self, session_ids: tp.Iterable[str]) -> int:
+        """
+        Drops the pending turns of deleted sessions, so that they are not written. Returns how many.
+        The log keeps them until it is truncated: a replay skips them, like a turn that is being
+        flushed while its session is deleted (see `crud.insert_turns`).
+        """
+        with self._lock:
+            turns = [turn for session_id in set(session_ids) for turn in self._by_session.get(session_id, [])]
+            for turn in turns:
+                self._remove_pending(turn)
+            if turns and not self._pending and self._log is not None:
+                self._log.truncate(0)
+        return len(turns)
+
+    # --- Flushing ---
+
+    def flush(self) -> int:
+        """Writes the pending turns to the database, in batches. Returns the number of turns written."""
+        flushed = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = list(self._pending.values())[:self.batch_size]
+                if not batch:
+                    break
+                done, written = self._write_batch(batch)
+                if done:
+                    with self._lock:
+                        for turn in done:
+                            self._remove_pending(turn)
+                        self._write_checkpoint(done[-1]["seq"])
+                        if not self._pending and self._log is not None:
+                            self._log.truncate(0) # Everything is in the DB, the log can start over
+                flushed += written
+                if len(done) < len(batch): # The database is unavailable: retry later
+                    break
+        return flushed
+
+    def _write_batch(self, batch: tp.List[dict]) -> tp.Tuple[tp.List[dict], int]:
+        """
+        Writes a batch of turns. Returns the turns that are done with, written or dead-lettered
+        (a prefix of the batch, so that the checkpoint stays exact), and the number written.
+        """
+        try:
+            self._insert(batch)
+            return batch, len(batch)
+        except Exception as e:
+            if _is_transient(e):
+                logger.error(f"Error flushing {len(batch)} chat turns, retrying later: {e}")
+                return [], 0
+            logger.error(f"Error flushing {len(batch)} chat turns, retrying them one by one: {e}")
+        done, written = [], 0
+        for turn in batch:
+            try:
+                self._insert([turn])
+                written += 1
+            except Exception as e:
+                if _is_transient(e):
+                    logger.error(f"Error flushing chat turn {turn['seq']}, retrying later: {e}")
+                    break
+                self._dead_letter(turn, e)
+            done.append(turn)
+        return done, written
+
+    def _insert(self, turns: tp.List[dict]) -> None:
+        db = database.SessionLocal()
+        try:
+            crud.insert_turns(db, turns)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _dead_letter(self, turn: dict, error: Exception) -> None:
+        logger.error(
+            f"Chat turn {turn['seq']} of session {turn['session_id']} was rejected by the database, "
+            f"moving it to {self.dead_letter_path}: {type(error).__name__}: {error}"
+        )
+        with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"turn": turn, "error": f"{type(error).__name__}: {error}"}, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        DEAD_LETTERS.inc()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    # --- Helpers ---
+
+    @staticmethod
+    def _message_record(message_id: int, session_id: str, message: models.MessageCreate,
+                        timestamp: str, citations: tp.List[dict]) -> dict:
+        return {
+            "id": message_id,
+            "session_id": session_id,
+            "role": message.role,
+            "content": message.content,
+            "timestamp": timestamp,
+            "ai_model": message.ai_model,
+            "link": message.link,
+            "citations": citations,
+        }
+
+    def _add_pending(self, turn: dict) -> None:
+        self._pending[turn["seq"]] = turn
+        self._by_session.setdefault(turn["session_id"], []).append(turn)
+        for message in turn["messages"]:
+            for citation in message["citations"]:
+                self._citations[citation["id"]] = citation
+
+    def _remove_pending(self, turn: dict) -> None:
+        self._pending.pop(turn["seq"], None)
+        session_turns = self._by_session.get(turn["session_id"], [])
+        if turn in session_turns:
+            session_turns.remove(turn)
+        if not session_turns:
+            self._by_session.pop(turn["session_id"], None)
+        for message in turn["messages"]:
+            for citation in message["citations"]:
+                self._citations.pop(citation["id"], None)
+
+    def _seed_ids(self, replayed: tp.List[dict]) -> None:
+        """Next IDs: after the largest ID in the database (hot or archived) or in the replayed turns."""
+        db = database.SessionLocal()
+        try:
+            archived_message_id, archived_citation_id = archive.max_archived_ids(db)
+            max_message_id = max(db.query(func.max(database.Message.id)).scalar() or 0, archived_message_id)
+            max_citation_id = max(db.query(func.max(database.Citation.id)).scalar() or 0, archived_citation_id)
+        finally:
+            db.close()
+        for turn in replayed:
+            for message in turn["messages"]:
+                max_message_id = max(max_message_id, message["id"])
+                for citation in message["citations"]:
+                    max_citation_id = max(max_citation_id, citation["id"])
+        self._next_message_id = max_message_id + 1
+        self._next_citation_id = max_citation_id + 1
+
+    def _repair_log(self) -> None:
+        """
+        Cuts a torn last entry off the log: an append interrupted by a crash, never acknowledged.
+        Otherwise the next append would continue its line, and both entries would be unreadable.
+        """
+        try:
+            with open(self.log_path, "rb+") as f:
+                data = f.read()
+                end = data.rfind(b"\n") + 1
+                if end < len(data):
+                    logger.error(f"Removing a truncated entry at the end of {self.log_path}.")
+                    f.truncate(end)
+                    f.flush()
+                    os.fsync(f.fileno())
+        except FileNotFoundError:
+            return
+
+    def _read_log(self) -> tp.List[dict]:
+        if not os.path.exists(self.log_path):
+            return []
+        turns = []
+        with open(self.log_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    turns.append(json.loads(line))
+                except json.JSONDecodeError: # A torn last entry is removed by `_repair_log` first
+                    logger.error(f"Skipping a corrupt entry of {self.log_path}.")
+        return turns
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_checkpoint(self, seq: int) -> None:
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path) # Atomic
+
+
+# Shared queue, started on application startup when WRITE_BEHIND is enabled
+queue = WriteBehindQueue()
+
+Gauge("write_behind_pending_turns", "Chat turns logged but not written to the database yet", function=queue.pending_count)
@@ -1,20 +1,43 @@
 # main.py
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.concurrency import run_in_threadpool
 
 from backend.db.database import create_db_and_tables #, populate_initial_citations
-from backend.api import chat, citation # Import router objects
+from backend.api import chat, citation, documents, messages, metrics, profiles # Import router objects
+from backend.core import profiling, tracing
+from backend.core.instrumentation import HTTP_REQUEST_SECONDS
+from backend.core.warmup import retrieval
+from backend.core.config import GZIP_MIN_SIZE, SERVER_TIMING, WRITE_BEHIND
+from backend.db import archive, write_behind
 
 import os
+import time
 from dotenv import load_dotenv
 env_path = os.path.abspath(".env")
 # print("Loading .env from:", env_path)
 load_dotenv(env_path)
 
-# Create DB tables on startup if they don't exist
-create_db_and_tables()
-# Populate initial citation data if needed
-# populate_initial_citations()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Fast startup: only the cheap, idempotent setup runs before the server binds."""
+    # Create DB tables on startup if they don't exist
+    create_db_and_tables()
+    # Replay the chat turns logged but not written to the DB before the last shutdown/crash
+    if WRITE_BEHIND:
+        write_behind.queue.start()
+    # Populate initial citation data if needed
+    # populate_initial_citations()
+    # FAQ database, embeddings and index are loaded in the background (see /readyz)
+    retrieval.start()
+    # Move the sessions idle for ARCHIVE_AFTER_DAYS out of the hot tables, periodically
+    archive.archiver.start()
+    yield
+    archive.archiver.stop()
+    # Write the chat turns still in the write-behind queue to the DB
+    write_behind.queue.stop()
 
 
 # Initialize FastAPI app
@@ -22,6 +45,7 @@ app = FastAPI(
     title="Chat App Backend API",
     description="API for managing chat sessions, messages, and citations.",
     version="0.1.0",
+    lifespan=lifespan,
 )
 BACKEND_PORT= int(os.getenv("BACKEND_PORT", 8000)) # Default to 8000 if PORT not set in .env
 # print(f"Port used: {BACKEND_PORT} \t{os.environ['BACKEND_PORT']}")
@@ -44,9 +68,71 @@ app.add_middleware(
     allow_headers=["*"], # Allows all headers
 )
 
+# --- Compression ---
+# Large responses (e.g. long message histories) are gzipped for clients that accept it
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)
+
+# --- Server-Timing ---
+@app.middleware("http")
+async def server_timing_header(request: Request, call_next):
+    """Adds the per-stage durations of the request as a `Server-Timing` header, when enabled."""
+    if not (SERVER_TIMING or request.headers.get("x-server-timing") == "1"):
+        return await call_next(request)
+    trace = tracing.start_trace()
+    response = await call_next(request)
+    response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+# --- Per-request profiling ---
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    """Profiles the request when it carries a valid signed `X-Profile` header (see backend/core/profiling.py)."""
+    header = request.headers.get(profiling.PROFILE_HEADER)
+    if header is None or request.url.path.startswith(profiles.router.prefix):
+        return await call_next(request)
+    if not profiling.verify(header, request.method, request.url.path):
+        response = await call_next(request)
+        response.headers[profiling.PROFILE_STATUS_HEADER] = "invalid"
+        return response
+    capture = profiling.profiler.begin()
+    if capture is None: # Every profiling slot is taken: serve the request unprofiled
+        response = await call_next(request)
+        response.headers[profiling.PROFILE_STATUS_HEADER] = "busy"
+        return response
+    try:
+        response = await call_next(request)
+    finally:
+        profile_id = await run_in_threadpool(profiling.profiler.end, capture)
+    if profile_id:
+        response.headers[profiling.PROFILE_ID_HEADER] = profile_id
+    response.headers[profiling.PROFILE_STATUS_HEADER] = "saved" if profile_id else "empty"
+    return response
+
+# --- Request metrics ---
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Records the latency of every request per route template and status (see GET /metrics)."""
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        # Route templates, not raw paths (session IDs would make a series per session)
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - start, method=request.method,
+            route=getattr(route, "path", "unmatched"), status=status_code,
+        )
+
 # --- Include Routers ---
 app.include_router(chat.router)
 app.include_router(citation.router)
+app.include_router(messages.router)
+app.include_router(documents.router)
+app.include_router(metrics.router)
+app.include_router(profiles.router)
 
 # --- Root Endpoint (Optional) ---
 @app.get("/")
@@ -54,6 +140,20 @@ async def read_root():
     """Simple root endpoint to check if the API is running."""
     return {"message": "Welcome to the Chat App Backend API!"}
 
+# --- Probes ---
+@app.get("/healthz")
+async def healthz():
+    """Liveness probe: the process is up and serving requests."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz(response: Response):
+    """Readiness probe: 200 once the retrieval engine is loaded, 503 while it is warming up."""
+    if retrieval.ready:
+        return {"status": "ready", "warmup_seconds": retrieval.warmup_seconds}
+    response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": "warming_up", "error": retrieval.error}
+
 if __name__ == "__main__":
     # Active .venv and run `python .\backend\main.py`
     import uvicorn
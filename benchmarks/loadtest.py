@@ -0,0 +1,216 @@
+"""Load test of the backend API: chat turns, history reads and citation fetches under concurrency.
+
+Run from the project root:
+- in-process (nothing else needed): the app runs in this process with the synthetic LLM provider,
+  a fresh SQLite database and an index of the FAQ corpus of `ecommerce-faq-database_mysql.sql`
+  `PYTHONPATH=. python benchmarks/loadtest.py --sessions 50 --turns 4 --rate 5`
+- against a running server: `PYTHONPATH=. python benchmarks/loadtest.py --url http://localhost:8000`
+
+Sessions arrive at `--rate` per second (Poisson arrivals, open loop: arrivals do not wait for slow
+responses) and each replays a conversation of `--turns` FAQ questions. After each answer, the client
+reads the session history and fetches the citations of the answer with their documents.
+The report (JSON) has, per operation: count, error rate, status codes, p50/p95/p99/max latency in ms
+and throughput. Environment variables of the backend (e.g. SYNTHETIC_LATENCY, ADMISSION_MAX_IN_FLIGHT,
+WRITE_BEHIND) apply to the in-process app.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+import typing as tp
+from collections import Counter, defaultdict
+
+import httpx
+import sqlparse
+
+FAQ_SQL_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ecommerce-faq-database_mysql.sql")
+FAQ_ROW = re.compile(r"\(\s*(\d+)\s*,\s*'((?:[^']|'')*)'\s*,\s*'((?:[^']|'')*)'\s*\)")
+
+
+def faq_rows_from_sql(path: str = FAQ_SQL_FILE) -> tp.List[tp.Tuple[int, str, str]]:
+    """(category_id, question, answer) rows of the `faq_items` INSERT statements of the SQL script."""
+    with open(path, encoding="utf-8") as f:
+        statements = sqlparse.split(f.read())
+    rows = []
+    for statement in statements:
+        statement = sqlparse.format(statement, strip_comments=True)
+        if re.match(r"\s*INSERT\s+INTO\s+faq_items\b", statement, re.IGNORECASE):
+            for category_id, question, answer in FAQ_ROW.findall(statement):
+                rows.append((int(category_id), question.replace("''", "'"), answer.replace("''", "'")))
+    return rows
+
+
+class Recorder:
+    """Latencies and outcomes per operation."""
+    def __init__(self):
+        self.latencies: tp.Dict[str, tp.List[float]] = defaultdict(list)
+        self.statuses: tp.Dict[str, Counter] = defaultdict(Counter)
+
+    async def request(self, client: httpx.AsyncClient, op: str, method: str, url: str, **kwargs) -> tp.Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except Exception as e: # Transport errors, and app exceptions when the app runs in this process
+            self.statuses[op][f"exception:{type(e).__name__}"] += 1
+            return None
+        self.latencies[op].append(time.perf_counter() - start)
+        self.statuses[op][str(response.status_code)] += 1
+        return response
+
+    def report(self, wall_seconds: float) -> tp.Dict[str, tp.Any]:
+        operations = {}
+        for op in sorted(set(self.latencies) | set(self.statuses)):
+            statuses = self.statuses[op]
+            total = sum(statuses.values())
+            errors = sum(n for status, n in statuses.items() if not status.startswith(("2", "3")))
+            latencies = sorted(self.latencies[op])
+            operations[op] = {
+                "count": total,
+                "errors": errors,
+                "error_rate": round(errors / total, 4) if total else 0.0,
+                "statuses": dict(statuses),
+                "throughput_rps": round(total / wall_seconds, 2) if wall_seconds else 0.0,
+                "latency_ms": {
+                    "mean": _ms(statistics.fmean(latencies)) if latencies else None,
+                    "p50": _ms(_percentile(latencies, 0.50)),
+                    "p95": _ms(_percentile(latencies, 0.95)),
+                    "p99": _ms(_percentile(latencies, 0.99)),
+                    "max": _ms(latencies[-1]) if latencies else None,
+                },
+            }
+        return operations
+
+def _percentile(ordered: tp.List[float], q: float) -> tp.Optional[float]:
+    if not ordered:
+        return None
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)] # Nearest rank
+
+def _ms(seconds: tp.Optional[float]) -> tp.Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+async def run_session(client: httpx.AsyncClient, recorder: Recorder, questions: tp.List[str], think_time: float) -> None:
+    """One user: a new chat session, then one question after the other."""
+    response = await recorder.request(client, "create_session", "POST", "/sessions/", json={"title": "Load test"})
+    if response is None or response.status_code != 201:
+        return
+    session_id = response.json()["id"]
+    for question in questions:
+        response = await recorder.request(
+            client, "send_message", "POST", f"/sessions/{session_id}/messages/", json={"role": "user", "content": question},
+        )
+        if response is not None and response.status_code == 201:
+            answer = response.json()
+            await recorder.request(client, "read_history", "GET", f"/sessions/{session_id}/messages/")
+            if answer.get("citations"):
+                await recorder.request(
+                    client, "message_citations", "GET", f"/messages/{answer['id']}/citations", params={"expand": "documents"},
+                )
+        if think_time:
+            await asyncio.sleep(think_time)
+
+async def run_load(client: httpx.AsyncClient, args, questions: tp.List[str]) -> tp.Dict[str, tp.Any]:
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    tasks, arrival = [], 0.0
+    start = time.perf_counter()
+    for _ in range(args.sessions):
+        delay = arrival - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        script = [rng.choice(questions) for _ in range(args.turns)]
+        tasks.append(asyncio.create_task(run_session(client, recorder, script, args.think_time)))
+        arrival += rng.expovariate(args.rate) if args.rate > 0 else 0.0
+    await asyncio.gather(*tasks)
+    wall_seconds = time.perf_counter() - start
+
+    operations = recorder.report(wall_seconds)
+    turns = operations.get("send_message", {})
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "out"},
+        "wall_seconds": round(wall_seconds, 3),
+        "turns_per_second": round((turns.get("count", 0) - turns.get("errors", 0)) / wall_seconds, 2) if wall_seconds else 0.0,
+        "operations": operations,
+    }
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/readyz")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"The backend was not ready after {timeout}s")
+
+
+def prepare_local_backend(workdir: str) -> None:
+    """Environment of the in-process app: synthetic provider, SQLite and an index of the FAQ corpus.
+    Must run before anything from `backend` is imported (the configuration is read at import)."""
+    os.environ.setdefault("LLM_PROVIDER", "synthetic")
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(workdir, 'loadtest.db')}")
+    os.environ.setdefault("WRITE_BEHIND_LOG", os.path.join(workdir, "turns.log"))
+    if os.getenv("INDEX_DIR"):
+        return
+    os.environ["INDEX_DIR"] = os.path.join(workdir, "index")
+
+    from backend.core import index_store
+    from backend.core.vectorstore import embed_documents, EMBED_MODEL, RERANK_MODEL
+
+    docs = [
+        {"title": "Ecommerce FAQ", "text": f"Question: {question}\nAnswer: {answer}", "category_id": category_id, "id": i}
+        for i, (category_id, question, answer) in enumerate(faq_rows_from_sql())
+    ]
+    index_store.build(docs, embed_documents(docs), os.environ["INDEX_DIR"], embed_model=EMBED_MODEL, rerank_model=RERANK_MODEL)
+
+async def main_async(args) -> tp.Dict[str, tp.Any]:
+    questions = [question for _, question, _ in faq_rows_from_sql()]
+    limits = httpx.Limits(max_connections=args.max_connections)
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+            await wait_until_ready(client, args.ready_timeout)
+            return await run_load(client, args, questions)
+
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+        prepare_local_backend(workdir)
+        from backend.main import app
+
+        async with app.router.lifespan_context(app):
+            # Unhandled app exceptions become 500 responses, as behind a server, instead of raising in the client
+            transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+            async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=args.timeout, limits=limits) as client:
+                await wait_until_ready(client, args.ready_timeout)
+                return await run_load(client, args, questions)
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Base URL of a running backend (default: run the app in this process)")
+    parser.add_argument("--sessions", type=int, default=20, help="Number of simulated users (chat sessions)")
+    parser.add_argument("--turns", type=int, default=3, help="Questions asked per session")
+    parser.add_argument("--rate", type=float, default=5.0, help="Session arrivals per second (0: all at once)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Seconds between the turns of a session")
+    parser.add_argument("--max-connections", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Timeout of a request, in seconds")
+    parser.add_argument("--ready-timeout", type=float, default=120.0, help="Seconds to wait for /readyz")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="Write the JSON report to this file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(main_async(args))
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,261 @@
+"""Micro-benchmarks of the hot paths of the backend, with a JSON baseline and a regression check.
+
+Run from the project root:
+- `PYTHONPATH=. python benchmarks/micro.py run --out benchmarks/baseline.json` records a baseline
+  (on the machine the comparisons will run on: numbers are not portable across machines).
+- `PYTHONPATH=. python benchmarks/micro.py run --compare benchmarks/baseline.json` runs the suite and
+  exits with status 1 if a benchmark got slower than the baseline by more than `--threshold`.
+- `PYTHONPATH=. python benchmarks/micro.py compare baseline.json current.json` compares two result files.
+
+Everything runs locally: the synthetic LLM provider (no latency) stands in for Cohere, embeddings
+are random unit vectors and the database is a temporary SQLite file. `--only` selects benchmarks by
+name prefix, `--sizes` the corpus sizes (indexing 100000 documents with the production HNSW settings
+takes more than 10 minutes, so it is not in the default sizes: `--sizes 1000,10000,100000`).
+"""
+import os
+import sys
+import json
+import atexit
+import shutil
+import time
+import random
+import logging
+import argparse
+import platform
+import datetime
+import tempfile
+import statistics
+import subprocess
+import typing as tp
+
+# The suite must never touch a real database or provider: configure the backend before importing it
+_workdir = tempfile.mkdtemp(prefix="micro-")
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_workdir, 'bench.db')}"
+os.environ["LLM_PROVIDER"] = "synthetic"
+os.environ["SYNTHETIC_LATENCY"] = "embed=fixed:0;rerank=fixed:0;chat=fixed:0;chat_stream=fixed:0"
+os.environ["SYNTHETIC_TOKENS_PER_SEC"] = "1000000000"
+
+import numpy as np
+
+import serialization # benchmarks/serialization.py
+
+DEFAULT_SIZES = (1000, 10000)
+DEFAULT_THRESHOLD = 0.15 # 15% slower than the baseline median is a regression
+EMBEDDING_DIMENSIONS = 1024
+
+Case = tp.Tuple[str, tp.Callable[[], tp.Any], int] # name, function timed, runs
+BENCHMARKS: tp.List[tp.Tuple[str, tp.Callable[..., tp.Iterator[Case]]]] = []
+
+
+def benchmark(name: str):
+    """Registers a generator of cases (name, function, runs); its setup is not timed."""
+    def decorator(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return decorator
+
+
+def make_docs(n: int) -> tp.List[dict]:
+    return [
+        {"title": "Ecommerce FAQ", "text": f"Question: How do I do thing {i}?\nAnswer: Go to your account and follow the steps for thing {i}.",
+         "category_id": i % 7 + 1, "id": i}
+        for i in range(n)
+    ]
+
+def stub_embeddings(n: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((n, EMBEDDING_DIMENSIONS), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def stub_vectorstore(n: int):
+    from backend.core.vectorstore import Vectorstore
+
+    vectorstore = Vectorstore.__new__(Vectorstore) # Without embedding the documents through the provider
+    vectorstore.docs = make_docs(n)
+    vectorstore.docs_len = n
+    vectorstore.docs_embs = stub_embeddings(n)
+    return vectorstore
+
+
+# --- Benchmarks ---
+
+@benchmark("vectorstore")
+def bench_vectorstore(sizes: tp.Sequence[int]) -> tp.Iterator[Case]:
+    for n in sizes:
+        vectorstore = stub_vectorstore(n)
+        yield f"vectorstore.index[{n}]", vectorstore.index, 3 if n <= 1000 else 1
+        if not hasattr(vectorstore, "idx"): # Index case filtered out
+            vectorstore.index()
+        queries = [f"How do I do thing {i}?" for i in range(50)]
+        cycle = iter(queries * 1000)
+        yield f"vectorstore.retrieve[{n}]", lambda: vectorstore.retrieve(next(cycle)), 50
+
+@benchmark("crud")
+def bench_crud(sizes: tp.Sequence[int]) -> tp.Iterator[Case]:
+    from backend.db import crud, database, models
+
+    database.create_db_and_tables()
+    db = database.SessionLocal()
+    session_id = crud.create_chat_session(db, models.ChatSessionCreate(title="Benchmark")).id
+    citations = [{"text": "the return policy", "start": 10 * i, "end": 10 * i + 8, "document_ids": [str(i), str(i + 1)]} for i in range(3)]
+    user = models.MessageCreate(role="user", content="What is the return policy?")
+    answer = models.MessageCreate(role="assistant", content="You can return any item within 30 days. " * 5, ai_model="Gemma 3")
+
+    def create_turn():
+        return crud.create_turn(db, session_id=session_id, user_message=user, assistant_message=answer, citations=citations)
+    yield "crud.create_turn", create_turn, 200
+
+    for _ in range(500 - 200): # 1000 messages in the session
+        create_turn()
+    yield "crud.get_messages_with_citations[100]", lambda: crud.get_messages_with_citations(db, session_id=session_id, limit=100), 50
+    last_id = crud.get_messages_with_citations(db, session_id=session_id, limit=1000)[-1].id
+    yield "crud.get_messages_after[10]", lambda: crud.get_messages_after(db, session_id=session_id, after_id=last_id - 10), 100
+    yield "crud.get_citations_by_msg_id", lambda: crud.get_citations_by_msg_id(db, msg_id=last_id), 200
+
+@benchmark("get_docs")
+def bench_get_docs(sizes: tp.Sequence[int]) -> tp.Iterator[Case]:
+    from backend.core.documents import DocumentStore
+
+    for n in sizes:
+        store = DocumentStore(make_docs(n))
+        rng = random.Random(0)
+        doc_ids = [str(rng.randrange(n)) for _ in range(10)]
+        yield f"get_docs.lookup[{n}]", lambda: store.get_many(doc_ids), 500
+
+@benchmark("frontend")
+def bench_frontend(sizes: tp.Sequence[int]) -> tp.Iterator[Case]:
+    try:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "frontend"))
+        from utils import format_text_with_citations # Needs streamlit
+    except ImportError as e:
+        print(f"Skipping the frontend benchmarks: {e}", file=sys.stderr)
+        return
+    text = "You can return any item within 30 days of delivery, see the return policy. " * 250 # ~19k characters
+    step = len(text) // 100
+    citations = [{"id": i, "text": text[i * step:i * step + 40], "start": i * step, "end": i * step + 40} for i in range(100)]
+    yield "frontend.format_text_with_citations[100]", lambda: format_text_with_citations(text, [dict(c) for c in citations]), 50
+
+@benchmark("mysql")
+def bench_mysql(sizes: tp.Sequence[int]) -> tp.Iterator[Case]:
+    from backend.db.mysql_v1 import MYSQL
+
+    for n in sizes:
+        rows = [(i % 7 + 1, f"How do I do thing {i}?", f"Go to your account and follow the steps for thing {i}.") for i in range(n)]
+        yield f"mysql.faq_documents[{n}]", lambda: MYSQL.faq_documents(rows), 20
+
+@benchmark("serialization")
+def bench_serialization(sizes: tp.Sequence[int]) -> tp.Iterator[Case]:
+    messages = serialization.make_messages(1000)
+    yield "serialization.default[1000]", lambda: serialization.default_path(messages), 20
+    yield "serialization.fast[1000]", lambda: serialization.fast_path(messages), 20
+
+
+# --- Running and comparing ---
+
+def measure(fn: tp.Callable[[], tp.Any], runs: int) -> tp.Dict[str, tp.Any]:
+    if runs > 1:
+        fn() # Warm-up
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {
+        "runs": runs,
+        "median_s": statistics.median(times),
+        "p95_s": times[min(int(0.95 * len(times)), len(times) - 1)],
+        "min_s": times[0],
+        "mean_s": statistics.fmean(times),
+    }
+
+def metadata() -> tp.Dict[str, tp.Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+def run_suite(only: tp.Sequence[str], sizes: tp.Sequence[int]) -> tp.Dict[str, tp.Any]:
+    results = {}
+    for group, cases in BENCHMARKS:
+        if only and not any(prefix.startswith(group) or group.startswith(prefix) for prefix in only):
+            continue # Skips the setup too
+        for name, fn, runs in cases(sizes):
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            results[name] = measure(fn, runs)
+            print(f"{name:<45}{results[name]['median_s'] * 1000:>12.3f} ms (median of {runs})", file=sys.stderr)
+    return {"meta": metadata(), "results": results}
+
+def compare(baseline: tp.Dict[str, tp.Any], current: tp.Dict[str, tp.Any], threshold: float) -> tp.List[str]:
+    """Prints a comparison of the medians; returns the names of the benchmarks that regressed."""
+    regressions = []
+    print(f"{'benchmark':<45}{'baseline ms':>13}{'current ms':>13}{'change':>9}  status")
+    names = list(baseline["results"]) + [name for name in current["results"] if name not in baseline["results"]]
+    for name in names:
+        before, after = baseline["results"].get(name), current["results"].get(name)
+        if before is None or after is None:
+            status = "new" if before is None else "missing"
+            value = (after or before)["median_s"] * 1000
+            print(f"{name:<45}{'' if before is None else f'{value:.3f}':>13}{'' if after is None else f'{value:.3f}':>13}{'':>9}  {status}")
+            continue
+        change = after["median_s"] / before["median_s"] - 1
+        if change > threshold:
+            status = "REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            status = "improved"
+        else:
+            status = "ok"
+        print(f"{name:<45}{before['median_s'] * 1000:>13.3f}{after['median_s'] * 1000:>13.3f}{change:>+9.1%}  {status}")
+    return regressions
+
+def load(path: str) -> tp.Dict[str, tp.Any]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--only", nargs="*", default=[], help="Name prefixes of the benchmarks to run, e.g. crud. vectorstore.retrieve")
+    run_parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Corpus sizes, e.g. 1000,10000,100000")
+    run_parser.add_argument("--out", help="Write the results (JSON) to this file, e.g. a new baseline")
+    run_parser.add_argument("--compare", metavar="BASELINE", help="Compare the results with this baseline")
+    run_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Relative slowdown flagged as a regression")
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        return 1 if compare(load(args.baseline), load(args.current), args.threshold) else 0
+
+    logging.disable(logging.INFO) # The pipeline logs every retrieval at INFO level
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    current = run_suite(args.only, sizes)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        regressions = compare(load(args.compare), current, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    elif not args.out:
+        print(json.dumps(current, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
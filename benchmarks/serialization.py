@@ -0,0 +1,91 @@
+"""Serialization of a message history: FastAPI's default path vs the fast path of GET /sessions/{id}/messages/.
+
+Run from the project root: `PYTHONPATH=. python benchmarks/serialization.py [--messages 1000] [--repeat 20]`
+
+- default: `MessageResponse.model_validate` per row, validation of the result against the response model,
+  `jsonable_encoder` and the stdlib JSON encoder (what FastAPI does for a `response_model` route).
+- fast: rows to plain dicts and bytes in one step (backend/api/fastjson.py).
+Both are also timed with gzip compression, as done by the GZip middleware for large responses.
+"""
+import sys
+import gzip
+import json
+import time
+import argparse
+import datetime
+import statistics
+from types import SimpleNamespace
+from typing import List
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from backend.api import fastjson
+from backend.db import models
+
+
+def make_messages(n: int, citations_per_answer: int = 3) -> List[SimpleNamespace]:
+    """ORM-like messages: alternating user questions and assistant answers with citations."""
+    start = datetime.datetime(2025, 1, 1)
+    messages, citation_id = [], 1
+    for i in range(n):
+        is_answer = i % 2 == 1
+        citations = []
+        if is_answer:
+            for _ in range(citations_per_answer):
+                citations.append(SimpleNamespace(
+                    id=citation_id, msg_id=i + 1, doc_ids=[str(citation_id % 50), str((citation_id + 7) % 50)],
+                    text="the return policy", start=12, end=29,
+                ))
+                citation_id += 1
+        messages.append(SimpleNamespace(
+            id=i + 1, session_id="3f1c2d4e-0000-4000-8000-000000000000",
+            role="assistant" if is_answer else "user",
+            content=("You can return any item within 30 days of delivery. " * 6) if is_answer else "What is the return policy?",
+            link=None, timestamp=start + datetime.timedelta(seconds=i),
+            ai_model="Gemma 3" if is_answer else None, citations=citations,
+        ))
+    return messages
+
+RESPONSE_ADAPTER = TypeAdapter(List[models.MessageResponse])
+
+def default_path(messages) -> bytes:
+    page = [models.MessageResponse.model_validate(message) for message in messages]
+    validated = RESPONSE_ADAPTER.validate_python([message.model_dump() for message in page])
+    return json.dumps(jsonable_encoder(validated), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def fast_path(messages) -> bytes:
+    return fastjson.dumps([fastjson.message_row(message) for message in messages])
+
+def timed(fn, repeat: int) -> List[float]:
+    fn() # Warm-up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    messages = make_messages(args.messages)
+    assert json.loads(default_path(messages)) == json.loads(fast_path(messages)), "Both paths must return the same JSON"
+
+    encoder = "orjson" if fastjson.orjson is not None else "stdlib json"
+    print(f"{args.messages} messages, {args.repeat} runs, fast path encoder: {encoder}")
+    print(f"{'path':<16}{'median ms':>12}{'p95 ms':>10}{'bytes':>12}")
+    for name, fn in [("default", lambda: default_path(messages)),
+                     ("fast", lambda: fast_path(messages)),
+                     ("default+gzip", lambda: gzip.compress(default_path(messages))),
+                     ("fast+gzip", lambda: gzip.compress(fast_path(messages)))]:
+        times = sorted(timed(fn, args.repeat))
+        p95 = times[min(int(0.95 * len(times)), len(times) - 1)]
+        print(f"{name:<16}{statistics.median(times) * 1000:>12.2f}{p95 * 1000:>10.2f}{len(fn()):>12}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,7 +3,7 @@ import os
 # import re
 from typing import List, Dict, Optional, Any, Literal
 # import uuid
-# from html import escape
+from html import escape
 import streamlit as st
 import streamlit.components.v1 as components
 from streamlit_modal import Modal
@@ -24,8 +24,12 @@ from utils import(
     api_get_sessions,
     api_create_session,
     api_get_messages,
+    parse_message_timestamps,
     api_create_message,
     api_get_citation,
+    api_get_citation_documents,
+    api_get_message_citations,
+    api_search_messages,
     api_get_docs,
     get_model_name_from_message,
     find_url_in_text,
@@ -135,22 +139,49 @@ def render_sidebar() -> None:
             # Scrollable Chat List
             chat_list_container = st.container(height=300, border=True)
             with chat_list_container:
-                # Sort by title or creation date if available and desired
-                # API currently sorts by created_at desc, let's use the order received
+                # API sorts by last activity (most recent first), let's use the order received
                 sorted_chat_ids = list(st.session_state.chat_sessions.keys())
 
                 for chat_id in sorted_chat_ids:
-                    chat_title = st.session_state.chat_sessions[chat_id].get('title', f"Chat {chat_id[:6]}")
+                    chat_session = st.session_state.chat_sessions[chat_id]
+                    chat_title = chat_session.get('title', f"Chat {chat_id[:6]}")
+                    message_count = chat_session.get('message_count', 0)
                     button_type = "primary" if chat_id == st.session_state.current_chat_id else "secondary"
-                    if st.button(f"💬 {chat_title[:30]}", key=f"chat_{chat_id}", use_container_width=True, type=button_type):
-                        if st.session_state.current_chat_id != chat_id:
-                             st.session_state.current_chat_id = chat_id
-                             st.session_state.show_citation_id = None # Reset modal state
-                             st.session_state.documents_cache = {} # Clear citation cache
-                             # Fetch messages for the selected chat
-                             with st.spinner(f"Loading chat '{chat_title}'..."):
-                                 st.session_state.messages = api_get_messages(chat_id)
-                             st.rerun() # Rerun to display fetched messages
+                    if st.button(f"💬 {chat_title[:30]} ({message_count})", key=f"chat_{chat_id}", use_container_width=True,
+                                 type=button_type, help=chat_session.get('last_message_preview')):
+                        open_chat(chat_id, chat_title)
+
+        # --- Message Search ---
+        search_query = st.text_input("Search messages", key="search_query", placeholder="Search all chats...")
+        if search_query:
+            results = api_search_messages(search_query)
+            if not results:
+                st.caption("No matching messages.")
+            for result in results:
+                # The snippet is escaped HTML, with the matching words in <mark> tags
+                st.markdown(f"**{escape(result['session_title'][:30])}** · {result['role']}<br>{result['snippet']}", unsafe_allow_html=True)
+                if st.button("Open chat", key=f"search_{result['id']}"):
+                    open_chat(result['session_id'], result['session_title'])
+
+def open_chat(chat_id: str, chat_title: str) -> None:
+    """Select a chat and load its messages."""
+    if st.session_state.current_chat_id != chat_id:
+         st.session_state.current_chat_id = chat_id
+         st.session_state.show_citation_id = None # Reset modal state
+         st.session_state.documents_cache = {} # Clear citation cache
+         # Fetch messages for the selected chat
+         with st.spinner(f"Loading chat '{chat_title}'..."):
+             st.session_state.messages = api_get_messages(chat_id)
+         st.rerun() # Rerun to display fetched messages
+
+def sync_messages(chat_id: str) -> None:
+    """Fetch the messages newer than the last one we have (the whole chat again if its message IDs changed)."""
+    last_id = max((m["id"] for m in st.session_state.messages), default=0)
+    new_messages = api_get_messages(chat_id, after=last_id, epoch=st.session_state.get("message_epoch"))
+    if new_messages is None:
+        st.session_state.messages = api_get_messages(chat_id)
+    else:
+        st.session_state.messages.extend(new_messages)
 
 def render_chat_message(message: Dict, index: int) -> None:
     """Render a single chat message from the fetched data.
@@ -188,6 +219,7 @@ def render_chat_message(message: Dict, index: int) -> None:
                     button_key = f"trigger-button-{citation_id}-{index}-{idx}"
                     if st.button(f"[{citation_id}]", key=button_key, help=f"View details for '{citation['text']}'"):
                         st.session_state.show_citation_id = citation_id
+                        st.session_state.show_citation_msg_id = message.get("id")
                         # No rerun here, display_citation_modal logic handles opening
                         # Need to trigger a rerun *after* state is set if modal check is later
                         st.rerun() # Rerun needed to make modal check happen
@@ -257,12 +289,29 @@ def render_chat_area() -> None:
 
             if created_assistant_msg:
                 print(f"3. render_chat_area -> created_assistant_msg: {created_assistant_msg} ")
-                # 3. Refresh message list from backend to show user msg & potential (future) assistant msg
-                with st.spinner("Checking for response..."): # Placeholder spinner
-                    st.session_state.messages = api_get_messages(current_chat_id)
-                st.rerun() # Rerun to display the refreshed message list
+                # 3. Append the stored turn to the local history instead of fetching the whole session again
+                user_msg = created_assistant_msg.pop("user_message", None)
+                message_epoch = created_assistant_msg.pop("message_epoch", None)
+                if message_epoch is not None and message_epoch != st.session_state.get("message_epoch", message_epoch):
+                    # The chat was restored from the archive under new message IDs: reload it
+                    with st.spinner("Reloading chat..."):
+                        st.session_state.messages = api_get_messages(current_chat_id)
+                elif user_msg:
+                    st.session_state.messages.extend(parse_message_timestamps([user_msg, created_assistant_msg]))
+                else:
+                    # Only fetch what is newer than the last message we have
+                    with st.spinner("Checking for response..."):
+                        sync_messages(current_chat_id)
+                # Move the chat to the top of the sidebar with its new activity summary, as the backend does
+                chat_session = st.session_state.chat_sessions.pop(current_chat_id, {"id": current_chat_id})
+                chat_session["message_count"] = chat_session.get("message_count", 0) + 2
+                chat_session["last_message_preview"] = created_assistant_msg["content"][:120]
+                st.session_state.chat_sessions = {current_chat_id: chat_session, **st.session_state.chat_sessions}
+                st.rerun() # Rerun to display the updated message list
             else:
                  st.error("Failed to send message.") # API call already showed error
+                 # The backend keeps the user message of a turn it could not answer: show it
+                 sync_messages(current_chat_id)
 
 
 def display_citation_modal(modal_instance: Modal) -> None:
@@ -281,9 +330,16 @@ def display_citation_modal(modal_instance: Modal) -> None:
         else:
             # Fetch from API if not in cache
             with st.spinner(f"Loading citation '{citation_id}'..."):
-                doc_ids = api_get_citation(citation_id)
-                print(f"1. display_citation_modal -> doc_ids: {doc_ids}")
-                docs = api_get_docs(doc_ids)
+                # Evidence of the whole message in one request: its other citations open from the cache
+                msg_id = st.session_state.get("show_citation_msg_id")
+                message_docs = api_get_message_citations(msg_id) if msg_id is not None else None
+                if message_docs:
+                    for cited_id, cited_docs in message_docs.items():
+                        if cited_docs:
+                            st.session_state.documents_cache[cited_id] = cited_docs
+                    docs = message_docs.get(citation_id)
+                if not docs:
+                    docs = api_get_citation_documents(citation_id)
                 print(f"2. display_citation_modal -> docs 1: {docs}")
             if docs:
                 st.session_state.documents_cache[citation_id] = docs # Store in cache
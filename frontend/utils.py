@@ -3,7 +3,7 @@
 import os
 import datetime
 import re
-from typing import List
+from typing import Dict, List, Tuple
 # import uuid
 from html import escape
 import streamlit as st
@@ -47,7 +47,8 @@ def api_get_sessions() -> List[dict]:
     """
     try:
         logger.info(f"Fetching sessions from {BACKEND_URL}/sessions/")
-        response = requests.get(f"{BACKEND_URL}/sessions/")
+        # Most recently active first, with their message count and last message preview
+        response = requests.get(f"{BACKEND_URL}/sessions/", params={"sort": "activity"})
         logger.info(f"Response: {response}")
         if response.status_code == 200:
             return response.json() # Returns list of session dicts
@@ -81,36 +82,66 @@ def api_create_session(title: str = None) -> dict:
         st.error(f"Network error creating session: {e}")
         return None
 
-def api_get_messages(session_id: str) -> List[dict]:
-    """Fetch messages for a specific session.
+def parse_message_timestamps(messages: List[dict]) -> List[dict]:
+    """Convert the timestamp strings of messages to datetime objects, in place."""
+    for msg in messages:
+         if isinstance(msg.get("timestamp"), str):
+             try:
+                 # Attempt to parse ISO format timestamp
+                 msg["timestamp"] = datetime.datetime.fromisoformat(msg["timestamp"])
+             except ValueError:
+                  # Handle other potential formats or leave as string if parsing fails
+                  pass # Keep original string if parsing fails
+    return messages
+
+def api_get_messages(session_id: str, page_size: int = 100, after: int = None, epoch: int = None) -> List[dict]:
+    """Fetch messages for a specific session, following the pagination cursors page by page.
+    The message epoch of the session is kept in `st.session_state.message_epoch`.
     
     Args:
         session_id (str): The ID of the session to fetch messages for.
+        page_size (int): Number of messages requested per page.
+        after (int, optional): Only fetch the messages newer than this message ID (incremental sync).
+        epoch (int, optional): With `after`, the message epoch the local messages come from.
         
     Returns:
         List[dict]: A list of message dictionaries, or an empty list if an error occurred.
+        None if the message IDs of the session changed since `epoch`: reload the session without `after`.
     """
     if not session_id: return []
+    messages = []
+    params = {"limit": page_size}
+    if after is not None:
+        params["after"] = after
+        if epoch is not None:
+            params["epoch"] = epoch
     try:
-        response = requests.get(f"{BACKEND_URL}/sessions/{session_id}/messages/")
-        if response.status_code == 200:
-            # Convert timestamp strings to datetime objects if necessary (FastAPI/Pydantic might do this)
-            messages = response.json()
-            for msg in messages:
-                 if isinstance(msg.get("timestamp"), str):
-                     try:
-                         # Attempt to parse ISO format timestamp
-                         msg["timestamp"] = datetime.datetime.fromisoformat(msg["timestamp"])
-                     except ValueError:
-                          # Handle other potential formats or leave as string if parsing fails
-                          pass # Keep original string if parsing fails
-            return messages # Returns list of message dicts
-        elif response.status_code == 404:
-             st.warning(f"Session {session_id} not found on backend.")
-             return []
-        else:
-            handle_api_error(response, f"fetching messages for session {session_id}")
-            return []
+        while True:
+            response = requests.get(f"{BACKEND_URL}/sessions/{session_id}/messages/", params=params)
+            if response.status_code == 200:
+                if "X-Message-Epoch" in response.headers:
+                    st.session_state.message_epoch = int(response.headers["X-Message-Epoch"])
+                # Convert timestamp strings to datetime objects if necessary (FastAPI/Pydantic might do this)
+                page = parse_message_timestamps(response.json())
+                messages.extend(page)
+                if after is not None:
+                    # Delta reads: a full page means there may be more after its last message
+                    if len(page) < page_size:
+                        return messages
+                    params["after"] = page[-1]["id"]
+                    continue
+                next_cursor = response.headers.get("X-Next-Cursor")
+                if not next_cursor:
+                    return messages # Returns list of message dicts
+                params["cursor"] = next_cursor
+            elif response.status_code == 404:
+                 st.warning(f"Session {session_id} not found on backend.")
+                 return []
+            elif response.status_code == 409 and after is not None:
+                return None # The session was restored from the archive under new message IDs
+            else:
+                handle_api_error(response, f"fetching messages for session {session_id}")
+                return []
     except requests.exceptions.RequestException as e:
         st.error(f"Network error fetching messages: {e}")
         return []
@@ -128,7 +159,8 @@ def api_create_message(
         link (str, optional): An optional URL associated with the message. TODO: remove link
         
     Returns:
-        dict: The assistant message dictionary, or None if an error occurred.
+        dict: The assistant message dictionary, with the stored user message under "user_message",
+            or None if an error occurred.
     """
     if not session_id: return None
     payload = {"role": role, "content": content}
@@ -173,6 +205,77 @@ def api_get_citation(citation_id: str) -> List[str]:
         st.error(f"Network error fetching citation: {e}")
         return None
     
+def api_get_citation_documents(citation_id: str) -> List[dict]:
+    """Fetch the documents of a citation in a single request (`expand=documents`).
+    
+    Args:
+        citation_id (str): The ID of the citation.
+        
+    Returns:
+        List[dict]: The documents of the citation, or None if an error occurred.
+    """
+    try:
+        response = requests.get(f"{BACKEND_URL}/citations/{citation_id}", params={"expand": "documents"})
+        if response.status_code == 200:
+            return response.json()["documents"]
+        elif response.status_code == 404:
+             st.toast(f"Citation '{citation_id}' not found.")
+             return None
+        else:
+            handle_api_error(response, f"fetching citation {citation_id}")
+            return None
+    except requests.exceptions.RequestException as e:
+        st.error(f"Network error fetching citation: {e}")
+        return None
+
+def api_get_message_citations(msg_id: int) -> Dict[int, List[dict]]:
+    """Fetch the documents of every citation of a message in a single request.
+    
+    Args:
+        msg_id (int): The ID of the (assistant) message.
+        
+    Returns:
+        Dict[int, List[dict]]: The documents of each citation by citation ID, or None if an error occurred.
+    """
+    try:
+        response = requests.get(f"{BACKEND_URL}/messages/{msg_id}/citations", params={"expand": "documents"})
+        if response.status_code == 200:
+            return {citation["id"]: citation["documents"] for citation in response.json()}
+        else:
+            handle_api_error(response, f"fetching the citations of message {msg_id}")
+            return None
+    except requests.exceptions.RequestException as e:
+        st.error(f"Network error fetching citations: {e}")
+        return None
+
+def api_search_messages(query: str, session_id: str = None, limit: int = 20) -> List[dict]:
+    """Search the stored messages (full text), most relevant first.
+    
+    Args:
+        query (str): The words to search for.
+        session_id (str): Only search the messages of this chat session (optional).
+        limit (int): The maximum number of results.
+        
+    Returns:
+        List[dict]: The matching messages with their session and an HTML snippet, or an empty list if an error occurred.
+    """
+    params = {"q": query, "limit": limit}
+    if session_id:
+        params["session_id"] = session_id
+    try:
+        response = requests.get(f"{BACKEND_URL}/messages/search", params=params)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            handle_api_error(response, "searching messages")
+            return []
+    except requests.exceptions.RequestException as e:
+        st.error(f"Network error searching messages: {e}")
+        return []
+
+# Documents responses by requested IDs, with their ETag: {ids: (etag, docs)}
+_docs_cache: Dict[str, Tuple[str, List[dict]]] = {}
+
 def api_get_docs(doc_ids: List[str]) -> List[dict]:
     """Fetch documents from the backend.
     
@@ -182,10 +285,20 @@ def api_get_docs(doc_ids: List[str]) -> List[dict]:
     Returns:
         List[dict]: A list of document dictionaries, or None if an error occurred.
     """
+    key = ",".join(doc_ids)
+    cached = _docs_cache.get(key)
+    headers = {"If-None-Match": cached[0]} if cached else {}
     try:
-        response = requests.post(f"{BACKEND_URL}/sessions/documents/", json={"doc_ids": doc_ids})
+        response = requests.get(f"{BACKEND_URL}/documents/", params={"ids": key}, headers=headers)
+        if response.status_code == 304: # Unchanged since the cached response
+            return cached[1]
         if response.status_code == 200:
-            return response.json() # Returns docs dict {'id', 'text', etc.}
+            docs = response.json() # Returns docs dict {'id', 'text', etc.}
+            if response.headers.get("ETag"):
+                if len(_docs_cache) >= 1024: # Keep the cache bounded
+                    _docs_cache.clear()
+                _docs_cache[key] = (response.headers["ETag"], docs)
+            return docs
         elif response.status_code == 404:
              st.toast(f"Documents '{doc_ids}' not found.")
              return None
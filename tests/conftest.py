@@ -0,0 +1,28 @@
+"""Test setup: a throwaway SQLite database and the synthetic LLM provider, set before `backend` is imported."""
+import os
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="chatbot-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'test.db')}"
+os.environ["LLM_PROVIDER"] = "synthetic"
+os.environ.setdefault("INDEX_DIR", os.path.join(_tmp, "index"))
+
+import pytest
+
+from backend.db import database
+
+
+@pytest.fixture(scope="session", autouse=True)
+def tables():
+    database.create_db_and_tables()
+
+
+@pytest.fixture
+def db():
+    session = database.SessionLocal()
+    yield session
+    session.close()
+    # Every test starts from empty tables
+    with database.engine.begin() as connection:
+        for table in reversed(database.Base.metadata.sorted_tables):
+            connection.execute(table.delete())
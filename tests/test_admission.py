@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+from sqlalchemy.pool import QueuePool
+
+from backend.core import admission
+
+
+def controller(**kwargs):
+    options = {"max_in_flight": 1, "max_queue": 2, "queue_timeout": 1.0, "session_rate": 0, "session_burst": 1}
+    return admission.AdmissionController(**{**options, **kwargs})
+
+async def queued(ctrl, n=1):
+    """Waits for `n` waiters to be queued."""
+    while ctrl.waiting < n:
+        await asyncio.sleep(0)
+
+
+def test_pool_capacity():
+    pool = QueuePool(lambda: None, pool_size=5, max_overflow=10)
+    assert admission.pool_capacity(pool, headroom=2) == 13
+    assert admission.pool_capacity(QueuePool(lambda: None, pool_size=1, max_overflow=0), headroom=2) == 1
+    assert admission.pool_capacity(QueuePool(lambda: None, pool_size=5, max_overflow=-1)) == admission.UNBOUNDED_POOL_MAX_IN_FLIGHT
+
+def test_default_cap_fits_the_pool():
+    from backend.db import database
+    assert admission.controller.max_in_flight == admission.pool_capacity(database.engine.pool)
+
+def test_queue_full_is_rejected():
+    async def run():
+        ctrl = controller(max_queue=1)
+        await ctrl.acquire()
+        waiter = asyncio.create_task(ctrl.acquire())
+        await queued(ctrl)
+        with pytest.raises(admission.AdmissionRejected) as rejected:
+            await ctrl.acquire()
+        assert rejected.value.reason == "queue_full" and rejected.value.status_code == 503
+        ctrl.release()
+        await waiter
+        ctrl.release()
+        assert ctrl.stats() == {"in_flight": 0, "waiting": 0, "admitted": 2, "rejected": {"queue_full": 1, "queue_timeout": 0, "session_rate": 0}}
+    asyncio.run(run())
+
+def test_release_hands_the_slot_over_in_order():
+    async def run():
+        ctrl = controller()
+        order = []
+        async def turn(name):
+            async with ctrl.admit():
+                order.append(name)
+                await asyncio.sleep(0.01)
+        first = asyncio.create_task(turn("first"))
+        await asyncio.sleep(0)
+        rest = [asyncio.create_task(turn(name)) for name in ("second", "third")]
+        await queued(ctrl, 2)
+        assert ctrl.in_flight == 1
+        await asyncio.gather(first, *rest)
+        assert order == ["first", "second", "third"]
+        assert ctrl.in_flight == 0 and ctrl.waiting == 0
+    asyncio.run(run())
+
+def test_queue_timeout():
+    async def run():
+        ctrl = controller(queue_timeout=0.01)
+        await ctrl.acquire()
+        with pytest.raises(admission.AdmissionRejected) as rejected:
+            await ctrl.acquire()
+        assert rejected.value.reason == "queue_timeout"
+        assert ctrl.waiting == 0 and ctrl.in_flight == 1
+        ctrl.release()
+        assert ctrl.in_flight == 0
+    asyncio.run(run())
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        ctrl = controller()
+        await ctrl.acquire()
+        waiter = asyncio.create_task(ctrl.acquire())
+        await queued(ctrl)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert ctrl.waiting == 0
+        ctrl.release()
+        assert ctrl.in_flight == 0
+    asyncio.run(run())
+
+def test_cancelled_after_handover_passes_the_slot_on():
+    async def run():
+        ctrl = controller()
+        await ctrl.acquire()
+        first = asyncio.create_task(ctrl.acquire())
+        await queued(ctrl)
+        second = asyncio.create_task(ctrl.acquire())
+        await queued(ctrl, 2)
+        ctrl.release() # Hands the slot to `first`...
+        first.cancel() # ...which is cancelled before it runs
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await second # Got the slot instead
+        assert ctrl.in_flight == 1 and ctrl.waiting == 0
+        ctrl.release()
+        assert ctrl.in_flight == 0
+    asyncio.run(run())
+
+def test_session_rate_only_charges_admitted_turns():
+    async def run():
+        ctrl = controller(max_queue=0, session_rate=0.001, session_burst=1)
+        await ctrl.acquire("other")
+        for _ in range(3): # Shed for load: the session keeps its token
+            with pytest.raises(admission.AdmissionRejected) as rejected:
+                await ctrl.acquire("chat")
+            assert rejected.value.reason == "queue_full"
+        ctrl.release()
+        await ctrl.acquire("chat")
+        ctrl.release()
+        with pytest.raises(admission.AdmissionRejected) as rejected:
+            await ctrl.acquire("chat")
+        assert rejected.value.reason == "session_rate" and rejected.value.status_code == 429
+        assert ctrl.in_flight == 0
+    asyncio.run(run())
@@ -0,0 +1,34 @@
+import logging
+
+from backend.core.history import HistoryManager, estimate_tokens
+from backend.db import crud, models
+
+
+def add_turns(db, session_id, n):
+    for i in range(n):
+        crud.create_message(db, session_id, models.MessageCreate(role="user", content=f"question {i}"))
+        crud.create_message(db, session_id, models.MessageCreate(role="assistant", content=f"answer {i}"))
+
+def test_messages_missing_from_a_lagging_summary_are_sent(db):
+    session_id = crud.create_chat_session(db, models.ChatSessionCreate(title="History")).id
+    add_turns(db, session_id, 4)
+    manager = HistoryManager(llm=None, keep_turns=1)
+
+    history = manager.build_history(db, session_id) # Never compacted: no summary
+    assert [message["message"] for message in history] == [f"{kind} {i}" for i in range(4) for kind in ("question", "answer")]
+
+    messages = crud.get_messages_for_session(db, session_id)
+    crud.upsert_conversation_summary(db, session_id, summary="Asked 0 and 1.", last_msg_id=messages[3].id)
+    history = manager.build_history(db, session_id)
+    assert history[0]["role"] == "SYSTEM"
+    assert [message["message"] for message in history[1:]] == ["question 2", "answer 2", "question 3", "answer 3"]
+
+def test_messages_over_the_budget_are_logged(db, caplog):
+    session_id = crud.create_chat_session(db, models.ChatSessionCreate(title="History")).id
+    add_turns(db, session_id, 3)
+    manager = HistoryManager(llm=None, keep_turns=1, token_budget=2 * estimate_tokens("question 0"))
+
+    with caplog.at_level(logging.WARNING, logger="backend.core.history"):
+        history = manager.build_history(db, session_id)
+    assert [message["message"] for message in history] == ["question 2", "answer 2"]
+    assert "Left 4 messages" in caplog.text
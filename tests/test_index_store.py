@@ -0,0 +1,50 @@
+import os
+
+from backend.core import index_store
+
+DOCS = [{"id": "1", "question": "Refund?"}, {"id": "2", "question": "Shipping?"}]
+EMBEDDINGS = [[1.0, 0.0], [0.0, 1.0]]
+
+
+def builds(tmp_path):
+    return sorted(entry for entry in os.listdir(tmp_path) if entry != "index")
+
+def test_build_swaps_a_symlink_and_keeps_the_previous_build(tmp_path):
+    out_dir = str(tmp_path / "index")
+    index_store.build(DOCS, EMBEDDINGS, out_dir)
+    first = os.path.realpath(out_dir)
+    store = index_store.IndexStore(out_dir)
+    assert os.path.islink(out_dir)
+    assert store.docs[1] == DOCS[1]
+
+    index_store.build(DOCS[:1], EMBEDDINGS[:1], out_dir)
+    second = os.path.realpath(out_dir)
+    assert second != first and len(builds(tmp_path)) == 2
+    assert index_store.IndexStore(out_dir).manifest["documents"] == 1
+    assert store.docs[1] == DOCS[1] # The old mapping still works
+
+    index_store.build(DOCS, EMBEDDINGS, out_dir)
+    assert builds(tmp_path) == sorted(os.path.basename(path) for path in (second, os.path.realpath(out_dir)))
+
+def test_build_replaces_an_index_directory(tmp_path):
+    out_dir = str(tmp_path / "index")
+    os.makedirs(out_dir) # Built before the symlinks
+    index_store.build(DOCS, EMBEDDINGS, out_dir)
+    assert os.path.islink(out_dir) and len(builds(tmp_path)) == 1
+    assert index_store.IndexStore(out_dir).index.knn_query([1.0, 0.0], k=1)[0][0][0] == 0
+
+def test_documents_are_looked_up_in_the_mapped_ids(tmp_path):
+    from backend.core.documents import DocumentStore
+    out_dir = str(tmp_path / "index")
+    docs = [{"id": 10, "question": "a"}, {"id": 2, "question": "b"}, {"id": "x", "question": "c"}]
+    index_store.build(docs, [[1.0]] * 3, out_dir)
+    store = DocumentStore(index_store.IndexStore(out_dir).docs)
+    assert store.positions is None
+    assert len(store) == 3
+    assert store.get_many(["x", 2, "10", "missing", "1"]) == [docs[2], docs[1], docs[0]]
+
+def test_index_without_id_files(tmp_path):
+    out_dir = str(tmp_path / "index")
+    index_store.build(DOCS, EMBEDDINGS, out_dir)
+    os.remove(os.path.join(out_dir, index_store.IDS_FILE)) # Built by an older version
+    assert index_store.IndexStore(out_dir).docs.position_of("2") == 1
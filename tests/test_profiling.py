@@ -0,0 +1,15 @@
+from backend.core import profiling
+
+
+def test_nested_section_keeps_the_active_profiler(tmp_path):
+    profiler = profiling.RequestProfiler(directory=str(tmp_path), max_concurrent=2)
+    outer = profiler.begin()
+    with profiling.profiled():
+        inner = profiler.begin() # A second request profiled in the same thread (event loop)
+        with profiling.profiled():
+            sum(range(10))
+        assert profiler.end(inner) is None
+        sum(range(10))
+    assert len(outer.profiles) == 1
+    assert profiler.end(outer) == outer.id
+    assert (tmp_path / f"{outer.id}.pstats").exists()
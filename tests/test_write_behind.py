@@ -0,0 +1,193 @@
+import os
+import json
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from backend.db import crud, database, models, write_behind
+
+
+@pytest.fixture
+def chat_session(db):
+    return crud.create_chat_session(db, models.ChatSessionCreate(title="Write-behind")).id
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    queues = []
+    def make(**kwargs):
+        # A long interval: the tests flush explicitly
+        queue = write_behind.WriteBehindQueue(log_path=str(tmp_path / "turns.log"), interval=3600, fsync=False, **kwargs)
+        queues.append(queue)
+        return queue
+    yield make
+    for queue in queues:
+        if queue.started:
+            queue._stop.set()
+            queue._wake.set()
+            queue._worker.join()
+            queue._log.close()
+            queue._log = None
+
+
+def submit(queue, session_id, n=1):
+    return [
+        queue.submit(
+            session_id,
+            models.MessageCreate(role="user", content=f"question {i}"),
+            models.MessageCreate(role="assistant", content=f"answer {i}", ai_model="test"),
+            [{"text": "answer", "start": 0, "end": 6, "document_ids": ["doc1", "doc2"]}],
+        )
+        for i in range(n)
+    ]
+
+def crash(queue):
+    """Stops a queue without flushing it."""
+    queue.flush = lambda: 0 # The worker flushes once more when stopped
+    queue._stop.set()
+    queue._wake.set()
+    queue._worker.join()
+    queue._log.close()
+    queue._log = None
+
+def stored_messages(db, session_id):
+    db.expire_all()
+    return db.query(database.Message).filter(database.Message.session_id == session_id).order_by(database.Message.id).all()
+
+
+def test_flush_writes_turns_and_truncates_log(db, chat_session, make_queue):
+    queue = make_queue()
+    queue.start()
+    (user, assistant), = submit(queue, chat_session)
+    assert queue.pending_count() == 1
+    assert [m.id for m in queue.pending_messages(chat_session)] == [user.id, assistant.id]
+    assert queue.pending_citations_of_message(assistant.id)[0].doc_ids == ["doc1", "doc2"]
+
+    assert queue.flush() == 1
+    assert queue.pending_count() == 0
+    assert queue.pending_messages(chat_session) == []
+    messages = stored_messages(db, chat_session)
+    assert [(m.id, m.content) for m in messages] == [(user.id, "question 0"), (assistant.id, "answer 0")]
+    assert [c.doc_ids for c in messages[1].citations] == [["doc1", "doc2"]]
+    assert db.get(database.ChatSession, chat_session).message_count == 2
+    with open(queue.checkpoint_path) as f:
+        assert f.read() == "1"
+    with open(queue.log_path) as f:
+        assert f.read() == ""
+
+def test_replay_after_crash(db, chat_session, make_queue):
+    crashed = make_queue()
+    crashed.start()
+    turns = submit(crashed, chat_session, n=3)
+    crash(crashed) # Nothing flushed
+
+    queue = make_queue()
+    queue.start() # Replays and flushes the logged turns
+    assert queue.pending_count() == 0
+    assert [m.id for m in stored_messages(db, chat_session)] == [m.id for turn in turns for m in turn]
+    # New turns get IDs after the replayed ones
+    (user, _), = submit(queue, chat_session)
+    assert user.id == turns[-1][1].id + 1
+
+def test_replay_skips_checkpointed_turns(db, chat_session, make_queue):
+    queue = make_queue()
+    queue.start()
+    submit(queue, chat_session, n=2)
+    queue._log.flush()
+    with open(queue.log_path) as f:
+        logged = [json.loads(line) for line in f]
+    # Crash after the first turn was committed, before the log was truncated
+    crud.insert_turns(db, logged[:1])
+    queue._write_checkpoint(logged[0]["seq"])
+
+    replay = make_queue()
+    assert [turn["seq"] for turn in replay._read_log() if turn["seq"] > replay._read_checkpoint()] == [logged[1]["seq"]]
+
+def test_replay_of_committed_turns_is_idempotent(db, chat_session, make_queue):
+    queue = make_queue()
+    queue.start()
+    submit(queue, chat_session, n=2)
+    queue._log.flush()
+    with open(queue.log_path) as f:
+        logged = [json.loads(line) for line in f]
+    crud.insert_turns(db, logged) # Committed, but the checkpoint was not written
+
+    assert crud.insert_turns(db, logged) == 0
+    assert len(stored_messages(db, chat_session)) == 4
+    assert db.get(database.ChatSession, chat_session).message_count == 4
+
+def test_torn_last_entry_is_removed(db, chat_session, make_queue):
+    with open(make_queue().log_path, "w") as f:
+        f.write('{"seq":1,"session_id":') # Crash in the middle of the first append
+    queue = make_queue()
+    queue.start() # Nothing to replay
+    (user, assistant), = submit(queue, chat_session)
+    crash(queue)
+
+    replay = make_queue()
+    assert [turn["seq"] for turn in replay._read_log()] == [1]
+    replay.start()
+    assert [m.id for m in stored_messages(db, chat_session)] == [user.id, assistant.id]
+
+def test_rejected_turn_is_dead_lettered(db, chat_session, make_queue):
+    queue = make_queue()
+    queue.start()
+    turns = submit(queue, chat_session, n=3)
+    with queue._lock:
+        poison = list(queue._pending.values())[1]
+        poison["messages"][0]["content"] = None # NOT NULL violation
+    dead_letters = write_behind.DEAD_LETTERS.values.get((), 0)
+
+    assert queue.flush() == 2
+    assert queue.pending_count() == 0
+    assert [m.id for m in stored_messages(db, chat_session)] == [m.id for i in (0, 2) for m in turns[i]]
+    with open(queue.dead_letter_path) as f:
+        entries = [json.loads(line) for line in f]
+    assert [entry["turn"]["seq"] for entry in entries] == [poison["seq"]]
+    assert entries[0]["error"].startswith("IntegrityError")
+    assert write_behind.DEAD_LETTERS.values.get((), 0) == dead_letters + 1
+    with open(queue.checkpoint_path) as f:
+        assert f.read() == str(poison["seq"] + 1)
+
+def test_unavailable_database_keeps_turns_pending(db, chat_session, make_queue, monkeypatch):
+    queue = make_queue()
+    queue.start()
+    submit(queue, chat_session, n=2)
+    def unavailable(db, turns):
+        raise OperationalError("INSERT", {}, Exception("database is locked"))
+    monkeypatch.setattr(crud, "insert_turns", unavailable)
+
+    assert queue.flush() == 0
+    assert queue.pending_count() == 2
+    assert len(queue.pending_messages(chat_session)) == 4
+    assert not os.path.exists(queue.dead_letter_path)
+
+    monkeypatch.undo()
+    assert queue.flush() == 2
+    assert len(stored_messages(db, chat_session)) == 4
+
+def test_turns_of_deleted_sessions_are_dropped(db, chat_session, make_queue):
+    other = crud.create_chat_session(db, models.ChatSessionCreate(title="Other")).id
+    queue = make_queue()
+    queue.start()
+    submit(queue, chat_session)
+    submit(queue, other)
+
+    assert queue.discard_sessions([other]) == 1
+    assert queue.pending_messages(other) == []
+    crud.delete_chat_sessions(db, [other])
+    assert queue.flush() == 1
+    assert stored_messages(db, other) == []
+
+def test_replayed_turns_of_deleted_sessions_are_skipped(db, chat_session, make_queue):
+    queue = make_queue()
+    queue.start()
+    submit(queue, chat_session)
+    queue._log.flush()
+    with open(queue.log_path) as f:
+        logged = [json.loads(line) for line in f]
+    crud.delete_chat_sessions(db, [chat_session])
+
+    assert crud.insert_turns(db, logged) == 0
+    db.expire_all()
+    assert db.query(database.Message).count() == 0